@@ -1,26 +1,49 @@
 """api.py - Create and configure the Game API exposing the resources."""
 
 
-import textwrap
+import collections
+import itertools
+import logging
 import endpoints
 from protorpc import remote, messages
 from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 
-from models import User, Game, Score
+from models import User, Game, GameArchive, Score, Leaderboard, \
+    LEADERBOARD_SIZE, ALL_DIFFICULTIES
 from models import StringMessage, NewGameForm, GameForm, GameKeysForm, \
-    MakeMoveForm, ScoreForms, UserRank, UserRankForms, GameHistoryForm
-from utils import get_by_urlsafe
+    MakeMoveForm, ScoreForms, UserRank, UserRankForms, GameHistoryForm, \
+    MakeMovesForm, MoveResultForm, MoveResultsForm, MoveReceipt, \
+    RankHistogram, UserPositionForm, UserPositionForms, HintForm, \
+    NewGamesForm, GameForms
+from stats import timed
+from utils import get_key_by_urlsafe, get_user_names, fetch_page, \
+    run_in_transaction, schedule_task, TransactionConflictError
+from words import DEFAULT_DICTIONARY
+import counters
+import game_cache
+import guesses
+import history
+import startup
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),
 )
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),
+)
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    offset=messages.IntegerField(2),
+    limit=messages.IntegerField(3),
+)
 USER_REQUEST = endpoints.ResourceContainer(
     user=messages.StringField(1),
     email=messages.StringField(2)
@@ -28,11 +51,36 @@ USER_REQUEST = endpoints.ResourceContainer(
 USER_NAME = endpoints.ResourceContainer(
     user_name=messages.StringField(1)
 )
+SCORES_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2)
+)
+USER_SCORES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3)
+)
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+    difficulty=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3)
+)
 HIGH_SCORE_REQUEST = endpoints.ResourceContainer(
-    number_of_results=messages.IntegerField(1)
+    number_of_results=messages.IntegerField(1),
+    difficulty=messages.StringField(2)
+)
+HINT_REQUEST = endpoints.ResourceContainer(
+    pattern=messages.StringField(1, required=True),
+    incorrect_letters=messages.StringField(2),
+    dictionary=messages.StringField(3, default=DEFAULT_DICTIONARY)
 )
 MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
 
+# most games create_games_bulk makes at once, and the most user names that
+# can be looked up with one IN query
+MAX_BULK_GAMES = 500
+IN_QUERY_SIZE = 30
+
 
 @endpoints.api(name='hangman', version='v1')
 class HangmanApi(remote.Service):
@@ -42,6 +90,7 @@ class HangmanApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @timed
     def create_user(self, request):
         """Create a User. Requires a unique username"""
         if User.query(User.name == request.user).get():
@@ -57,6 +106,7 @@ class HangmanApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @timed
     def new_game(self, request):
         """Creates new game"""
         user = User.query(User.name == request.user).get()
@@ -68,371 +118,656 @@ class HangmanApi(remote.Service):
                 user.key,
                 request.attempts,
                 request.min_letters,
-                request.max_letters
-            )
-        except ValueError:
-            raise endpoints.BadRequestException(
-                'Attempts must be 6, 9, or 12!'
+                request.max_letters,
+                request.dictionary,
+                request.word_difficulty,
+                user.name
             )
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
 
         # Use a task queue to update the average attempts remaining.
         # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
+        # so it is performed out of sequence. Games created close together
+        # share one task.
+        schedule_task('/tasks/cache_average_attempts')
         return game.to_form('Good luck playing Hangman!')
 
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameForms,
+                      path='games',
+                      name='create_games_bulk',
+                      http_method='POST')
+    @timed
+    def create_games_bulk(self, request):
+        """Creates the same kind of game for each of a list of users, for
+        example for a tournament. If shared_word is True, every game has the
+        same word. The games are saved together, and the users are looked up
+        in batches."""
+        # each user gets one game
+        names = list(collections.OrderedDict.fromkeys(request.users))
+        if not names:
+            raise endpoints.BadRequestException('No users were given!')
+        if len(names) > MAX_BULK_GAMES:
+            raise endpoints.BadRequestException(
+                'At most %d games can be created at once.' % MAX_BULK_GAMES
+            )
+        users = self._get_users_by_name(names)
+        missing = [name for name in names if name not in users]
+        if missing:
+            raise endpoints.NotFoundException(
+                'These Users do not exist: %s' % ', '.join(missing)
+            )
+        try:
+            games = Game.new_games(
+                [users[name] for name in names],
+                request.attempts,
+                request.min_letters,
+                request.max_letters,
+                request.dictionary,
+                request.word_difficulty,
+                request.shared_word
+            )
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+        schedule_task('/tasks/cache_average_attempts')
+        return GameForms(items=[
+            game.to_form('Good luck playing Hangman!') for game in games
+        ])
+
+    @staticmethod
+    def _get_users_by_name(names):
+        """Returns a dictionary of name to User for the users with the given
+        names. The names are looked up IN_QUERY_SIZE at a time, with all the
+        queries running at once."""
+        futures = [
+            User.query(
+                User.name.IN(names[start:start + IN_QUERY_SIZE])
+            ).fetch_async()
+            for start in range(0, len(names), IN_QUERY_SIZE)
+        ]
+        return dict(
+            (user.name, user) for future in futures
+            for user in future.get_result()
+        )
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @timed
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = self._get_cached_game(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        )
         if game.cancelled:
             return game.to_form('This game has been cancelled.')
         elif game.game_over:
             return game.to_form('This game has ended.')
-        elif game:
-            return game.to_form('Time to make a move!')
         else:
-            raise endpoints.NotFoundException('Game not found!')
+            return game.to_form('Time to make a move!')
 
     @endpoints.method(request_message=USER_NAME,
                       response_message=GameKeysForm,
                       path='user/{user_name}/games',
                       name='get_user_games',
                       http_method='GET')
+    @timed
     def get_user_games(self, request):
         """Returns websafe keys of all unfinished games by the user"""
-        user = request.user_name
-        user = User.query(User.name == user).get()
-        games = Game.query(Game.user == user.key).fetch()
-        game_keys = []
-        for game in games:
-            if game.game_over is False and game.cancelled is False:
-                game_keys.append(game.key.urlsafe())
-        return GameKeysForm(keys=[key for key in game_keys])
+        user = User.query(User.name == request.user_name).get()
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        return GameKeysForm(keys=Game.get_active_game_keys(user.key))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='user/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @timed
     def cancel_game(self, request):
         """Cancel a non-completed game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        # user is needed for updating user rank
-        user = game.key.parent().get().key
-
-        if game.game_over is not True and game.cancelled is not True:
-            game.cancelled = True
-            # note in the game history that the game has been cancelled
-            game.game_history.append("('guess': 'None', \
-                'result': 'Game Cancelled', \
-                'remaining': %d)" % game.attempts_remaining)
-            game.put()
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+
+        def cancel():
+            # the game is read and changed in one transaction so a move made
+            # at the same time cannot be lost
+            game = self._get_game(game_key)
+            if game.game_over is True:
+                raise endpoints.BadRequestException(
+                    "You cannot cancel a game that is over."
+                )
+            if game.cancelled is True:
+                raise endpoints.BadRequestException(
+                    "This game is already cancelled!"
+                )
+            before = game.counter_values()
+            # cancelling also updates the user's rank
+            game.cancel()
+            game.update_counters(before)
 
-            # update user's rank - might be affected if % of cancelled games
-            # goes over 10%
-            difficulty = game.convert_int_to_difficulty(game.attempts_allowed)
-            UserRank.set_user_rank(user, difficulty)
-            return StringMessage(message="Game cancelled.")
-        elif game.game_over is True:
-            raise endpoints.BadRequestException(
-                "You cannot cancel a game that is over."
-            )
-            return StringMessage(
-                message="You cannot cancel a game that is over."
-            )
-        elif game.cancelled is True:
-            raise endpoints.BadRequestException(
-                "This game is already cancelled!"
-            )
-            return StringMessage(message="This game is already cancelled!")
-        else:
-            return StringMessage(message="Something odd happened!")
+        self._change_game(cancel)
+        return StringMessage(message="Game cancelled.")
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @timed
     def make_move(self, request):
         """Guess a letter or attempt to solve! Returns a game state with
-        message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        user = User.query(User.key == game.user).get()
-        user_urlsafe = user.key.urlsafe()
+        message. A request sent again with the same request_id is answered
+        with the response to the first one instead of being applied twice."""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+
+        # a game that is over never changes again, so a move on it is
+        # answered from the cache without a transaction
+        game = self._get_cached_game(game_key)
+        if game.game_over or game.cancelled:
+            response = MoveReceipt.get_response(
+                game_key, request.request_id, GameForm
+            )
+            if response:
+                return response
+            if game.game_over:
+                return game.to_form('Game already over!')
+            return game.to_form('This game has been cancelled!')
+
+        def move():
+            # the game is read and changed in one transaction so two moves
+            # made at the same time cannot overwrite each other
+            response = MoveReceipt.get_response(
+                game_key, request.request_id, GameForm
+            )
+            if response:
+                return response
+            game = self._get_game(game_key)
+
+            if game.game_over:
+                return game.to_form('Game already over!')
+            if game.cancelled:
+                return game.to_form('This game has been cancelled!')
+
+            before = game.counter_values()
+            msg = self._apply_guess(game, request.guess)
+            self._save_move(game)
+            game.update_counters(before)
+            response = game.to_form(msg)
+            MoveReceipt.save(game_key, request.request_id, response)
+            return response
+
+        return self._change_game(move)
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MoveResultsForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @timed
+    def make_moves(self, request):
+        """Make several guesses in a row. The guesses are applied in order
+        until the game is over, and the game is saved once. Returns the
+        result of each guess that was applied and the final game state.
+        A request sent again with the same request_id is answered with the
+        response to the first one instead of being applied twice."""
+        if not request.guesses:
+            raise endpoints.BadRequestException('No guesses were given!')
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+
+        # a game that is over never changes again, so moves on it are
+        # answered from the cache without a transaction
+        game = self._get_cached_game(game_key)
+        if game.game_over or game.cancelled:
+            response = MoveReceipt.get_response(
+                game_key, request.request_id, MoveResultsForm
+            )
+            if response:
+                return response
+            if game.game_over:
+                return MoveResultsForm(
+                    game=game.to_form('Game already over!')
+                )
+            return MoveResultsForm(
+                game=game.to_form('This game has been cancelled!')
+            )
 
-        # needed for UserRank.set_user_rank
-        difficulty = game.convert_int_to_difficulty(game.attempts_allowed)
+        def moves():
+            response = MoveReceipt.get_response(
+                game_key, request.request_id, MoveResultsForm
+            )
+            if response:
+                return response
+            game = self._get_game(game_key)
 
-        if game.game_over:
-            return game.to_form('Game already over!')
-        if game.cancelled:
-            return game.to_form('This game has been cancelled!')
+            if game.game_over:
+                return MoveResultsForm(
+                    game=game.to_form('Game already over!')
+                )
+            if game.cancelled:
+                return MoveResultsForm(
+                    game=game.to_form('This game has been cancelled!')
+                )
+
+            before = game.counter_values()
+            results = []
+            msg = ''
+            for guess in request.guesses:
+                msg = self._apply_guess(game, guess)
+                results.append(MoveResultForm(
+                    guess=guess,
+                    message=msg,
+                    attempts_remaining=game.attempts_remaining
+                ))
+                # guesses after the game is over are not applied
+                if game.game_over:
+                    break
+
+            if results:
+                self._save_move(game)
+                game.update_counters(before)
+            response = MoveResultsForm(
+                results=results, game=game.to_form(msg)
+            )
+            MoveReceipt.save(game_key, request.request_id, response)
+            return response
+
+        return self._change_game(moves)
+
+    @staticmethod
+    def _change_game(func):
+        """Run func, which reads and changes a game, in a transaction and
+        return its result. Raises a ConflictException if the game kept being
+        changed by other requests."""
+        try:
+            return run_in_transaction(func)
+        except TransactionConflictError:
+            raise endpoints.ConflictException(
+                'The game is being changed by another request, please try '
+                'again.'
+            )
 
+    @staticmethod
+    def _get_game(game_key):
+        """Return the game that game_key points to, from the datastore or
+        the archive. Raises a NotFoundException if there is no such game."""
+        game = game_key.get() or GameArchive.get_game(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        return game
+
+    @staticmethod
+    def _get_cached_game(game_key):
+        """Return the game that game_key points to from the game cache, or
+        from the archive if it has been archived. Raises a NotFoundException
+        if there is no such game."""
+        game = game_cache.get(game_key) or GameArchive.get_game(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        return game
+
+    @staticmethod
+    def _apply_guess(game, guess):
+        """Apply one guess to the game without saving it, and log it in the
+        game history. Sets game.game_over and game.won if the guess ended the
+        game. Returns the message for the guess."""
         # make the guess lowercase, to be safe.
-        guess = request.guess.lower()
-        target_word = game.target_word
-        target_lower = target_word.lower()
-        # set game.target_revealed to be a string
-        if game.target_revealed is None:
-            target_revealed = ''
-        else:
-            target_revealed = game.target_revealed
-
-        def reveal_word(guess=''):
-            """Convert 'target_word' into a string with correctly guessed
-            letters and underscores for unguessed letters"""
-            show_target_list = []
-            i = 0  # keep track of what letter we are on / to replace
-            # build the revealed word using correctly guessed letters and
-            # underscores for not guessed letters
-            for letter in target_lower:
-                # if this letter in the target word is the same as the letter
-                # that was just guessed
-                if letter == guess:
-                    # append currently correctly guessed letter
-                    # to show_target_list
-                    show_target_list.append(guess)
-                    i += 1
-                elif letter in target_revealed:
-                    # append previously correctly guessed letter(s)
-                    # to show_target_list
-                    show_target_list.append(letter)
-                    i += 1
-                else:
-                    # for letters not yet guessed, append an underscore ' _ '
-                    show_target_list.append(" _ ")
-                    i += 1
-            # convert show_target_list (list with correct letters and
-            # underscores) into a string
-            show_target_string = ''.join(x for x in show_target_list)
-            # set the revealed word in datastore
-            game.correct_guesses = show_target_string
-            return show_target_string
+        guess = guess.lower()
+        target_lower = game.target_word.lower()
+        # games created before letter bitmasks were stored need them set
+        game.load_masks()
+        guess_bit = guesses.letter_bit(guess)
 
         # begin evaluating guesses
 
         # an attempt to solve was correct. game over!
         if guess == target_lower:
-            # calculate the letters that were 'guessed' in order to solve
-            # the word
-            letters_guessed_for_solve = []
-            for letter in target_lower:
-                # add letters from the target word that were not already
-                # guessed and are not already in the letters_guessed list
-                # to the list
-                if letter not in game.correct_letters and \
-                        letter not in letters_guessed_for_solve:
-                    letters_guessed_for_solve.append(letter)
-
-            # add the guessed letters to game.correct_letters
-            # for scoring purposes
-            add_letters = ''.join(x for x in letters_guessed_for_solve)
-            game.correct_letters += add_letters
-
-            # add the solve to game.history
-            history = (
-                "(\
-                'guess': %s, \
-                'result': 'You solved the puzzle! The correct word \
-                    is: %s', \
-                'remaining': %d \
-                )"
-            ) % (guess, target_word, game.attempts_remaining)
-            game.game_history.append(history)
-            game.put()
-
-            # set game.game_over = True and game.won = True
-            game.end_game(
-                request.urlsafe_game_key, user_urlsafe, True, difficulty
+            # add the letters from the target word that were not already
+            # guessed to game.correct_letters for scoring purposes
+            game.correct_letters += guesses.letters_in_mask(
+                target_lower, game.word_mask & ~game.correct_mask
             )
-
-            target_revealed = target_word
-            return game.to_form(
-                'You solved the puzzle! The correct word is: ' + target_word
+            game.correct_mask |= game.word_mask
+            game.guessed_mask |= game.word_mask
+            game.target_revealed = guesses.render(
+                target_lower, game.correct_mask
             )
+            # set game.game_over = True and game.won = True
+            game.finish(True)
+            result = history.SOLVED
         # an attempt to solve was incorrect. game over!
         elif len(guess) > 4 and guess != target_lower:
-            # add the failed solve to game.history
-            history = textwrap.dedent(
-                "(\
-                'guess': %s, \
-                'result': 'Your attempt to solve was unsuccessful! Game over! \
-                 The correct word is: %s', \
-                'remaining': %d \
-                )"
-            ) % (guess, target_word, game.attempts_remaining)
-            game.game_history.append(history)
-
             # log the incorrect guess
             game.incorrect_letters = guess
-
             # set game.game_over = True and game.won = False
-            game.end_game(
-                request.urlsafe_game_key, user_urlsafe, False, difficulty
-            )
-            msg = "Your attempt to solve was unsuccessful! Game over!"
-            return game.to_form(msg)
+            game.finish(False)
+            result = history.SOLVE_FAILED
 
         # handle miscellaneous errors/mistakes
         elif len(guess) == 0:
-            msg = "You didn't guess a letter!"
+            result = history.NO_GUESS
         # since all words 0 to 4 characters long were removed from the word
         # list, guesses of 1 to 4 characters long can be assumed to be
         # errant guesses, not attempts to solve.
         elif len(guess) > 1 and len(guess) < 5:
-            msg = 'You cannot guess more than one letter at a time!'
-        elif guess in game.incorrect_letters:
-            msg = "You already incorrectly guessed this letter!"
-        elif guess in target_revealed:
-            msg = "You already correctly guessed this letter!"
+            result = history.TOO_MANY_LETTERS
+        # only letters (and the apostrophe) can be in a word
+        elif not guess_bit:
+            result = history.NOT_A_LETTER
+        elif guess_bit & game.guessed_mask & ~game.correct_mask:
+            result = history.ALREADY_INCORRECT
+        elif guess_bit & game.correct_mask:
+            result = history.ALREADY_CORRECT
 
         # a letter was guessed correctly!
-        elif guess in game.target_word:
+        elif guess_bit & game.word_mask:
             # save and log the correct guess so the target word can be revealed
             game.correct_letters += guess
-            game.target_revealed = reveal_word(guess)
+            game.correct_mask |= guess_bit
+            game.guessed_mask |= guess_bit
+            game.target_revealed = guesses.render(
+                target_lower, game.correct_mask
+            )
             # check if this letter solved the word
-            if game.target_revealed == target_word:
+            if guesses.is_solved(game.word_mask, game.correct_mask):
                 # game won!
                 # set game.game_over = True and game.won = True
-                game.end_game(
-                    request.urlsafe_game_key, user_urlsafe, True, difficulty
-                )
-                msg = 'Correct! You solved the puzzle!'
-                return game.to_form('You win!')
+                game.finish(True)
+                result = history.WON
             # the guess was correct but did not solve the word
             else:
-                msg = 'Correct! Guess another letter.'
+                result = history.CORRECT
 
         # a letter was guessed incorrectly
         else:
-            msg = 'Incorrect! That letter is not in the word.'
             game.incorrect_letters += guess
+            game.guessed_mask |= guess_bit
             game.attempts_remaining -= 1
+            result = history.INCORRECT
+            # the user has run out of attempts
+            if game.attempts_remaining < 1:
+                # set game.game_over = True and game.won = False
+                game.finish(False)
+                result |= history.GAME_OVER
 
         # end evaluating guesses
 
-        """the code below runs in the following cases:
-        misc errors guessed, incorrect guess
-        it does NOT run for:
-        solve correct, solve incorrect, game won by all correct letters guessed
-        """
-
-        if game.attempts_remaining < 1:
-            # add "Game over" to msg for game history clarity
-            msg += " Game over!"
-
-        # save msg and guess to game.game_history for get_game_history
-        # set the message for game history
-        history = ("('guess': %s, 'result': '%s', 'remaining': %d)") % (
-            guess, msg, game.attempts_remaining
-        )
-        if game.game_history is None:
-            game.game_history = history
-        else:
-            game.game_history.append(history)
+        # save the result of the guess to the game history for
+        # get_game_history
+        game.log_move(guess, result)
+        return history.message(result, game.target_word)
 
-        # the user has run out of attempts
-        if game.attempts_remaining < 1:
-            # set game.game_over = True and game.won = False
-            game.end_game(
-                request.urlsafe_game_key, user_urlsafe, False, difficulty
-            )
-            return game.to_form(msg)
-        # still attempts remaining. keep playing!
+    @staticmethod
+    def _save_move(game):
+        """Save a game after one or more guesses. If the game is over, its
+        score is saved as well, and the user's rank is updated by a task.
+        Runs in the move's transaction."""
+        if game.game_over:
+            game.end_game()
         else:
             game.put()
-            return game.to_form(msg)
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=GameHistoryForm,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @timed
     def get_game_history(self, request):
-        """Return a move-by-move history of a game."""
-        game = ndb.Key(urlsafe=request.urlsafe_game_key).get()
-        # convert game.game_history from list to string
-        history = ', '.join(x for x in game.game_history)
+        """Return a move-by-move history of a game. offset and limit return
+        only part of the history."""
+        # None is less than every number in Python 2
+        if (request.offset or 0) < 0 or (request.limit or 0) < 0:
+            raise endpoints.BadRequestException(
+                'offset and limit cannot be negative.'
+            )
+        game = self._get_cached_game(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        )
+        # the moves are decoded one at a time, only up to the last one asked
+        # for
+        offset = request.offset or 0
+        stop = None if request.limit is None else offset + request.limit
+        moves = itertools.islice(game.iter_moves(), offset, stop)
         gh = GameHistoryForm()
-        gh.history = history
+        gh.history = ', '.join(
+            history.format_move(guess, code, remaining, game.target_word)
+            for guess, code, remaining in moves
+        )
         gh.check_initialized()
         return gh
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=HINT_REQUEST,
+                      response_message=HintForm,
+                      path='hint',
+                      name='get_hint',
+                      http_method='GET')
+    @timed
+    def get_hint(self, request):
+        """Return the letter most likely to be in a word, given the revealed
+        word (a game's target_revealed, with _ for each hidden letter) and
+        the letters guessed incorrectly, and the number of words in the
+        dictionary that could still be the word."""
+        # hints loads numpy, which no other endpoint needs
+        import hints
+        pattern = hints.normalize_pattern(request.pattern)
+        if not pattern:
+            raise endpoints.BadRequestException('The pattern is empty!')
+        try:
+            letter, share, count = hints.best_letter(
+                request.dictionary, pattern, request.incorrect_letters or ''
+            )
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        if count == 0:
+            raise endpoints.NotFoundException(
+                'No word in the dictionary matches the pattern!'
+            )
+        return HintForm(letter=letter, probability=share, candidates=count)
+
+    @endpoints.method(request_message=SCORES_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @timed
     def get_scores(self, request):
-        """Return all scores"""
-        scores = Score.query()
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Return one page of all scores. Pass the returned next_cursor as
+        cursor to get the next page."""
+        scores, next_cursor = fetch_page(
+            Score.query(), request.page_size, request.cursor
+        )
+        return self._score_forms(scores, next_cursor)
 
-    @endpoints.method(request_message=USER_NAME,
+    @endpoints.method(request_message=USER_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='user/scores/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @timed
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
+        """Returns one page of an individual User's scores. Pass the returned
+        next_cursor as cursor to get the next page."""
         user = User.query(User.name == request.user_name).get()
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores, next_cursor = fetch_page(
+            Score.query(Score.user == user.key),
+            request.page_size,
+            request.cursor
+        )
+        return self._score_forms(scores, next_cursor)
 
     @endpoints.method(request_message=HIGH_SCORE_REQUEST,
                       response_message=ScoreForms,
                       path='highscores',
                       name='get_high_scores',
                       http_method='GET')
+    @timed
     def get_high_scores(self, request):
-        """Return high scores for all difficulty levels, sorted high score to
-        low"""
-        high_scores = Score.query().order(-Score.score)\
-            .fetch(request.number_of_results)
-        return ScoreForms(items=[score.to_form() for score in high_scores])
-
-    @endpoints.method(response_message=UserRankForms,
+        """Return high scores for one or all difficulty levels, sorted high
+        score to low. Up to LEADERBOARD_SIZE scores are read from the cached
+        leaderboards."""
+        difficulty = request.difficulty or ALL_DIFFICULTIES
+        if difficulty not in (ALL_DIFFICULTIES, 'easy', 'medium', 'hard'):
+            raise endpoints.BadRequestException(
+                "Difficulty must be 'easy', 'medium' or 'hard'."
+            )
+        number_of_results = request.number_of_results
+        if number_of_results is None:
+            number_of_results = LEADERBOARD_SIZE
+        elif number_of_results < 1:
+            raise endpoints.BadRequestException(
+                'number_of_results must be at least 1.'
+            )
+        if number_of_results <= LEADERBOARD_SIZE:
+            entries = Leaderboard.get_entries(difficulty)
+            return ScoreForms(items=[
+                entry.to_form() for entry in entries[:number_of_results]
+            ])
+
+        # more scores than the leaderboards keep were asked for
+        query = Score.query()
+        if difficulty != ALL_DIFFICULTIES:
+            query = query.filter(Score.difficulty == difficulty)
+        high_scores = query.order(-Score.score).fetch(number_of_results)
+        return self._score_forms(high_scores)
+
+    @endpoints.method(request_message=RANKINGS_REQUEST,
+                      response_message=UserRankForms,
                       path='rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @timed
     def get_user_rankings(self, request):
-        """Return user rankings (won/loss %), grouped by difficulty."""
-        user_rank = \
-            UserRank.query()\
-            .order(UserRank.difficulty, -UserRank.performance)
-        return UserRankForms(rankings=[rank.to_form() for rank in user_rank])
+        """Return user rankings (won/loss %), grouped by difficulty. If
+        difficulty, page_size or cursor is given, return one page of the
+        rankings instead, for one or all difficulty levels."""
+        query = UserRank.query()
+        if request.difficulty:
+            query = query.filter(UserRank.difficulty == request.difficulty)
+        query = query.order(UserRank.difficulty, -UserRank.performance)
+
+        next_cursor = None
+        if request.difficulty or request.page_size or request.cursor:
+            user_rank, next_cursor = fetch_page(
+                query, request.page_size, request.cursor
+            )
+        else:
+            user_rank = query.fetch()
+        # get every user in one batch instead of one get per rank
+        user_names = get_user_names(user_rank)
+        return UserRankForms(
+            rankings=[
+                rank.to_form(user_names.get(rank.user)) for rank in user_rank
+            ],
+            next_cursor=next_cursor
+        )
+
+    @endpoints.method(request_message=USER_NAME,
+                      response_message=UserPositionForms,
+                      path='rankings/{user_name}',
+                      name='get_user_position',
+                      http_method='GET')
+    @timed
+    def get_user_position(self, request):
+        """Return a user's place in the rankings, and the percentage of
+        ranked users they are level with or ahead of, for each difficulty
+        level they have played."""
+        user = User.query(User.name == request.user_name).get()
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        difficulties = ['easy', 'medium', 'hard']
+        ranks = ndb.get_multi([
+            UserRank.get_key(user.key, difficulty)
+            for difficulty in difficulties
+        ])
+        positions = []
+        for rank in ranks:
+            if rank is None:
+                continue
+            place, players, percentile = RankHistogram.get_position(
+                rank.difficulty, rank.performance
+            )
+            positions.append(UserPositionForm(
+                difficulty=rank.difficulty,
+                performance=rank.performance,
+                rank=place,
+                players=players,
+                percentile=percentile
+            ))
+        return UserPositionForms(user=user.name, positions=positions)
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @timed
     def get_average_attempts(self, request):
         """Get the cached average moves remaining"""
-        return StringMessage(
-            message=memcache.get(MEMCACHE_MOVES_REMAINING) or ''
+        message = memcache.get(MEMCACHE_MOVES_REMAINING)
+        if message is None:
+            message = self._cache_average_attempts()
+        return StringMessage(message=message)
+
+    @staticmethod
+    def _score_forms(scores, next_cursor=None):
+        """Returns ScoreForms for a list of scores, getting every user in one
+        batch instead of one get per score."""
+        user_names = get_user_names(scores)
+        return ScoreForms(
+            items=[
+                score.to_form(user_names.get(score.user)) for score in scores
+            ],
+            next_cursor=next_cursor
         )
 
     @staticmethod
     def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = \
-                sum([game.attempts_remaining for game in games])
+        """Populates memcache with the average moves remaining of active
+        Games, read from the active games counters. Returns the message."""
+        count = counters.get_count(counters.ACTIVE_GAMES)
+        total_attempts_remaining = \
+            counters.get_count(counters.ATTEMPTS_REMAINING)
+        if count > 0:
             average = float(total_attempts_remaining) / count
-            memcache.set(
-                MEMCACHE_MOVES_REMAINING,
-                'The average moves remaining is {:.2f}'.format(average)
-            )
+            message = 'The average moves remaining is {:.2f}'.format(average)
+        else:
+            message = ''
+        memcache.set(MEMCACHE_MOVES_REMAINING, message)
+        return message
+
+    @staticmethod
+    def _reconcile_average_attempts():
+        """Counts the active Games and their attempts remaining, and corrects
+        the active games counters if they have drifted."""
+        count = 0
+        total_attempts_remaining = 0
+        # only attempts_remaining is read from each game
+        games = Game.query(
+            Game.game_over == False, Game.cancelled == False
+        ).iter(projection=[Game.attempts_remaining], batch_size=500)
+        for game in games:
+            count += 1
+            total_attempts_remaining += game.attempts_remaining
+
+        for name, total in [
+                (counters.ACTIVE_GAMES, count),
+                (counters.ATTEMPTS_REMAINING, total_attempts_remaining)]:
+            if counters.get_count(name) != total:
+                logging.warning(
+                    'Counter %s was %d, corrected to %d',
+                    name, counters.get_count(name), total
+                )
+                counters.set_count(name, total)
+        HangmanApi._cache_average_attempts()
 
 
-api = endpoints.api_server([HangmanApi])
+api = startup.StartupMiddleware(endpoints.api_server([HangmanApi]))
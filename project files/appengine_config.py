@@ -0,0 +1,10 @@
+"""appengine_config.py - Loaded by App Engine on a new instance, before the
+application modules."""
+
+import startup
+
+# time the imports of the application modules, see startup.py
+startup.install()
+
+# share of endpoint and handler calls recorded by stats.py
+hangman_stats_SAMPLE_RATE = 0.1
@@ -0,0 +1,98 @@
+"""counters.py - Sharded counters for totals that many requests change.
+
+Each counter is split into NUM_SHARDS entities, and every change is made to
+a random shard, so changes made at the same time rarely contend. The total
+is the sum of the shards, which is cached in memcache and kept up to date as
+the counter changes."""
+
+import logging
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+NUM_SHARDS = 20
+MEMCACHE_COUNTER = 'COUNTER_%s'
+
+# counters of the games that are neither over nor cancelled, and of their
+# total attempts remaining
+ACTIVE_GAMES = 'active_games'
+ATTEMPTS_REMAINING = 'attempts_remaining'
+
+
+class CounterShard(ndb.Model):
+    """One shard of a counter. The id is the counter name and shard
+    number."""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _shard_keys(name):
+    """Returns the keys of every shard of a counter."""
+    return [
+        ndb.Key(CounterShard, '%s-%d' % (name, shard))
+        for shard in range(NUM_SHARDS)
+    ]
+
+
+def get_count(name):
+    """Returns the total of a counter."""
+    total = memcache.get(MEMCACHE_COUNTER % name)
+    if total is None:
+        total = sum(
+            shard.count for shard in ndb.get_multi(_shard_keys(name))
+            if shard is not None
+        )
+        memcache.add(MEMCACHE_COUNTER % name, total)
+    return total
+
+
+def increment(deltas):
+    """Adds to several counters at once.
+    Args:
+        deltas: A dictionary of counter name to the amount to add, which can
+            be negative.
+    A failure is logged and does not fail the request that made the change;
+    the counters are corrected by set_count."""
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if not deltas:
+        return
+    keys = dict(
+        (name, random.choice(_shard_keys(name))) for name in deltas
+    )
+
+    def update():
+        shards = ndb.get_multi(keys.values())
+        for shard, (name, key) in zip(shards, keys.items()):
+            shard = shard or CounterShard(key=key)
+            shard.count += deltas[name]
+            shard.put()
+
+    try:
+        # usually called on commit of a game's transaction, while ndb still
+        # has that transaction's context
+        ndb.transaction(
+            update, retries=3, xg=len(keys) > 1,
+            propagation=ndb.TransactionOptions.INDEPENDENT
+        )
+    except Exception:
+        logging.exception('Could not update counters %s', deltas)
+        memcache.delete_multi(
+            [MEMCACHE_COUNTER % name for name in deltas]
+        )
+        return
+
+    for name, delta in deltas.items():
+        # only changes a total that is already cached
+        if delta > 0:
+            memcache.incr(MEMCACHE_COUNTER % name, delta)
+        else:
+            memcache.decr(MEMCACHE_COUNTER % name, -delta)
+
+
+def set_count(name, total):
+    """Sets the total of a counter, to correct it after it has drifted.
+    Changes made to the counter while it is being set can be lost."""
+    shards = [CounterShard(key=key, count=0) for key in _shard_keys(name)]
+    shards[0].count = total
+    ndb.put_multi(shards)
+    memcache.set(MEMCACHE_COUNTER % name, total)
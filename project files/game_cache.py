@@ -0,0 +1,281 @@
+"""game_cache.py - Write-through cache of Game entities.
+
+Games are read from a small least-recently-used cache on the instance, then
+from memcache, then from the datastore. Every saved game is written to both
+caches. Each game carries a version number that goes up every time it is
+saved, and the latest version of each game is kept in memcache under its own
+small key, so an instance only serves a game from its own cache if no newer
+version has been saved by another instance.
+
+Two instances can write the same game to memcache at once, for example one
+filling it after a miss while another saves a move, so memcache is never
+simply overwritten: a game read from the datastore is only added if memcache
+has no copy, and a saved game replaces the copy in memcache with
+compare-and-set only if its version is higher.
+
+Reads inside a transaction must go to the datastore, so that the transaction
+fails if the game is changed by someone else before it commits; only reads
+outside a transaction use the cache.
+
+    python game_cache.py            replay a game with and without the cache
+"""
+
+import contextlib
+import logging
+import threading
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+from lru import LRUCache
+
+
+# number of games kept on each instance
+LOCAL_CACHE_SIZE = 1000
+MEMCACHE_GAME = 'GAME_%s'
+MEMCACHE_GAME_VERSION = 'GAME_VERSION_%s'
+# times a write is retried when another instance changes the same key
+CAS_ATTEMPTS = 3
+
+# encoded games and their versions, keyed by urlsafe key
+_local = LRUCache(LOCAL_CACHE_SIZE)
+
+# games stored inside batch() on each thread, written to memcache together
+# when it ends
+_batch = threading.local()
+
+# hit and miss counts for this instance
+_stats = {
+    'local_hits': 0,
+    'memcache_hits': 0,
+    'misses': 0,
+    'stale': 0,
+    'writes': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_stats():
+    """Returns a copy of this instance's hit and miss counts."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _encode(game):
+    return game._to_pb().Encode()
+
+
+def _decode(encoded):
+    return ndb.ModelAdapter().pb_to_entity(entity_pb.EntityProto(encoded))
+
+
+def get(key):
+    """Returns the Game that key points to, or None if there is no such
+    game. A new copy is returned each time, so it can be changed."""
+    if ndb.in_transaction():
+        return key.get()
+    urlsafe = key.urlsafe()
+    local = _local.get(urlsafe)
+    if local is not None:
+        version = memcache.get(MEMCACHE_GAME_VERSION % urlsafe)
+        if version == local[0]:
+            _count('local_hits')
+            return _decode(local[1])
+        _count('stale')
+
+    cached = memcache.get(MEMCACHE_GAME % urlsafe)
+    if cached is not None:
+        _count('memcache_hits')
+        _local.set(urlsafe, cached)
+        return _decode(cached[1])
+
+    _count('misses')
+    game = key.get()
+    if game is not None:
+        _fill(game)
+    return game
+
+
+def _fill(game):
+    """Caches a game read from the datastore. By the time it is cached the
+    game may have been saved again, so it is only added to memcache if
+    memcache has no copy."""
+    urlsafe = game.key.urlsafe()
+    cached = (game.version, _encode(game))
+    _local.set(urlsafe, cached)
+    failed = memcache.add_multi({
+        MEMCACHE_GAME % urlsafe: cached,
+        MEMCACHE_GAME_VERSION % urlsafe: game.version,
+    })
+    if len(failed) == 1:
+        # the other key was written by a save in between, so the two keys
+        # may not agree
+        memcache.delete_multi([
+            MEMCACHE_GAME % urlsafe, MEMCACHE_GAME_VERSION % urlsafe
+        ])
+
+
+def _version(value):
+    """Returns the version of a value cached under either key."""
+    return value[0] if isinstance(value, tuple) else value
+
+
+def _write_newer(mapping, versions):
+    """Writes each value of mapping to memcache unless memcache already holds
+    the same or a newer version of it, as given by versions. Keys that are
+    not in memcache are added and the others replaced with compare-and-set,
+    retrying keys that another instance changed in between. Returns the keys
+    that could not be written."""
+    client = memcache.Client()
+    pending = dict(mapping)
+    for attempt in range(CAS_ATTEMPTS):
+        current = client.get_multi(pending.keys(), for_cas=True)
+        added, replaced = {}, {}
+        for key, value in pending.items():
+            if key not in current:
+                added[key] = value
+            elif _version(current[key]) < versions[key]:
+                replaced[key] = value
+        failed = []
+        if added:
+            failed.extend(client.add_multi(added))
+        if replaced:
+            failed.extend(client.cas_multi(replaced))
+        pending = dict((key, pending[key]) for key in failed)
+        if not pending:
+            break
+    return pending.keys()
+
+
+def store(game):
+    """Writes a saved game to memcache and to this instance's cache. Inside
+    batch(), the game is written when the batch ends."""
+    games = getattr(_batch, 'games', None)
+    if games is not None:
+        games.append(game)
+    else:
+        store_multi([game])
+
+
+@contextlib.contextmanager
+def batch():
+    """Collects the games stored on this thread in the with block, such as
+    the games of one ndb.put_multi, and writes them to memcache in one batch
+    when the block ends."""
+    if getattr(_batch, 'games', None) is not None:
+        # already in a batch
+        yield
+        return
+    _batch.games = []
+    try:
+        yield
+    finally:
+        # games saved before an error are still written
+        games, _batch.games = _batch.games, None
+        if games:
+            store_multi(games)
+
+
+def store_multi(games):
+    """Writes saved games to memcache, in one batch, and to this instance's
+    cache."""
+    mapping, versions, urlsafes = {}, {}, {}
+    for game in games:
+        urlsafe = game.key.urlsafe()
+        urlsafes[MEMCACHE_GAME % urlsafe] = urlsafe
+        urlsafes[MEMCACHE_GAME_VERSION % urlsafe] = urlsafe
+        cached = (game.version, _encode(game))
+        _local.set(urlsafe, cached)
+        mapping[MEMCACHE_GAME % urlsafe] = cached
+        mapping[MEMCACHE_GAME_VERSION % urlsafe] = game.version
+        versions[MEMCACHE_GAME % urlsafe] = game.version
+        versions[MEMCACHE_GAME_VERSION % urlsafe] = game.version
+    failed = _write_newer(mapping, versions)
+    if failed:
+        # a game is removed from memcache if either of its keys could not
+        # be written: a newer game without its version would be hidden by
+        # older copies on other instances, and a newer version without its
+        # game would make instances read an older game from memcache
+        failed = set(urlsafes[key] for key in failed)
+        logging.warning(
+            'Could not cache %d of %d games', len(failed), len(games)
+        )
+        memcache.delete_multi(
+            [MEMCACHE_GAME % urlsafe for urlsafe in failed] +
+            [MEMCACHE_GAME_VERSION % urlsafe for urlsafe in failed]
+        )
+    with _stats_lock:
+        _stats['writes'] += len(games)
+
+
+def forget_multi(keys):
+    """Removes games that no longer exist from memcache and this instance's
+    cache."""
+    urlsafes = [key.urlsafe() for key in keys]
+    for urlsafe in urlsafes:
+        _local.delete(urlsafe)
+    memcache.delete_multi(
+        [MEMCACHE_GAME % urlsafe for urlsafe in urlsafes] +
+        [MEMCACHE_GAME_VERSION % urlsafe for urlsafe in urlsafes]
+    )
+
+
+def clear():
+    """Empties this instance's cache."""
+    _local.clear()
+
+
+def benchmark(moves=20, number=20):
+    """Print the cost of replaying the moves of a game, reading the game
+    before each move from the datastore and from the cache. Uses local stubs
+    of the datastore and memcache."""
+    import timeit
+    from google.appengine.ext import testbed
+    from models import User, Game
+    import guesses
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    try:
+        user = User(name='benchmark')
+        user.put()
+        game = Game.new_game(user.key, 12, 8, 12, user_name=user.name)
+
+        def move(letter):
+            # make_move reads and saves the game in a transaction
+            current = game.key.get()
+            current.guessed_mask |= guesses.letter_bit(letter)
+            current.put()
+
+        def replay(read):
+            # a client shows the game with get_game before each move
+            for letter in guesses.ALPHABET[:moves]:
+                read(game.key)
+                ndb.transaction(lambda: move(letter))
+                ndb.get_context().clear_cache()
+
+        for name, read in [('datastore get', lambda key: key.get()),
+                           ('game cache', get)]:
+            clear()
+            memcache.flush_all()
+            seconds = min(timeit.repeat(
+                lambda: replay(read), number=number, repeat=3
+            ))
+            print '%-20s %8.3f ms per move' % (
+                name, seconds * 1e3 / (number * moves)
+            )
+        print get_stats()
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,147 @@
+"""guesses.py - Bitmask evaluation of hangman guesses.
+
+Each letter that can appear in a word has one bit. A game keeps a mask of
+the letters in its word, a mask of every letter guessed and a mask of the
+letters guessed correctly, so checking a guess is a couple of bit operations
+and the game is won when the correct mask covers the word mask. The revealed
+word is rendered from a table of letter positions that is built once per
+word, and renders are cached.
+
+    python guesses.py               compare with the old reveal_word loop
+"""
+
+from lru import LRUCache
+
+
+# every character that can be guessed, one bit each. some words in the
+# full dictionary (wordsEn.txt) contain an apostrophe, which has to be
+# guessed too.
+ALPHABET = "abcdefghijklmnopqrstuvwxyz'"
+LETTER_BITS = dict(
+    (letter, 1 << number) for number, letter in enumerate(ALPHABET)
+)
+
+# shown in the revealed word for a letter that has not been guessed
+HIDDEN_LETTER = ' _ '
+
+# letter positions tables, shared by all games on an instance
+_positions_cache = LRUCache(2048)
+
+# rendered words keyed by (word, correct_mask). a plain dict is used because
+# it is read on every guess; it is emptied when it grows past its limit.
+_render_cache = {}
+RENDER_CACHE_SIZE = 8192
+
+
+def letter_bit(letter):
+    """Return the bit for a letter, or 0 if it cannot be guessed."""
+    return LETTER_BITS.get(letter, 0)
+
+
+def letters_mask(letters):
+    """Return the mask of every letter in a string."""
+    mask = 0
+    for letter in letters:
+        mask |= LETTER_BITS.get(letter, 0)
+    return mask
+
+
+def letters_in_mask(word, mask):
+    """Return the distinct letters of word whose bits are in mask, in the
+    order they first appear in the word."""
+    letters = []
+    for letter in word:
+        bit = LETTER_BITS.get(letter, 0)
+        if mask & bit:
+            letters.append(letter)
+            mask &= ~bit
+    return ''.join(letters)
+
+
+def letter_positions(word):
+    """Return a tuple of (bit, positions) pairs, one for each distinct letter
+    of word, built once per word."""
+    positions = _positions_cache.get(word)
+    if positions is None:
+        table = {}
+        for position, letter in enumerate(word):
+            table.setdefault(LETTER_BITS.get(letter, 0), []).append(position)
+        positions = tuple(
+            (bit, tuple(letter_positions)) for bit, letter_positions
+            in table.items()
+        )
+        _positions_cache.set(word, positions)
+    return positions
+
+
+def render(word, correct_mask):
+    """Return word with the letters in correct_mask shown and every other
+    letter replaced by HIDDEN_LETTER."""
+    key = (word, correct_mask)
+    revealed = _render_cache.get(key)
+    if revealed is None:
+        shown = [HIDDEN_LETTER] * len(word)
+        for bit, positions in letter_positions(word):
+            if bit & correct_mask:
+                for position in positions:
+                    shown[position] = word[position]
+        revealed = ''.join(shown)
+        if len(_render_cache) >= RENDER_CACHE_SIZE:
+            _render_cache.clear()
+        _render_cache[key] = revealed
+    return revealed
+
+
+def is_solved(word_mask, correct_mask):
+    """Return True if every letter of the word has been guessed."""
+    return word_mask & ~correct_mask == 0
+
+
+def _reveal_word_loop(target_lower, target_revealed, guess):
+    """Reveal a word the way make_move did before bitmasks: scan every letter
+    of the word and test it against the revealed string."""
+    show_target_list = []
+    for letter in target_lower:
+        if letter == guess:
+            show_target_list.append(guess)
+        elif letter in target_revealed:
+            show_target_list.append(letter)
+        else:
+            show_target_list.append(HIDDEN_LETTER)
+    return ''.join(x for x in show_target_list)
+
+
+def benchmark(number=100000):
+    """Print the cost of evaluating a correct guess with the old string loop
+    and with bitmasks."""
+    import timeit
+    word = 'information'
+    revealed = _reveal_word_loop(word, '', 'o')
+    word_mask = letters_mask(word)
+    correct_mask = letters_mask('o')
+    guessed_mask = letters_mask('oxz')
+
+    def string_guess():
+        if 'n' in 'xz' or 'n' in revealed:
+            return None
+        if 'n' in word:
+            new_revealed = _reveal_word_loop(word, revealed, 'n')
+            return new_revealed == word
+
+    def mask_guess():
+        bit = letter_bit('n')
+        if bit & guessed_mask:
+            return None
+        if bit & word_mask:
+            new_mask = correct_mask | bit
+            render(word, new_mask)
+            return is_solved(word_mask, new_mask)
+
+    for name, func in [('reveal_word loop', string_guess),
+                       ('bitmasks, cached render', mask_guess)]:
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print '%-30s %8.3f us per guess' % (name, seconds * 1e6 / number)
+
+
+if __name__ == '__main__':
+    benchmark()
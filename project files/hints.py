@@ -0,0 +1,152 @@
+"""hints.py - Suggest the next letter to guess from a revealed pattern.
+
+For each dictionary and word length, the letters of the words are turned
+into a table with one row per position: row p holds, for every word of that
+length, the bit (see guesses.py) of its letter at position p. The words that
+match a pattern are found with a few NumPy comparisons over those rows
+instead of a loop over the words. The hint is the letter that is in the
+most of the matching words. Matching words are cached by pattern, as the
+same patterns come up again and again early in games.
+
+    python hints.py                 time some hints on each dictionary
+"""
+
+import numpy
+
+from guesses import ALPHABET, LETTER_BITS, HIDDEN_LETTER, letters_mask
+from lru import LRUCache
+from words import get_word_index
+
+
+# shown in a pattern for each letter that has not been guessed
+HIDDEN = HIDDEN_LETTER.strip()
+
+# bit of each byte value, so upper case letters match too
+_BYTE_BITS = numpy.zeros(256, dtype=numpy.uint32)
+for _letter, _bit in LETTER_BITS.items():
+    _BYTE_BITS[ord(_letter)] = _bit
+    _BYTE_BITS[ord(_letter.upper())] = _bit
+
+# bytes of matching word numbers kept in the pattern cache on each instance
+CANDIDATES_CACHE_BYTES = 4 * 1024 * 1024
+
+# (dictionary, length) -> (position_bits, word_masks)
+_tables = {}
+# (dictionary, pattern, incorrect mask) -> numbers of the matching words
+_candidates_cache = LRUCache(
+    CANDIDATES_CACHE_BYTES, weigh=lambda numbers: numbers.nbytes
+)
+
+
+def normalize_pattern(pattern):
+    """Return a pattern such as target_revealed, 'a _ _ le', without its
+    spaces: 'a__le'."""
+    return ''.join(pattern.split()).lower()
+
+
+def _length_tables(dictionary, length):
+    """Return the letter tables of the words of one length: an array with a
+    row of letter bits for each position, and the mask of every letter of
+    each word. Built on first use."""
+    tables = _tables.get((dictionary, length))
+    if tables is None:
+        index = get_word_index(dictionary)
+        if length > index.max_length:
+            count = 0
+        else:
+            count = index.starts[length + 1] - index.starts[length]
+        letters = numpy.frombuffer(
+            index.data, dtype=numpy.uint8, count=count * length,
+            offset=index.offsets[length] if count else 0
+        ).reshape(count, length)
+        # transposed and copied so each position is one contiguous row
+        position_bits = numpy.ascontiguousarray(_BYTE_BITS[letters].T)
+        word_masks = numpy.bitwise_or.reduce(position_bits, axis=0) \
+            if count else numpy.zeros(0, dtype=numpy.uint32)
+        tables = (position_bits, word_masks)
+        _tables[(dictionary, length)] = tables
+    return tables
+
+
+def candidates(dictionary, pattern, incorrect_letters):
+    """Return the numbers, within their length, of the words of dictionary
+    that could be the word: each shown letter is at its position, and the
+    hidden positions hold neither a shown letter (every copy of a guessed
+    letter is shown) nor an incorrect letter."""
+    shown_mask = letters_mask(pattern.replace(HIDDEN, ''))
+    incorrect_mask = letters_mask(incorrect_letters.lower())
+    key = (dictionary, pattern, incorrect_mask)
+    numbers = _candidates_cache.get(key)
+    if numbers is None:
+        position_bits, word_masks = _length_tables(dictionary, len(pattern))
+        match = numpy.ones(len(word_masks), dtype=bool)
+        excluded = numpy.uint32(shown_mask | incorrect_mask)
+        for position, letter in enumerate(pattern):
+            if letter == HIDDEN:
+                match &= (position_bits[position] & excluded) == 0
+            else:
+                match &= position_bits[position] == LETTER_BITS.get(letter, 0)
+        # no word length has more than 65536 words in the word lists, so
+        # the numbers fit in a quarter of the space of numpy's default
+        # int64
+        dtype = numpy.uint16 if len(match) <= 65536 else numpy.uint32
+        numbers = numpy.flatnonzero(match).astype(dtype)
+        _candidates_cache.set(key, numbers)
+    return numbers
+
+
+def best_letter(dictionary, pattern, incorrect_letters=''):
+    """Return (letter, share, count): the letter not yet guessed that is in
+    the most of the words matching pattern, the share of those words it is
+    in, and the number of words. The letter is None if no word matches.
+    Raises a ValueError if the dictionary does not exist."""
+    pattern = normalize_pattern(pattern)
+    numbers = candidates(dictionary, pattern, incorrect_letters)
+    if not len(numbers):
+        return None, 0.0, 0
+    word_masks = _length_tables(dictionary, len(pattern))[1][numbers]
+    guessed = letters_mask(pattern + incorrect_letters.lower())
+    best, best_count = None, -1
+    for letter in ALPHABET:
+        bit = LETTER_BITS[letter]
+        if bit & guessed:
+            continue
+        count = int(((word_masks & numpy.uint32(bit)) != 0).sum())
+        if count > best_count:
+            best, best_count = letter, count
+    if best_count <= 0:
+        return None, 0.0, len(numbers)
+    return best, float(best_count) / len(numbers), len(numbers)
+
+
+def benchmark(number=200):
+    """Print the cost of a hint for a few patterns, with and without the
+    pattern cache."""
+    import timeit
+    patterns = [
+        ('_ _ _ _ _ _ _ _', ''),
+        ('_ e _ _ _ _ _ _', 'a'),
+        ('_ e _ _ _ i _ _', 'aos'),
+        ('_ _ _ e _ _ _ _ _ _ _', 'trn'),
+    ]
+    for dictionary in ('common', 'full'):
+        for pattern, incorrect in patterns:
+            best_letter(dictionary, pattern, incorrect)
+
+            def uncached():
+                _candidates_cache.clear()
+                best_letter(dictionary, pattern, incorrect)
+
+            for name, func in [
+                    ('cached', lambda: best_letter(
+                        dictionary, pattern, incorrect)),
+                    ('uncached', uncached)]:
+                seconds = min(timeit.repeat(func, number=number, repeat=3))
+                print '%-6s %-24s %-4s %-8s %8.3f ms' % (
+                    dictionary, pattern.replace(' ', ''), incorrect, name,
+                    seconds * 1e3 / number
+                )
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,192 @@
+"""history.py - Packed binary log of the moves made in a game.
+
+Each move is stored as a result code, the attempts remaining after the move
+and the guess, so a move takes a few bytes instead of a formatted string.
+The result messages are rebuilt from the codes when the history is read.
+
+    python history.py               time saving a game with each history
+"""
+
+import re
+import struct
+
+
+# result codes
+CORRECT = 1
+INCORRECT = 2
+NO_GUESS = 3
+TOO_MANY_LETTERS = 4
+NOT_A_LETTER = 5
+ALREADY_INCORRECT = 6
+ALREADY_CORRECT = 7
+WON = 8
+SOLVED = 9
+SOLVE_FAILED = 10
+CANCELLED = 11
+
+# added to a result code when the move used up the last attempt
+GAME_OVER = 0x80
+
+# the message sent to the player for each result
+MESSAGES = {
+    CORRECT: 'Correct! Guess another letter.',
+    INCORRECT: 'Incorrect! That letter is not in the word.',
+    NO_GUESS: "You didn't guess a letter!",
+    TOO_MANY_LETTERS: 'You cannot guess more than one letter at a time!',
+    NOT_A_LETTER: 'That is not a letter!',
+    ALREADY_INCORRECT: 'You already incorrectly guessed this letter!',
+    ALREADY_CORRECT: 'You already correctly guessed this letter!',
+    WON: 'You win!',
+    SOLVED: 'You solved the puzzle! The correct word is: %(word)s',
+    SOLVE_FAILED: 'Your attempt to solve was unsuccessful! Game over!',
+    CANCELLED: 'Game Cancelled',
+}
+
+# the game history also shows the word after a failed attempt to solve
+HISTORY_MESSAGES = dict(MESSAGES)
+HISTORY_MESSAGES[SOLVE_FAILED] = \
+    'Your attempt to solve was unsuccessful! Game over! ' \
+    'The correct word is: %(word)s'
+
+# result code, attempts remaining and length of the guess, then the guess
+MOVE_HEADER = struct.Struct('<BBB')
+MAX_GUESS_LENGTH = 255
+
+
+def message(code, word, history=False):
+    """Return the message for a result code. word is the game's target word,
+    which is shown after an attempt to solve. If history is True, return the
+    message shown in the game history."""
+    messages = HISTORY_MESSAGES if history else MESSAGES
+    text = messages[code & ~GAME_OVER] % {'word': word}
+    if code & GAME_OVER:
+        text += ' Game over!'
+    return text
+
+
+def pack_move(guess, code, remaining):
+    """Return one move packed for the log."""
+    if isinstance(guess, unicode):
+        guess = guess.encode('utf-8')
+    guess = guess[:MAX_GUESS_LENGTH]
+    return MOVE_HEADER.pack(code, max(0, remaining), len(guess)) + guess
+
+
+def iter_moves(log):
+    """Yield (guess, code, remaining) for each move in a packed log, decoding
+    one move at a time."""
+    position = 0
+    log = log or ''
+    while position < len(log):
+        code, remaining, length = MOVE_HEADER.unpack_from(log, position)
+        position += MOVE_HEADER.size
+        guess = log[position:position + length]
+        position += length
+        yield guess, code, remaining
+
+
+def format_move(guess, code, remaining, word):
+    """Return a move as shown by get_game_history."""
+    if code == CANCELLED:
+        guess = 'None'
+    return "('guess': %s, 'result': '%s', 'remaining': %d)" % (
+        guess, message(code, word, history=True), remaining
+    )
+
+
+# matches one move in the formatted strings games used to store
+LEGACY_MOVE = re.compile(
+    r"'guess':\s*(.*?),\s*'result':\s*'(.*)',\s*'remaining':\s*(\d+)",
+    re.DOTALL
+)
+
+
+def parse_legacy_move(text):
+    """Convert a move stored as a formatted string, as games did before the
+    packed log, into (guess, code, remaining). Returns None if the string
+    cannot be understood."""
+    match = LEGACY_MOVE.search(text)
+    if not match:
+        return None
+    guess, result, remaining = match.groups()
+    # some strings were built with line continuations and contain runs of
+    # whitespace
+    result = ' '.join(result.split())
+
+    code = 0
+    if result.endswith(' Game over!') and \
+            not result.startswith('Your attempt to solve'):
+        code = GAME_OVER
+        result = result[:-len(' Game over!')]
+    if result.startswith('You solved the puzzle!'):
+        code |= SOLVED
+    elif result.startswith('Your attempt to solve'):
+        code |= SOLVE_FAILED
+    elif result == 'Correct! You solved the puzzle!':
+        code |= WON
+    else:
+        for result_code, text in MESSAGES.items():
+            if text == result:
+                code |= result_code
+                break
+        else:
+            return None
+
+    if code == CANCELLED:
+        guess = ''
+    return guess, code, int(remaining)
+
+
+def benchmark(number=200):
+    """Print the size of a 12 move game's history and the cost of saving the
+    game, with the history as formatted strings and as a packed log. Uses
+    local stubs of the datastore and memcache."""
+    import timeit
+    from google.appengine.ext import ndb, testbed
+    from models import User, Game
+
+    moves = [(letter, CORRECT, 6) for letter in 'hangmn'] + [
+        ('x', INCORRECT, 5), ('q', INCORRECT, 4),
+        ('hangmen', SOLVE_FAILED, 3), ('z', ALREADY_INCORRECT, 3),
+        ('hangman', SOLVED, 3), ('', CANCELLED, 3),
+    ]
+    word = 'hangman'
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    try:
+        user = User(name='benchmark')
+        user.put()
+        strings = Game(
+            parent=user.key, user=user.key, target_word=word,
+            attempts_allowed=6, user_name=user.name, game_history=[
+                format_move(guess, code, remaining, word)
+                for guess, code, remaining in moves
+            ]
+        )
+        packed = Game(
+            parent=user.key, user=user.key, target_word=word,
+            attempts_allowed=6, user_name=user.name, move_log=''.join(
+                pack_move(guess, code, remaining)
+                for guess, code, remaining in moves
+            )
+        )
+        for name, game, size in [
+                ('strings', strings, sum(map(len, strings.game_history))),
+                ('packed log', packed, len(packed.move_log))]:
+            seconds = min(timeit.repeat(
+                lambda: game.put(use_cache=False), number=number, repeat=3
+            ))
+            print '%-12s %5d bytes of history %6d bytes saved %8.3f ms ' \
+                'per put' % (
+                    name, size, len(game._to_pb().Encode()),
+                    seconds * 1e3 / number
+                )
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+"""loadtest.py - Replays game traffic against local App Engine stubs.
+
+Creates users and games through HangmanApi, plays every game out in bursts
+of make_move with get_game in between, reads the leaderboards and rankings
+and runs the reminder cron, running queued tasks through the main.py
+handlers as they are added. Everything runs on the local datastore,
+memcache, taskqueue and mail stubs, so it needs the App Engine SDK.
+
+Reports the throughput, the latency percentiles and the datastore RPCs of
+each operation. With --baseline, the results are compared with a file saved
+earlier by --save-baseline, and the run fails if an operation makes more
+datastore RPCs or is slower by more than the tolerance. The RPCs per call
+change with the number of users and games, so the baseline records the
+arguments it was run with, and a run with other arguments is not compared
+with it.
+
+loadtest_baseline.json holds the results of the default run (1000 users,
+seed 1) on the SDK's stubs. Its RPC counts hold on any machine, but its
+latencies and throughput were measured on one machine, so save a baseline
+of your own before comparing times.
+
+    python loadtest.py --baseline loadtest_baseline.json
+    python loadtest.py --users 1000 --save-baseline baseline.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+# letters guessed in order of how often they appear in English words
+GUESS_ORDER = 'esiarntolcdupmghbyfvkwzxqj'
+PERCENTILES = (50, 95, 99)
+
+
+def fix_sys_path(sdk_path):
+    """Adds the App Engine SDK and its libraries to sys.path."""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    try:
+        import dev_appserver
+    except ImportError:
+        sys.exit('The App Engine SDK was not found. Pass its path with --sdk.')
+    dev_appserver.fix_sys_path()
+
+
+class LoadTest(object):
+    """Calls the api and handlers, timing each call and counting its
+    datastore RPCs."""
+
+    def __init__(self, seed):
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.random = random.Random(seed)
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        # endpoints reads the app version from the environment
+        self.bed.setup_env(current_version_id='loadtest.1', overwrite=True)
+        self.bed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1)
+        )
+        self.bed.init_memcache_stub()
+        self.bed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__))
+        )
+        self.bed.init_mail_stub()
+        self.bed.init_app_identity_stub()
+        self.bed.init_urlfetch_stub()
+        self.taskqueue = self.bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+        self.datastore_rpcs = 0
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'loadtest', self._count_rpc, 'datastore_v3'
+        )
+        # wall times and datastore RPCs of each call, by operation
+        self.calls = {}
+
+        import api
+        import main
+        self.api_module = api
+        self.api = api.HangmanApi()
+        self.app = main.app
+
+    def _count_rpc(self, service, call, request, response):
+        self.datastore_rpcs += 1
+
+    def close(self):
+        self.bed.deactivate()
+
+    def call(self, operation, func, *args):
+        """Calls func, recording its wall time and datastore RPCs under
+        operation. Errors are recorded and return None."""
+        import endpoints
+        rpcs = self.datastore_rpcs
+        start = time.time()
+        try:
+            result = func(*args)
+        except endpoints.ServiceException:
+            result = None
+            operation += ' (error)'
+        self.calls.setdefault(operation, []).append(
+            (time.time() - start, self.datastore_rpcs - rpcs)
+        )
+        return result
+
+    def endpoint(self, name, request_container, **fields):
+        """Calls an endpoint method with a request built from fields."""
+        request_type = getattr(
+            request_container, 'combined_message_class', request_container
+        )
+        return self.call(
+            name, getattr(self.api, name), request_type(**fields)
+        )
+
+    def handler(self, path, method='GET', body='', headers=None):
+        """Sends a request to a main.py handler."""
+        import webapp2
+        request = webapp2.Request.blank(
+            path, method=method, body=body, headers=headers or {}
+        )
+        return self.call(path, request.get_response, self.app)
+
+    def run_tasks(self):
+        """Runs queued tasks until none are left, including any tasks they
+        queue."""
+        while True:
+            tasks = []
+            for queue in self.taskqueue.GetQueues():
+                tasks.extend(self.taskqueue.get_filtered_tasks(
+                    queue_names=[queue['name']]
+                ))
+                self.taskqueue.FlushQueue(queue['name'])
+            if not tasks:
+                return
+            for task in tasks:
+                self.handler(
+                    task.url, task.method, task.payload, dict(task.headers)
+                )
+
+    def create_users(self, count):
+        names = ['user%d' % number for number in range(count)]
+        for name in names:
+            self.endpoint(
+                'create_user', self.api_module.USER_REQUEST,
+                user=name, email='%s@example.com' % name
+            )
+        return names
+
+    def new_games(self, names):
+        games = []
+        for name in names:
+            form = self.endpoint(
+                'new_game', self.api_module.NEW_GAME_REQUEST,
+                user=name,
+                attempts=self.random.choice([6, 9, 12]),
+                min_letters=5,
+                max_letters=self.random.randint(6, 12)
+            )
+            if form:
+                games.append(form.urlsafe_key)
+        return games
+
+    def play(self, games, finish=0.8):
+        """Plays games in bursts of a few moves each, showing the game with
+        get_game before each burst, the way clients take turns. finish is
+        the share of games that are played to the end; the others are left
+        unfinished for the reminder cron."""
+        guesses = dict((key, list(GUESS_ORDER)) for key in games)
+        unfinished = set(self.random.sample(
+            games, int(len(games) * (1 - finish))
+        ))
+        active = list(games)
+        bursts = 0
+        while active:
+            # unfinished games are left after their first two bursts
+            if bursts == 2:
+                active = [key for key in active if key not in unfinished]
+            bursts += 1
+            self.random.shuffle(active)
+            still_active = []
+            for key in active:
+                self.endpoint(
+                    'get_game', self.api_module.GET_GAME_REQUEST,
+                    urlsafe_game_key=key
+                )
+                form = None
+                for move in range(self.random.randint(1, 4)):
+                    if not guesses[key]:
+                        break
+                    form = self.endpoint(
+                        'make_move', self.api_module.MAKE_MOVE_REQUEST,
+                        urlsafe_game_key=key, guess=guesses[key].pop(0),
+                        request_id='%s-%d' % (key, len(guesses[key]))
+                    )
+                    if form is None or form.game_over:
+                        break
+                if form is not None and not form.game_over and \
+                        guesses[key]:
+                    still_active.append(key)
+            active = still_active
+            self.run_tasks()
+
+    def read(self, names):
+        """Reads the leaderboards and rankings, as the scoreboard pages
+        do."""
+        for difficulty in (None, 'easy', 'medium', 'hard'):
+            self.endpoint(
+                'get_high_scores', self.api_module.HIGH_SCORE_REQUEST,
+                number_of_results=20, difficulty=difficulty
+            )
+        self.endpoint(
+            'get_user_rankings', self.api_module.RANKINGS_REQUEST,
+            difficulty='medium', page_size=50
+        )
+        for name in self.random.sample(names, min(len(names), 100)):
+            self.endpoint(
+                'get_user_position', self.api_module.USER_NAME,
+                user_name=name
+            )
+            self.endpoint(
+                'get_user_games', self.api_module.USER_NAME, user_name=name
+            )
+        from protorpc import message_types
+        self.endpoint('get_average_attempts', message_types.VoidMessage)
+
+    def reminders(self):
+        self.handler('/crons/send_reminder')
+        self.run_tasks()
+
+
+def percentile(ordered, percent):
+    return ordered[int(round((len(ordered) - 1) * percent / 100.0))]
+
+
+# the arguments that change the traffic, saved with the results
+RUN_ARGUMENTS = ('users', 'games_per_user', 'seed')
+
+
+def summarize(calls, seconds, arguments):
+    """Returns the results of a run: the arguments it was run with, the
+    throughput and, for each operation, the number of calls, latency
+    percentiles in milliseconds and datastore RPCs per call."""
+    operations = {}
+    for operation, timings in calls.items():
+        times = sorted(wall for wall, rpcs in timings)
+        result = {
+            'calls': len(timings),
+            'datastore_rpcs': round(
+                float(sum(rpcs for wall, rpcs in timings)) / len(timings), 2
+            ),
+        }
+        for percent in PERCENTILES:
+            result['p%d_ms' % percent] = round(
+                percentile(times, percent) * 1000, 3
+            )
+        operations[operation] = result
+    total = sum(len(timings) for timings in calls.values())
+    return {
+        'arguments': arguments,
+        'calls': total,
+        'seconds': round(seconds, 3),
+        'calls_per_second': round(total / seconds, 1),
+        'operations': operations,
+    }
+
+
+def report(results):
+    print '%-36s %7s %9s %9s %9s %8s' % (
+        'operation', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'ds rpcs'
+    )
+    for operation, result in sorted(results['operations'].items()):
+        print '%-36s %7d %9.3f %9.3f %9.3f %8.2f' % (
+            operation, result['calls'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], result['datastore_rpcs']
+        )
+    print '%d calls in %.1f seconds, %.1f calls per second' % (
+        results['calls'], results['seconds'], results['calls_per_second']
+    )
+
+
+def different_arguments(arguments, baseline):
+    """Returns a list of the arguments of a run that differ from the ones
+    the baseline was run with. A baseline saved without its arguments
+    differs in all of them."""
+    old_arguments = baseline.get('arguments', {})
+    return [
+        '%s %s, baseline %s' % (name, arguments[name], old_arguments.get(name))
+        for name in RUN_ARGUMENTS
+        if arguments[name] != old_arguments.get(name)
+    ]
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of the regressions since the baseline: operations
+    making more datastore RPCs, or with a higher p95 latency, by more than
+    tolerance, and a lower throughput. Raises a ValueError if the run and
+    the baseline were run with different arguments."""
+    differences = different_arguments(results['arguments'], baseline)
+    if differences:
+        raise ValueError(
+            'Not comparable with the baseline, which was run with other '
+            'arguments: %s' % '; '.join(differences)
+        )
+    regressions = []
+    for operation, old in sorted(baseline['operations'].items()):
+        new = results['operations'].get(operation)
+        if new is None:
+            continue
+        if new['datastore_rpcs'] > old['datastore_rpcs'] * (1 + tolerance):
+            regressions.append('%s: %.2f datastore RPCs, was %.2f' % (
+                operation, new['datastore_rpcs'], old['datastore_rpcs']
+            ))
+        if new['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 %.3f ms, was %.3f ms' % (
+                operation, new['p95_ms'], old['p95_ms']
+            ))
+    if results['calls_per_second'] < \
+            baseline['calls_per_second'] * (1 - tolerance):
+        regressions.append('%.1f calls per second, was %.1f' % (
+            results['calls_per_second'], baseline['calls_per_second']
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay game traffic against local App Engine stubs.'
+    )
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--games-per-user', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--save-baseline', help='save the results here')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed regression, 0.2 is 20%%')
+    args = parser.parse_args()
+    arguments = dict((name, getattr(args, name)) for name in RUN_ARGUMENTS)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        # checked before the run, which can take a while
+        differences = different_arguments(arguments, baseline)
+        if differences:
+            sys.exit('Not comparable with the baseline, which was run with '
+                     'other arguments: %s' % '; '.join(differences))
+
+    # the word lists are read from the application directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    fix_sys_path(args.sdk)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    test = LoadTest(args.seed)
+    try:
+        start = time.time()
+        names = test.create_users(args.users)
+        games = []
+        for number in range(args.games_per_user):
+            games.extend(test.new_games(names))
+        test.run_tasks()
+        test.play(games)
+        test.read(names)
+        test.reminders()
+        results = summarize(test.calls, time.time() - start, arguments)
+    finally:
+        test.close()
+
+    report(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print 'Regressions since the baseline:'
+            for regression in regressions:
+                print '  ' + regression
+            sys.exit(1)
+        print 'No regressions since the baseline.'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""lru.py - A small least-recently-used cache for per-instance data."""
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """Dictionary-like cache holding at most `size` entries. When it is full,
+    the least recently used entry is dropped. If `weigh` is given, `size` is
+    instead the largest total of weigh(value) over the entries, for example
+    their size in bytes. Safe to share between the threads of an
+    instance."""
+
+    def __init__(self, size, weigh=None):
+        self.size = size
+        self._weigh = weigh or (lambda value: 1)
+        self._weight = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value cached for key, or default."""
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                return default
+            # re-insert the entry so it is the most recently used
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        """Cache value for key, dropping the least recently used entries
+        while the cache is over its size. A value larger than the whole
+        cache is not kept."""
+        weight = self._weigh(value)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, weight)
+            self._weight += weight
+            while self._weight > self.size:
+                self._weight -= self._entries.popitem(last=False)[1][1]
+
+    def delete(self, key):
+        """Remove key from the cache, if it is there."""
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._weight -= entry[1]
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+    def __len__(self):
+        return len(self._entries)
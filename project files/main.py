@@ -3,27 +3,116 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 
+import collections
+import datetime
+import importlib
+import json
+import logging
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import HangmanApi
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
-from models import User, Game
+from models import User, Game, UserRank, RankHistogram, ReminderRun, \
+    ReminderBatch, Leaderboard, GameArchive, ALL_DIFFICULTIES
+from utils import run_in_transaction, schedule_task, get_suppressed_count
+from words import DICTIONARIES, get_word_index
+import counters
+import game_cache
+import startup
+import stats
+
+# tasks queued with schedule_task, whose suppressed requests are counted
+SCHEDULED_TASKS = (
+    '/tasks/cache_average_attempts',
+    '/tasks/rebuild_rank_histogram',
+    '/tasks/rebuild_leaderboards',
+)
+# number of users sent reminders by each reminder task
+REMINDER_BATCH_SIZE = 100
+# number of games converted by each migration task
+MIGRATION_BATCH_SIZE = 100
+# number of users whose ranks are rebuilt by each backfill task
+BACKFILL_BATCH_SIZE = 20
+# games are archived this many days after they end, by batches of this many
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_BATCH_SIZE = 200
+CUTOFF_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
+        """Start sending a reminder email to each User with an email about
+        games. The users are split into batches that are handled by
+        SendReminderBatch tasks. Called every 3 days using a cron job"""
+        run = ReminderRun()
+        run.put()
+        taskqueue.add(
+            url='/tasks/send_reminder_batch',
+            name='reminder-%d-0' % run.key.id(),
+            params={'run': run.key.id(), 'batch': 0}
+        )
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send reminder emails to one batch of users. The next batch is
+        queued before this one is sent, so the batches run side by side."""
+        # only needed by reminders, so not imported by every instance
+        from google.appengine.api import mail, app_identity
+
+        run_key = ndb.Key(ReminderRun, int(self.request.get('run')))
+        batch = int(self.request.get('batch'))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        # email > None is one inequality, so the query can be paged with
+        # cursors; != would run as two queries
+        users, next_cursor, more = User.query(User.email > None).fetch_page(
+            REMINDER_BATCH_SIZE, start_cursor=cursor
+        )
+        last = not (more and next_cursor)
+
+        if not last:
+            try:
+                # named, so a retry of this task does not queue it twice
+                taskqueue.add(
+                    url='/tasks/send_reminder_batch',
+                    name='reminder-%d-%d' % (run_key.id(), batch + 1),
+                    params={
+                        'run': run_key.id(),
+                        'batch': batch + 1,
+                        'cursor': next_cursor.urlsafe()
+                    }
+                )
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                pass
+
+        # a retry of a batch that got as far as sending must not send again
+        progress = run_in_transaction(ReminderBatch.claim, run_key, batch)
+        if progress is None:
+            logging.warning(
+                'Reminder run %d batch %d was already sent', run_key.id(),
+                batch
+            )
+            return
+
+        # count every user's unfinished games at the same time, reading only
+        # keys
+        counts = [
+            Game.query(
+                Game.game_over == False, Game.cancelled == False,
+                ancestor=user.key
+            ).count_async()
+            for user in users
+        ]
+
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            # get all games for user
-            games = Game.query(ancestor=user.key).fetch()
-            unfinished = 0
-            for game in games:
-                # count games that are not over
-                if game.game_over is False:
-                    unfinished += 1
+        emails = 0
+        for user, count in zip(users, counts):
+            unfinished = count.get_result()
+            # check if the user has unfinished games
+            if unfinished == 0:
+                continue
 
             subject = \
                 'Reminder! You have %d unfinished hangman games!' \
@@ -34,24 +123,302 @@ class SendReminderEmail(webapp2.RequestHandler):
 
             # This will send test emails, the arguments to send_mail are:
             # from, to, subject, body
-            # check if the user has unfinished games
-            if unfinished > 0:
-                mail.send_mail(
-                    'noreply@{}.appspotmail.com'.format(app_id),
-                    user.email,
-                    subject,
-                    body
-                )
+            mail.send_mail(
+                'noreply@{}.appspotmail.com'.format(app_id),
+                user.email,
+                subject,
+                body
+            )
+            emails += 1
+
+        logging.info(
+            'Reminder run %d batch %d: %d users, %d emails',
+            run_key.id(), batch, len(users), emails
+        )
+        # the emails have been sent, so failing to record them must not make
+        # the task retry
+        try:
+            self.record_progress(progress, len(users), emails, batch, last)
+        except Exception:
+            logging.exception(
+                'Could not record reminder run %d batch %d', run_key.id(),
+                batch
+            )
+
+    @staticmethod
+    def record_progress(progress, users, emails, batch, last):
+        """Saves the batch's ReminderBatch and, once every batch is done,
+        logs how long the run took."""
+        progress.users = users
+        progress.emails = emails
+        progress.finished = datetime.datetime.utcnow()
+        progress.put()
+        # only the last batch writes the run
+        run = progress.run.get()
+        if last:
+            run.total_batches = batch + 1
+            run.put()
+        if run.total_batches is None:
+            return
+        batches_done, users, emails, finished = run.get_progress()
+        if batches_done == run.total_batches:
+            seconds = (finished - run.started).total_seconds()
+            logging.info(
+                'Reminder run %d finished: %d batches, %d users, %d emails '
+                'in %.1f seconds, %.1f users per second',
+                run.key.id(), batches_done, users, emails, seconds,
+                users / max(seconds, 0.001)
+            )
+
+
+class ReconcileAverageMovesRemaining(webapp2.RequestHandler):
+    def get(self):
+        """Recount the active games and correct the counters the average
+        moves remaining is read from. Called every hour using a cron job"""
+        # api imports endpoints, which the other handlers do not need.
+        # utils only imports it when the api raises its errors
+        from api import HangmanApi
+        HangmanApi._reconcile_average_attempts()
 
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
     def post(self):
         """Update game listing announcement in memcache."""
+        from api import HangmanApi
         HangmanApi._cache_average_attempts()
         self.response.set_status(204)
 
 
+class RecordGameResult(webapp2.RequestHandler):
+    def post(self):
+        """Add the result of a game that is over to the leaderboards and the
+        user's rank. Queued by Game.end_game."""
+        game = ndb.Key(urlsafe=self.request.get('game')).get()
+        if game is None:
+            logging.warning('Game %s not found', self.request.get('game'))
+        else:
+            game.record_result()
+        self.response.set_status(204)
+
+
+class MigrateGameHistory(webapp2.RequestHandler):
+    def post(self):
+        """Move the game history of one batch of games from formatted
+        strings to the packed move log, then queue the next batch. Start it
+        once by queueing a task for /tasks/migrate_game_history."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True
+        )
+
+        def migrate(key):
+            # in a transaction so a move made at the same time is not lost
+            game = key.get()
+            if game and game.migrate_history():
+                game.put()
+
+        for key in keys:
+            run_in_transaction(migrate, key)
+
+        if more and next_cursor:
+            taskqueue.add(
+                url='/tasks/migrate_game_history',
+                params={'cursor': next_cursor.urlsafe()}
+            )
+        self.response.set_status(204)
+
+
+class BackfillGameEnded(webapp2.RequestHandler):
+    def post(self):
+        """Set the end time of the games in one batch that ended before end
+        times were kept, so the archive cron job can find them, then queue
+        the next batch. Start it once by queueing a task for
+        /tasks/backfill_game_ended."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True
+        )
+
+        def backfill(key):
+            # in a transaction so a move made at the same time is not lost
+            game = key.get()
+            if game and game.backfill_ended():
+                game.put()
+
+        # most games need nothing, so only those that do get a transaction
+        for game in ndb.get_multi(keys):
+            if game is not None and game.ended is None and \
+                    (game.game_over or game.cancelled):
+                run_in_transaction(backfill, game.key)
+
+        if more and next_cursor:
+            taskqueue.add(
+                url='/tasks/backfill_game_ended',
+                params={'cursor': next_cursor.urlsafe()}
+            )
+        self.response.set_status(204)
+
+
+class BackfillUserRanks(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the game counts of the ranks of one batch of users from
+        their games, then queue the next batch. Ranks saved before the counts
+        were kept are replaced. Start it once by queueing a task for
+        /tasks/backfill_user_ranks."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True
+        )
+
+        for key in keys:
+            # in a transaction so a game ending at the same time is counted
+            # once
+            run_in_transaction(UserRank.rebuild_user_ranks, key)
+            # ranks saved before the counts were kept have no parent
+            old_ranks = [
+                rank_key for rank_key in
+                UserRank.query(UserRank.user == key).fetch(keys_only=True)
+                if rank_key.parent() is None
+            ]
+            ndb.delete_multi(old_ranks)
+
+        if more and next_cursor:
+            taskqueue.add(
+                url='/tasks/backfill_user_ranks',
+                params={'cursor': next_cursor.urlsafe()}
+            )
+        else:
+            # every rank has been rebuilt, count them again
+            schedule_task('/tasks/rebuild_rank_histogram')
+        self.response.set_status(204)
+
+
+class RebuildRankHistogram(webapp2.RequestHandler):
+    def post(self):
+        """Recount the users at each performance for the rank
+        histograms."""
+        RankHistogram.rebuild()
+        self.response.set_status(204)
+
+
+class RebuildLeaderboards(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild every leaderboard from the saved scores. Queued when a
+        score could not be added to a leaderboard."""
+        Leaderboard.rebuild_all()
+        self.response.set_status(204)
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load what a new instance would otherwise load during its first
+        requests: the api module and endpoints, the word indexes, and the
+        leaderboards, rank histograms and counters if they are not in
+        memcache. Called by App Engine before the instance is sent
+        requests. Logs the startup report."""
+        startup.step('import api', importlib.import_module, 'api')
+        for dictionary in sorted(DICTIONARIES):
+            startup.step(
+                'word index %s' % dictionary, get_word_index, dictionary
+            )
+        for difficulty in ('easy', 'medium', 'hard'):
+            startup.step(
+                'leaderboard %s' % difficulty,
+                Leaderboard.get_entries, difficulty
+            )
+            startup.step(
+                'rank histogram %s' % difficulty,
+                RankHistogram.get_counts, difficulty
+            )
+        startup.step(
+            'leaderboard %s' % ALL_DIFFICULTIES,
+            Leaderboard.get_entries, ALL_DIFFICULTIES
+        )
+        for name in (counters.ACTIVE_GAMES, counters.ATTEMPTS_REMAINING):
+            startup.step('counter %s' % name, counters.get_count, name)
+        startup.uninstall()
+        startup.log_report()
+        self.response.set_status(204)
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Start moving games that ended more than `days` (default
+        ARCHIVE_AFTER_DAYS) days ago into the GameArchive. Called
+        every day using a cron job"""
+        days = int(self.request.get('days') or ARCHIVE_AFTER_DAYS)
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        taskqueue.add(
+            url='/tasks/archive_games',
+            params={'cutoff': cutoff.strftime(CUTOFF_FORMAT)}
+        )
+
+
+class ArchiveGamesBatch(webapp2.RequestHandler):
+    def post(self):
+        """Archive one batch of games that ended before the cutoff, then
+        queue the next batch."""
+        cutoff = datetime.datetime.strptime(
+            self.request.get('cutoff'), CUTOFF_FORMAT
+        )
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        # games that have not ended have no end time, which sorts first
+        keys, next_cursor, more = Game.query(
+            Game.ended > datetime.datetime(1970, 1, 1), Game.ended < cutoff
+        ).order(Game.ended).fetch_page(
+            ARCHIVE_BATCH_SIZE, start_cursor=cursor, keys_only=True
+        )
+
+        # each user's games are moved in one transaction
+        users = collections.defaultdict(list)
+        for key in keys:
+            users[key.parent()].append(key)
+        moved = 0
+        for game_keys in users.values():
+            moved += run_in_transaction(GameArchive.archive_games, game_keys)
+        logging.info('Archived %d games', moved)
+
+        if more and next_cursor:
+            taskqueue.add(
+                url='/tasks/archive_games',
+                params={
+                    'cutoff': self.request.get('cutoff'),
+                    'cursor': next_cursor.urlsafe()
+                }
+            )
+        self.response.set_status(204)
+
+
+class AdminStats(webapp2.RequestHandler):
+    def get(self):
+        """Show this instance's endpoint and handler statistics, game cache
+        counts and the number of background tasks schedule_task has
+        suppressed, as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'endpoints': stats.get_stats(),
+            'game_cache': game_cache.get_stats(),
+            'suppressed_tasks': dict(
+                (url, get_suppressed_count(url)) for url in SCHEDULED_TASKS
+            ),
+            'startup': startup.get_report(),
+        }, indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminder_batch', SendReminderBatch),
+    ('/crons/reconcile_average_attempts', ReconcileAverageMovesRemaining),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/record_game_result', RecordGameResult),
+    ('/tasks/migrate_game_history', MigrateGameHistory),
+    ('/tasks/backfill_user_ranks', BackfillUserRanks),
+    ('/tasks/backfill_game_ended', BackfillGameEnded),
+    ('/tasks/rebuild_rank_histogram', RebuildRankHistogram),
+    ('/tasks/rebuild_leaderboards', RebuildLeaderboards),
+    ('/crons/archive_games', ArchiveGames),
+    ('/tasks/archive_games', ArchiveGamesBatch),
+    ('/_ah/warmup', Warmup),
+    ('/admin/stats', AdminStats),
 ], debug=True)
+app = startup.StartupMiddleware(stats.StatsMiddleware(app))
@@ -1,10 +1,73 @@
 """models.py - This file contains the class definitions for the Datastore
 entities used by the game Hangman."""
 
+import bisect
+import itertools
+import logging
 import random
-from datetime import date
-from protorpc import messages
+from datetime import date, datetime, time
+from protorpc import messages, protojson
+from google.appengine.api import memcache, taskqueue
 from google.appengine.ext import ndb
+from words import get_word_index, get_tier, DEFAULT_DICTIONARY
+from utils import get_user_names, schedule_task
+import counters
+import game_cache
+import guesses
+import history
+
+
+# number of scores kept on each leaderboard, and the id of the leaderboard
+# for every difficulty level
+LEADERBOARD_SIZE = 100
+ALL_DIFFICULTIES = 'all'
+MEMCACHE_LEADERBOARD = 'LEADERBOARD_%s'
+
+# highest possible UserRank performance, and the number of shards of each
+# rank histogram
+MAX_PERFORMANCE = 1000
+RANK_HISTOGRAM_SHARDS = 10
+MEMCACHE_RANK_HISTOGRAM = 'RANK_HISTOGRAM_%s'
+
+# the urlsafe keys of a user's active games, with the generation of the
+# list they were read for. The generation goes up each time one of the
+# user's games is created, ends or is cancelled, and a cached list is only
+# used if its generation is the current one
+MEMCACHE_ACTIVE_GAMES = 'ACTIVE_GAMES_%s'
+MEMCACHE_ACTIVE_GAMES_GENERATION = 'ACTIVE_GAMES_GENERATION_%s'
+# seconds a user's active games are cached for
+ACTIVE_GAMES_CACHE_SECONDS = 600
+
+# the Game properties kept for an archived game
+ARCHIVED_GAME_FIELDS = (
+    'target_word', 'target_revealed', 'correct_letters', 'incorrect_letters',
+    'move_log', 'attempts_allowed', 'attempts_remaining', 'cancelled',
+    'game_over', 'won', 'user_name', 'dictionary', 'ended'
+)
+
+# body parts drawn for each incorrect guess, by attempts allowed
+BODY_PARTS = {
+    6: [
+        'head', 'body', 'left leg', 'right leg', 'left hand', 'right hand'
+    ],
+    9: [
+        'head', 'eyes', 'ears', 'hair', 'body', 'left leg', 'right leg',
+        'left hand', 'right hand'
+    ],
+    12: [
+        'head', 'left eye', 'right eye', 'mouth', 'nose', 'left ear',
+        'right ear', 'body', 'left leg', 'right leg', 'left hand',
+        'right hand'
+    ],
+}
+
+# GameForm.body_parts for each number of incorrect guesses, by attempts
+# allowed
+DRAWN_BODY_PARTS = dict(
+    (attempts, [str(parts[0:incorrect]) for incorrect in
+                range(len(parts) + 1)])
+    for attempts, parts in BODY_PARTS.items()
+)
 
 
 class User(ndb.Model):
@@ -19,43 +82,99 @@ class Game(ndb.Model):
     target_revealed = ndb.StringProperty(default='')
     correct_letters = ndb.StringProperty(default='')
     incorrect_letters = ndb.StringProperty(default='')
+    # the moves made in the game, packed by history.pack_move
+    move_log = ndb.BlobProperty(default='')
+    # formatted move strings of games from before move_log. they are moved
+    # to move_log by migrate_history
     game_history = ndb.StringProperty(repeated=True)
     attempts_allowed = ndb.IntegerProperty(required=True)
     attempts_remaining = ndb.IntegerProperty(required=True, default=6)
     cancelled = ndb.BooleanProperty(required=True, default=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
+    # copied from the User so responses do not have to get it
+    user_name = ndb.StringProperty(indexed=False)
     won = ndb.BooleanProperty(default=False)
+    dictionary = ndb.StringProperty(default=DEFAULT_DICTIONARY)
+    # bitmasks of the letters in target_word, every letter guessed and the
+    # letters guessed correctly. see guesses.py
+    word_mask = ndb.IntegerProperty(indexed=False)
+    guessed_mask = ndb.IntegerProperty(indexed=False, default=0)
+    correct_mask = ndb.IntegerProperty(indexed=False, default=0)
+    # goes up every time the game is saved, so cached copies of older
+    # versions are not used. see game_cache.py
+    version = ndb.IntegerProperty(indexed=False, default=0)
+    # when the game ended or was cancelled. games are moved to a GameArchive
+    # some time after
+    ended = ndb.DateTimeProperty()
+
+    # games are cached by game_cache instead
+    _use_memcache = False
+
+    def _pre_put_hook(self):
+        self.version += 1
+        # a game saved in a transaction is cached once the transaction
+        # commits, any other game once it is saved
+        self._cache_on_commit = ndb.in_transaction()
+        if self._cache_on_commit:
+            ndb.get_context().call_on_commit(
+                lambda: game_cache.store(self)
+            )
+
+    def _post_put_hook(self, future):
+        if not self._cache_on_commit and future.get_exception() is None:
+            game_cache.store(self)
 
     @classmethod
-    def new_game(cls, user, attempts, min_letters, max_letters):
+    def new_game(cls, user, attempts, min_letters, max_letters,
+                 dictionary=DEFAULT_DICTIONARY, word_difficulty=None,
+                 user_name=None):
         """Creates and returns a new game"""
-        valid_attempts_allowed = [6, 9, 12]
+        game = cls.build_game(
+            user, attempts, min_letters, max_letters, dictionary,
+            word_difficulty, user_name
+        )
+        game.put()
+        game.update_counters(None)
+        game.clear_active_games()
+        return game
 
-        # pick random word from file, with correct length
-        # https://github.com/first20hours/google-10000-english
-        # removed words shorter than 4 letters
-        words_file = open('google-10000-english-usa.txt', 'r')
-        all_words = words_file.readlines()
-
-        # create a list of words that are the correct length
-        correct_length_words = []
-        for word in all_words:
-            # if word lenth is less than max letters and more than min letters
-            if len(word) <= max_letters + 1 and len(word) >= min_letters + 1:
-                correct_length_words.append(word)
-
-        # now we are working with a list of words that are the correct length
-        # get the number of 'correct length words' this will be the upper
-        # range for randrange.
-        max_lines_correct_length_words = len(correct_length_words)
-        # assign a random number to pick_line. this will be the word that is
-        # used for this hangman game.
-        pick_line = random.randrange(0, max_lines_correct_length_words)
-        word = correct_length_words[pick_line].rstrip('\n')
-        # set target_revealed to be the same number of underscores
-        # as the number of letters in the word
-        target_revealed = "_ " * len(word)
+    @classmethod
+    def new_games(cls, users, attempts, min_letters, max_letters,
+                  dictionary=DEFAULT_DICTIONARY, word_difficulty=None,
+                  shared_word=False):
+        """Creates and returns a new game for each of a list of Users, saved
+        together. If shared_word is True, every game has the same word."""
+        word = None
+        if shared_word:
+            word = cls.pick_word(
+                attempts, min_letters, max_letters, dictionary,
+                word_difficulty
+            )
+        games = [
+            cls.build_game(
+                user.key, attempts, min_letters, max_letters, dictionary,
+                word_difficulty, user.name, word
+            )
+            for user in users
+        ]
+        # cached together once they are all saved
+        with game_cache.batch():
+            ndb.put_multi(games)
+        counters.increment({
+            counters.ACTIVE_GAMES: len(games),
+            counters.ATTEMPTS_REMAINING: attempts * len(games),
+        })
+        cls.clear_active_games_multi([user.key for user in users])
+        return games
+
+    @staticmethod
+    def pick_word(attempts, min_letters, max_letters,
+                  dictionary=DEFAULT_DICTIONARY, word_difficulty=None):
+        """Checks the settings of a new game and returns a word for it.
+        Raises a ValueError if the settings are not valid, or if no word
+        matches them."""
+        valid_attempts_allowed = [6, 9, 12]
 
         if attempts not in valid_attempts_allowed:
             raise ValueError('Attempts allowed must be 6, 9, or 12')
@@ -63,16 +182,172 @@ class Game(ndb.Model):
             raise ValueError(
                 'Maximum letters must be greater than minimum letters.'
             )
-        # create the game and save it to datastore.
-        game = Game(parent=user,
-                    user=user,
-                    target_word=word,
-                    attempts_allowed=attempts,
-                    attempts_remaining=attempts,
-                    target_revealed=target_revealed,
-                    game_over=False)
-        game.put()
-        return game
+
+        # pick a random word with the correct length and difficulty from the
+        # dictionary's word index. raises a ValueError if the dictionary or
+        # word difficulty does not exist, or if no word matches.
+        return get_word_index(dictionary).random_word(
+            min_letters, max_letters, get_tier(word_difficulty)
+        )
+
+    @classmethod
+    def build_game(cls, user, attempts, min_letters, max_letters,
+                   dictionary=DEFAULT_DICTIONARY, word_difficulty=None,
+                   user_name=None, word=None):
+        """Returns a new game without saving it. A word is picked unless one
+        is given."""
+        if word is None:
+            word = cls.pick_word(
+                attempts, min_letters, max_letters, dictionary,
+                word_difficulty
+            )
+        # set target_revealed to be the same number of underscores
+        # as the number of letters in the word
+        target_revealed = "_ " * len(word)
+
+        return cls(parent=user,
+                   user=user,
+                   user_name=user_name,
+                   target_word=word,
+                   attempts_allowed=attempts,
+                   attempts_remaining=attempts,
+                   target_revealed=target_revealed,
+                   dictionary=dictionary,
+                   word_mask=guesses.letters_mask(word.lower()),
+                   game_over=False)
+
+    @classmethod
+    def get_active_game_keys(cls, user):
+        """Returns the urlsafe keys of the user's games that are neither over
+        nor cancelled. Only the keys of the active games are read, and they
+        are cached until one of the user's games is created, ends or is
+        cancelled."""
+        cache_key = MEMCACHE_ACTIVE_GAMES % user.urlsafe()
+        generation_key = MEMCACHE_ACTIVE_GAMES_GENERATION % user.urlsafe()
+        cached = memcache.get_multi([cache_key, generation_key])
+        generation = cached.get(generation_key)
+        if generation is None:
+            # a random start, so a list cached before the generation was
+            # evicted is not taken for the current one
+            memcache.add(generation_key, random.getrandbits(31))
+            generation = memcache.get(generation_key)
+        elif cache_key in cached and cached[cache_key][0] == generation:
+            return cached[cache_key][1]
+
+        # games are children of their user, so an ancestor query sees a game
+        # as soon as it is saved
+        keys = [
+            key.urlsafe() for key in cls.query(
+                cls.game_over == False, cls.cancelled == False, ancestor=user
+            ).fetch(keys_only=True)
+        ]
+        # a game saved after the query moves the generation on, so the list
+        # stored here is never used after it, whichever is written last
+        if generation is not None:
+            memcache.set(
+                cache_key, (generation, keys), time=ACTIVE_GAMES_CACHE_SECONDS
+            )
+        return keys
+
+    @staticmethod
+    def clear_active_games_multi(users):
+        """Makes the cached active games of a list of User keys out of
+        date."""
+        memcache.offset_multi(dict(
+            (MEMCACHE_ACTIVE_GAMES_GENERATION % user.urlsafe(), 1)
+            for user in users
+        ))
+
+    def clear_active_games(self):
+        """Makes the user's cached active games out of date, once the game
+        is saved if it is being saved in a transaction."""
+        ndb.get_context().call_on_commit(
+            lambda: self.clear_active_games_multi([self.user])
+        )
+
+    def counter_values(self):
+        """Returns this game's share of the active games counters: one
+        active game and its attempts remaining, or nothing if the game is
+        over or cancelled."""
+        if self.game_over or self.cancelled:
+            return {counters.ACTIVE_GAMES: 0, counters.ATTEMPTS_REMAINING: 0}
+        return {
+            counters.ACTIVE_GAMES: 1,
+            counters.ATTEMPTS_REMAINING: self.attempts_remaining
+        }
+
+    def update_counters(self, before):
+        """Adds the change in this game's share of the active games counters
+        since `before`, a result of counter_values (or None for a new game).
+        If the game is being saved in a transaction, the counters are changed
+        once it commits."""
+        after = self.counter_values()
+        deltas = dict(
+            (name, value - (before or {}).get(name, 0))
+            for name, value in after.items()
+        )
+        ndb.get_context().call_on_commit(
+            lambda: counters.increment(deltas)
+        )
+
+    def load_masks(self):
+        """Set the letter bitmasks of a game created before they were
+        stored, from target_word and the guessed letters."""
+        if self.word_mask is None:
+            self.word_mask = guesses.letters_mask(self.target_word.lower())
+            self.correct_mask = guesses.letters_mask(self.correct_letters)
+            self.guessed_mask = self.correct_mask | \
+                guesses.letters_mask(self.incorrect_letters)
+
+    def log_move(self, guess, result):
+        """Add a move and its result code to the game history."""
+        self.migrate_history()
+        self.move_log += history.pack_move(
+            guess, result, self.attempts_remaining
+        )
+
+    def iter_moves(self):
+        """Yield (guess, result code, attempts remaining) for each move in
+        the game history, decoding one move at a time."""
+        if self.game_history:
+            return iter(self._parse_legacy_history())
+        return history.iter_moves(self.move_log)
+
+    def migrate_history(self):
+        """Move the formatted strings in game_history to move_log. Returns
+        True if there was anything to move."""
+        if not self.game_history:
+            return False
+        self.move_log = (self.move_log or '') + ''.join(
+            history.pack_move(*move) for move in self._parse_legacy_history()
+        )
+        self.game_history = []
+        return True
+
+    def backfill_ended(self):
+        """Set the end time of a game that ended before end times were kept,
+        so it can be archived: the start of the day of its score, or now for
+        a cancelled game, which has no score. Returns True if the end time
+        was set."""
+        if self.ended is not None or not (self.game_over or self.cancelled):
+            return False
+        score = Score.query(ancestor=self.key).get()
+        if score is not None and score.date is not None:
+            self.ended = datetime.combine(score.date, time())
+        else:
+            self.ended = datetime.utcnow()
+        return True
+
+    def _parse_legacy_history(self):
+        """Return the moves in game_history that can be parsed."""
+        moves = []
+        for text in self.game_history:
+            move = history.parse_legacy_move(text)
+            if move is None:
+                logging.warning('Could not parse game history: %r', text)
+            else:
+                moves.append(move)
+        return moves
 
     def to_form(self, message):
         """Returns a GameForm representation of the Game"""
@@ -84,34 +359,26 @@ class Game(ndb.Model):
         form.attempts_allowed = self.attempts_allowed
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
-        form.user = self.user.get().name
+        form.user = self.get_user_name()
         form.won = self.won
         form.message = message
 
-        # convert attempts_remaining to body_parts to be drawn
-        if form.attempts_allowed == 6:
-            body_parts = [
-                'head', 'body', 'left leg', 'right leg', 'left hand',
-                'right hand'
-            ]
-        elif form.attempts_allowed == 9:
-            body_parts = [
-                'head', 'eyes', 'ears', 'hair', 'body', 'left leg',
-                'right leg', 'left hand', 'right hand'
-            ]
-        elif form.attempts_allowed == 12:
-            body_parts = [
-                'head', 'left eye', 'right eye', 'mouth', 'nose',
-                'left ear', 'right ear', 'body', 'left leg', 'right leg',
-                'left hand', 'right hand'
-            ]
-
         # count incorrect guesses so we know how many body parts to draw/return
         incorrect_guesses = form.attempts_allowed - form.attempts_remaining
-        form.body_parts = str(body_parts[0:incorrect_guesses])
+        form.body_parts = DRAWN_BODY_PARTS[form.attempts_allowed][
+            incorrect_guesses
+        ]
 
         return form
 
+    def get_user_name(self):
+        """Returns the name of the game's user. Games store it when they are
+        created; older games look it up once and store it on their next
+        save."""
+        if self.user_name is None:
+            self.user_name = self.user.get().name
+        return self.user_name
+
     def convert_int_to_difficulty(self, int_difficulty):
         """ Converts attempts_allows (int representation of difficulty level)
         to a word representation of difficulty level (easy, medium, hard) """
@@ -124,15 +391,25 @@ class Game(ndb.Model):
 
         return set_difficulty
 
-    def end_game(self, game, user, result, difficulty):
-        """Ends the game, sets the score, and updates user rank.
+    def finish(self, result):
+        """Marks the game as over without saving it.
         If result is True, the player won.
         If result is False, the player lost."""
         self.won = result
         self.game_over = True
-        # save game result
-        self.put()
+        self.ended = datetime.utcnow()
+
+    def end_game(self):
+        """Saves a game that is over and its score. Can be run in a
+        transaction."""
+        self.end_game_async().get_result()
 
+    @ndb.tasklet
+    def end_game_async(self):
+        """Saves a game that is over and its score at the same time, and
+        queues a task, in the same transaction, that adds the result to the
+        leaderboards and the user's rank. The move that ended the game does
+        not wait for either."""
         # calculate the score
         set_score = int(
             (
@@ -145,22 +422,71 @@ class Game(ndb.Model):
             )
         )
 
-        user = ndb.Key(urlsafe=user)
-        game_key = ndb.Key(urlsafe=game)
-
         # set the score
         score = Score(
             # game is the parent
-            parent=game_key,
-            user=user,
-            difficulty=difficulty,
+            parent=self.key,
+            user=self.user,
+            difficulty=self.convert_int_to_difficulty(self.attempts_allowed),
             score=set_score,
-            date=date.today()
+            date=date.today(),
+            recorded=False
+        )
+
+        # the task is only added if the transaction commits
+        task = taskqueue.Queue().add_async(
+            taskqueue.Task(
+                url='/tasks/record_game_result',
+                params={'game': self.key.urlsafe()}
+            ),
+            transactional=ndb.in_transaction()
         )
-        score.put()
+        yield ndb.put_multi_async([self, score])
+        self.clear_active_games()
+        task.get_result()
+
+    def record_result(self):
+        """Adds the score of a game that is over to the leaderboards, and its
+        result to the user's rank. Run by the task queued by end_game; a
+        result that has already been recorded is skipped, so the task can
+        be retried."""
+        score = Score.query(ancestor=self.key).get()
+        if score is None:
+            logging.warning('Game %s has no score', self.key.urlsafe())
+            return
+
+        def record():
+            # the score, game and rank share the user's entity group
+            current = score.key.get()
+            if current.recorded:
+                return False
+            current.recorded = True
+            current.put()
+            UserRank.set_user_rank(
+                self.user, score.difficulty, finished=1, won=int(self.won)
+            )
+            return True
 
-        # update user rank
-        UserRank.set_user_rank(user, difficulty)
+        if ndb.transaction(record, retries=3):
+            Leaderboard.add_score(score, self.get_user_name())
+
+    def cancel(self):
+        """Cancels the game, saves it and updates the user's rank. Can be run
+        in a transaction."""
+        self.cancelled = True
+        self.ended = datetime.utcnow()
+        # note in the game history that the game has been cancelled
+        self.log_move('', history.CANCELLED)
+        self.put()
+        self.clear_active_games()
+
+        # update user's rank - might be affected if % of cancelled games
+        # goes over 10%
+        UserRank.set_user_rank(
+            self.user,
+            self.convert_int_to_difficulty(self.attempts_allowed),
+            cancelled=1
+        )
 
 
 class Score(ndb.Model):
@@ -171,69 +497,254 @@ class Score(ndb.Model):
     date = ndb.DateProperty(required=True)
     difficulty = ndb.StringProperty()
     score = ndb.IntegerProperty(default=0)
+    # False until the score is on the leaderboards and in the user's rank.
+    # None for scores from before results were recorded by a task
+    recorded = ndb.BooleanProperty(indexed=False)
+
+    def to_form(self, user_name=None):
+        """Sends Score message. Pass user_name if it is already known, to
+        save getting the User."""
+        if user_name is None:
+            user_name = self.user.get().name
+        return ScoreForm(
+            user=user_name,
+            date=str(self.date),
+            difficulty=self.difficulty,
+            score=self.score
+        )
+
+
+class LeaderboardEntry(ndb.Model):
+    """One score on a Leaderboard."""
+    user = ndb.KeyProperty(kind='User')
+    user_name = ndb.StringProperty()
+    date = ndb.DateProperty()
+    difficulty = ndb.StringProperty()
+    score = ndb.IntegerProperty()
+    # the Score the entry was made from, so it is never added twice
+    score_key = ndb.KeyProperty(kind='Score')
 
     def to_form(self):
         """Sends Score message."""
         return ScoreForm(
-            user=self.user.get().name,
+            user=self.user_name,
             date=str(self.date),
             difficulty=self.difficulty,
             score=self.score
         )
 
 
+class Leaderboard(ndb.Model):
+    """The LEADERBOARD_SIZE highest scores for one difficulty level, or for
+    every level. The id is the difficulty, or 'all'. The scores are added as
+    games end, and the leaderboard is cached in memcache, so reading it
+    costs no query."""
+    entries = ndb.LocalStructuredProperty(LeaderboardEntry, repeated=True)
+
+    @staticmethod
+    def memcache_key(difficulty):
+        return MEMCACHE_LEADERBOARD % difficulty
+
+    @classmethod
+    def get_entries(cls, difficulty=ALL_DIFFICULTIES):
+        """Returns the entries of a leaderboard, highest score first. Reads
+        memcache, then the datastore. A leaderboard that has not been saved
+        yet is built from the saved scores."""
+        entries = memcache.get(cls.memcache_key(difficulty))
+        if entries is None:
+            leaderboard = cls.get_by_id(difficulty)
+            if leaderboard is None:
+                leaderboard = cls.rebuild(difficulty)
+            entries = leaderboard.entries
+            memcache.set(cls.memcache_key(difficulty), entries)
+        return entries
+
+    @classmethod
+    def rebuild(cls, difficulty=ALL_DIFFICULTIES):
+        """Builds and saves a leaderboard from the saved scores."""
+        query = Score.query()
+        if difficulty != ALL_DIFFICULTIES:
+            query = query.filter(Score.difficulty == difficulty)
+        scores = query.order(-Score.score).fetch(LEADERBOARD_SIZE)
+        user_names = get_user_names(scores)
+        leaderboard = cls(id=difficulty, entries=[
+            LeaderboardEntry(
+                user=score.user,
+                user_name=user_names.get(score.user),
+                date=score.date,
+                difficulty=score.difficulty,
+                score=score.score,
+                score_key=score.key
+            )
+            for score in scores
+        ])
+        leaderboard.put()
+        memcache.delete(cls.memcache_key(difficulty))
+        return leaderboard
+
+    @classmethod
+    def add_score(cls, score, user_name):
+        """Adds a new score to the leaderboards for its difficulty level and
+        for every level, if it is high enough and not already there. A
+        failure is logged and does not fail the task that recorded the
+        score; instead a task is queued to rebuild the leaderboards."""
+        entry = LeaderboardEntry(
+            user=score.user,
+            user_name=user_name,
+            date=score.date,
+            difficulty=score.difficulty,
+            score=score.score,
+            score_key=score.key
+        )
+        for difficulty in (score.difficulty, ALL_DIFFICULTIES):
+            # a leaderboard built from the saved scores by get_entries may
+            # already hold this one
+            entries = cls.get_entries(difficulty)
+            if any(other.score_key == score.key for other in entries):
+                continue
+            # most scores are too low to change the leaderboard
+            if len(entries) >= LEADERBOARD_SIZE and \
+                    entry.score <= entries[-1].score:
+                continue
+            try:
+                entries = ndb.transaction(
+                    lambda: cls._insert(difficulty, entry), retries=3
+                )
+            except Exception:
+                logging.exception(
+                    'Could not add a score to the %s leaderboard', difficulty
+                )
+                memcache.delete(cls.memcache_key(difficulty))
+                schedule_task('/tasks/rebuild_leaderboards')
+                continue
+            memcache.set(cls.memcache_key(difficulty), entries)
+
+    @classmethod
+    def rebuild_all(cls):
+        """Rebuilds the leaderboard of each difficulty level and of every
+        level."""
+        for difficulty in ('easy', 'medium', 'hard', ALL_DIFFICULTIES):
+            cls.rebuild(difficulty)
+
+    @classmethod
+    def _insert(cls, difficulty, entry):
+        """Inserts entry into a leaderboard in score order, keeping the
+        LEADERBOARD_SIZE highest scores. An entry for a score that is
+        already there is left out. Runs in a transaction."""
+        leaderboard = cls.get_by_id(difficulty) or cls(id=difficulty)
+        if any(other.score_key == entry.score_key
+               for other in leaderboard.entries):
+            return leaderboard.entries
+        scores = [-other.score for other in leaderboard.entries]
+        # after any equal scores, so the earlier score stays ahead
+        position = bisect.bisect_right(scores, -entry.score)
+        leaderboard.entries.insert(position, entry)
+        del leaderboard.entries[LEADERBOARD_SIZE:]
+        leaderboard.put()
+        return leaderboard.entries
+
+
+class MoveReceipt(ndb.Model):
+    """The response to a move that was sent with a request_id. The game is
+    the parent. A retried request with the same request_id is answered from
+    its receipt instead of being applied to the game again."""
+    response = ndb.TextProperty(required=True)
+
+    @classmethod
+    def get_response(cls, game_key, request_id, message_type):
+        """Returns the stored response to request_id as a message_type
+        message, or None if request_id has not been seen."""
+        if not request_id:
+            return None
+        receipt = cls.get_by_id(request_id, parent=game_key)
+        if receipt is None:
+            return None
+        return protojson.decode_message(message_type, receipt.response)
+
+    @classmethod
+    def save(cls, game_key, request_id, message):
+        """Stores the response message to request_id."""
+        if request_id:
+            cls(
+                id=request_id,
+                parent=game_key,
+                response=protojson.encode_message(message)
+            ).put()
+
+
 class UserRank(ndb.Model):
     """User Rank object. This is the users overall win percentage per each
     difficulty level. For each difficuly level, if a user's cancelled games
     is over 10%, his overall rank for that difficulty level is affected:
-    UserRank *= completion percentage for this rank."""
+    UserRank *= completion percentage for this rank.
+    The user is the parent and the difficulty is the id, so a rank is got by
+    key and updated in the same transaction as the user's game. It keeps
+    counts of the user's games so the performance can be updated without
+    reading them."""
     user = ndb.KeyProperty(required=True, kind='User')
     difficulty = ndb.StringProperty(required=True)
     performance = ndb.IntegerProperty(required=True)
+    games_finished = ndb.IntegerProperty(default=0, indexed=False)
+    games_won = ndb.IntegerProperty(default=0, indexed=False)
+    games_cancelled = ndb.IntegerProperty(default=0, indexed=False)
 
-    def to_form(self):
-        """Sends UserRank message."""
+    def to_form(self, user_name=None):
+        """Sends UserRank message. Pass user_name if it is already known, to
+        save getting the User."""
+        if user_name is None:
+            user_name = self.user.get().name
         return UserRankForm(
-            user=self.user.get().name,
+            user=user_name,
             performance=self.performance,
             difficulty=self.difficulty
         )
 
     @classmethod
-    def set_user_rank(cls, user, difficulty):
-        """Updates a users rank after a game has been completed."""
-        # get scores for all games by this user in every difficulty level
-        all_games_played = Game.query(ancestor=user).fetch()
-        games_this_difficulty_level = 0  # game.game_over = True
-        games_cancelled = 0
-        games_won = 0
-
-        # convert difficulty to int_difficulty
-        if difficulty == 'hard':
-            int_difficulty = 6
-        elif difficulty == 'medium':
-            int_difficulty = 9
-        elif difficulty == 'easy':
-            int_difficulty = 12
-
-        # count games/games_won/cancelled for this difficulty level
-        for game in all_games_played:
-            if game.attempts_allowed == int_difficulty:
-                # count only games that are over. the user might have several
-                # not started games. we aren't looking for those.
-                if game.game_over is True:
-                    games_this_difficulty_level += 1
-                if game.won is True:
-                    games_won += 1
-                if game.cancelled is True:
-                    games_cancelled += 1
-
-        if games_this_difficulty_level != 0:
+    def get_key(cls, user, difficulty):
+        """Returns the key of a user's rank for a difficulty level."""
+        return ndb.Key(cls, difficulty, parent=user)
+
+    @classmethod
+    def set_user_rank(cls, user, difficulty, finished=0, won=0, cancelled=0):
+        """Updates a users rank after a game has been completed or
+        cancelled, by adding to the counts of the user's games for this
+        difficulty level. Runs in a transaction."""
+        rank = cls.get_key(user, difficulty).get()
+        if rank is None:
+            # rank is empty, create it
+            rank = cls(
+                key=cls.get_key(user, difficulty),
+                user=user,
+                difficulty=difficulty,
+                performance=0
+            )
+            old_performance = None
+        else:
+            old_performance = rank.performance
+        rank.games_finished += finished
+        rank.games_won += won
+        rank.games_cancelled += cancelled
+        rank.set_performance()
+        rank.put()
+
+        # move the user in the rank histogram once the rank is saved
+        new_performance = rank.performance
+        if new_performance != old_performance:
+            ndb.get_context().call_on_commit(
+                lambda: RankHistogram.move(
+                    difficulty, old_performance, new_performance
+                )
+            )
+        return rank
+
+    def set_performance(self):
+        """Calculates performance from the counts of games."""
+        if self.games_finished != 0:
             win_percentage = \
-                int((float(games_won) / games_this_difficulty_level) * 1000)
+                int((float(self.games_won) / self.games_finished) * 1000)
 
-            percent_finished = float(games_this_difficulty_level) \
-                / (games_cancelled + games_this_difficulty_level)
+            percent_finished = float(self.games_finished) \
+                / (self.games_cancelled + self.games_finished)
         else:
             # if no games have been finished, 100% of the games must have been
             # cancelled
@@ -244,29 +755,305 @@ class UserRank(ndb.Model):
         # is multiplied by the percent of games he has finished
         if percent_finished < 0.9:
             # set user's new_performance to win_percentage * percent_finished
-            new_performance = int(percent_finished * win_percentage)
+            self.performance = int(percent_finished * win_percentage)
         else:
             # otherwise the new_performance is the win_percentage
-            new_performance = win_percentage
+            self.performance = win_percentage
+
+    @classmethod
+    def rebuild_user_ranks(cls, user):
+        """Recounts all of a user's games and saves the user's ranks for
+        every difficulty level they have played. Used to fill in the counts
+        of ranks from before they were kept. Runs in a transaction on the
+        user's entity group."""
+        # games whose result has not been recorded yet are left out, they
+        # are added by their record_game_result task
+        pending = set(
+            score.key.parent() for score in Score.query(ancestor=user)
+            if score.recorded is False
+        )
+        ranks = {}
+        games = itertools.chain(
+            Game.query(ancestor=user), GameArchive.iter_games(user)
+        )
+        for game in games:
+            if game.key in pending:
+                continue
+            difficulty = game.convert_int_to_difficulty(game.attempts_allowed)
+            rank = ranks.get(difficulty)
+            if rank is None:
+                rank = ranks[difficulty] = cls(
+                    key=cls.get_key(user, difficulty),
+                    user=user,
+                    difficulty=difficulty,
+                    performance=0
+                )
+            # count only games that are over. the user might have several
+            # not started games. we aren't looking for those.
+            if game.game_over is True:
+                rank.games_finished += 1
+            if game.won is True:
+                rank.games_won += 1
+            if game.cancelled is True:
+                rank.games_cancelled += 1
+        for rank in ranks.values():
+            rank.set_performance()
+        ndb.put_multi(ranks.values())
+        return ranks.values()
 
-        # try to get the user's current rank
-        rank = UserRank.query(
-            ndb.AND(UserRank.user == user,
-                    ndb.AND(UserRank.difficulty == difficulty))
-        ).get()
 
-        if rank is None:
-            # rank is empty, create and save it
-            rank = UserRank(
-                user=user,
-                difficulty=difficulty,
-                performance=new_performance
+class RankHistogram(ndb.Model):
+    """One shard of the number of users at each performance (0 to
+    MAX_PERFORMANCE) for a difficulty level, so a user's place can be found
+    without reading every rank. The id is the difficulty and the shard
+    number. Each change is made to a random shard, and the shards are
+    summed when the histogram is read."""
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @staticmethod
+    def memcache_key(difficulty):
+        return MEMCACHE_RANK_HISTOGRAM % difficulty
+
+    @classmethod
+    def shard_keys(cls, difficulty):
+        """Returns the keys of every shard for a difficulty level."""
+        return [
+            ndb.Key(cls, '%s-%d' % (difficulty, shard))
+            for shard in range(RANK_HISTOGRAM_SHARDS)
+        ]
+
+    @classmethod
+    def move(cls, difficulty, old_performance, new_performance):
+        """Moves one user from old_performance (None for a new rank) to
+        new_performance. A failure is logged and does not fail the game
+        that changed the rank; a task is queued to correct the histogram by
+        rebuilding it."""
+        key = random.choice(cls.shard_keys(difficulty))
+
+        def update():
+            shard = key.get() or cls(key=key)
+            if not shard.counts:
+                shard.counts = [0] * (MAX_PERFORMANCE + 1)
+            # a shard's count can go below zero if the user was added to
+            # another shard; only the sum over the shards matters
+            if old_performance is not None:
+                shard.counts[old_performance] -= 1
+            shard.counts[new_performance] += 1
+            shard.put()
+
+        try:
+            # called on commit of a rank's transaction, while ndb still has
+            # that transaction's context, so it needs a transaction of its
+            # own
+            ndb.transaction(
+                update, retries=3,
+                propagation=ndb.TransactionOptions.INDEPENDENT
             )
-            rank.put()
-        else:
-            # rank exists. update it.
-            rank.performance = new_performance
-            rank.put()
+        except Exception:
+            logging.exception(
+                'Could not update the %s rank histogram', difficulty
+            )
+            schedule_task('/tasks/rebuild_rank_histogram')
+        memcache.delete(cls.memcache_key(difficulty))
+
+    @classmethod
+    def get_counts(cls, difficulty):
+        """Returns the number of users at each performance for a difficulty
+        level, summed over the shards."""
+        counts = memcache.get(cls.memcache_key(difficulty))
+        if counts is None:
+            counts = [0] * (MAX_PERFORMANCE + 1)
+            for shard in ndb.get_multi(cls.shard_keys(difficulty)):
+                if shard is not None:
+                    for performance, count in enumerate(shard.counts):
+                        counts[performance] += count
+            memcache.set(cls.memcache_key(difficulty), counts)
+        return counts
+
+    @classmethod
+    def get_position(cls, difficulty, performance):
+        """Returns the place of a user with this performance, the number of
+        ranked users, and the percentage of ranked users the user is level
+        with or ahead of."""
+        counts = cls.get_counts(difficulty)
+        players = sum(counts)
+        ahead = sum(counts[performance + 1:])
+        if players == 0:
+            return 1, 0, 100.0
+        return ahead + 1, players, 100.0 * (players - ahead) / players
+
+    @classmethod
+    def rebuild(cls):
+        """Counts every UserRank and saves the histograms. Changes made
+        while it runs can be lost, so run it when few games are ending."""
+        counts = dict(
+            (difficulty, [0] * (MAX_PERFORMANCE + 1))
+            for difficulty in ('easy', 'medium', 'hard')
+        )
+        for rank in UserRank.query():
+            if rank.difficulty in counts:
+                counts[rank.difficulty][rank.performance] += 1
+
+        shards = []
+        for difficulty, difficulty_counts in counts.items():
+            keys = cls.shard_keys(difficulty)
+            # every count goes in the first shard
+            shards.append(cls(key=keys[0], counts=difficulty_counts))
+            shards.extend(
+                cls(key=key, counts=[0] * (MAX_PERFORMANCE + 1))
+                for key in keys[1:]
+            )
+        ndb.put_multi(shards)
+        memcache.delete_multi(
+            [cls.memcache_key(difficulty) for difficulty in counts]
+        )
+
+
+class ReminderRun(ndb.Model):
+    """One run of the reminder email cron job, which is split into batches
+    of users. Each batch records its progress in its own ReminderBatch, so
+    batches running side by side never write the same entity."""
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    # set by the last batch, once it is known how many batches there are
+    total_batches = ndb.IntegerProperty()
+
+    def get_progress(self):
+        """Returns the number of batches done, users checked and emails sent
+        so far, and the time the last batch finished. Only known once
+        total_batches is set. The batches are read by key rather than
+        queried, so the counts are up to date and no index is needed."""
+        batches = ndb.get_multi([
+            ReminderBatch.get_key(self.key, batch)
+            for batch in range(self.total_batches)
+        ])
+        batches = [
+            batch for batch in batches
+            if batch is not None and batch.finished is not None
+        ]
+        return (
+            len(batches),
+            sum(batch.users for batch in batches),
+            sum(batch.emails for batch in batches),
+            max([batch.finished for batch in batches] or [None])
+        )
+
+
+class ReminderBatch(ndb.Model):
+    """One batch of a ReminderRun. The batch is claimed before its emails
+    are sent, so a retried task never sends them twice, and is updated with
+    the users checked and emails sent when it finishes. The id is
+    '<run id>-<batch number>'."""
+    run = ndb.KeyProperty(kind=ReminderRun, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+    users = ndb.IntegerProperty(default=0, indexed=False)
+    emails = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def get_key(cls, run_key, batch):
+        return ndb.Key(cls, '%d-%d' % (run_key.id(), batch))
+
+    @classmethod
+    def claim(cls, run_key, batch):
+        """Returns a new ReminderBatch for the batch, or None if the batch
+        has been claimed before. Runs in a transaction."""
+        key = cls.get_key(run_key, batch)
+        if key.get() is not None:
+            return None
+        claimed = cls(key=key, run=run_key)
+        claimed.put()
+        return claimed
+
+
+class ArchivedGame(ndb.Model):
+    """The game in a GameArchive: the Game properties in
+    ARCHIVED_GAME_FIELDS and the game's id."""
+    game_id = ndb.IntegerProperty(required=True)
+    target_word = ndb.StringProperty()
+    target_revealed = ndb.StringProperty()
+    correct_letters = ndb.StringProperty()
+    incorrect_letters = ndb.StringProperty()
+    move_log = ndb.BlobProperty()
+    attempts_allowed = ndb.IntegerProperty()
+    attempts_remaining = ndb.IntegerProperty()
+    cancelled = ndb.BooleanProperty()
+    game_over = ndb.BooleanProperty()
+    won = ndb.BooleanProperty()
+    user_name = ndb.StringProperty()
+    dictionary = ndb.StringProperty()
+    ended = ndb.DateTimeProperty()
+
+    @classmethod
+    def from_game(cls, game):
+        return cls(game_id=game.key.id(), **dict(
+            (name, getattr(game, name)) for name in ARCHIVED_GAME_FIELDS
+        ))
+
+    def to_game(self, user):
+        """Returns the archived game as a Game, with its original key. The
+        Game is not saved."""
+        return Game(
+            key=ndb.Key(Game, self.game_id, parent=user), user=user,
+            **dict((name, getattr(self, name)) for name in
+                   ARCHIVED_GAME_FIELDS)
+        )
+
+
+class GameArchive(ndb.Model):
+    """A game that ended some time ago, moved out of the Game kind so
+    queries and scans of games only see active and recent ones. Finished
+    games never change, so an archived game is only kept for get_game and
+    get_game_history. Each game is archived on its own, compressed, with
+    the User as the parent and the game's id as the id, so reading one costs
+    a get of that game alone. Scores keep their archived game's key as
+    parent."""
+    game = ndb.LocalStructuredProperty(ArchivedGame, compressed=True)
+
+    @classmethod
+    def get_key(cls, game_key):
+        """Returns the key a game is archived under."""
+        return ndb.Key(cls, game_key.id(), parent=game_key.parent())
+
+    @classmethod
+    def get_game(cls, game_key):
+        """Returns an archived game as a Game, or None if it is not in the
+        archive."""
+        archive = cls.get_key(game_key).get()
+        if archive is not None:
+            return archive.game.to_game(game_key.parent())
+        return None
+
+    @classmethod
+    def iter_games(cls, user):
+        """Yields each of a user's archived games as a Game."""
+        for archive in cls.query(ancestor=user):
+            yield archive.game.to_game(user)
+
+    @classmethod
+    def archive_games(cls, game_keys):
+        """Moves one user's games into the archive, if they are over or
+        cancelled. Returns the number of games moved. Runs in a transaction
+        on the user's entity group."""
+        games = [
+            game for game in ndb.get_multi(game_keys)
+            if game is not None and (game.game_over or game.cancelled)
+        ]
+        if not games:
+            return 0
+        for game in games:
+            # games from before the packed move log are converted first
+            game.migrate_history()
+            game.get_user_name()
+        ndb.put_multi([
+            cls(key=cls.get_key(game.key), game=ArchivedGame.from_game(game))
+            for game in games
+        ])
+        game_keys = [game.key for game in games]
+        ndb.delete_multi(game_keys)
+        ndb.get_context().call_on_commit(
+            lambda: game_cache.forget_multi(game_keys)
+        )
+        return len(games)
 
 
 class GameForm(messages.Message):
@@ -290,6 +1077,11 @@ class GameKeysForm(messages.Message):
     keys = messages.StringField(1, repeated=True)
 
 
+class GameForms(messages.Message):
+    """Return multiple GameForms"""
+    items = messages.MessageField(GameForm, 1, repeated=True)
+
+
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user = messages.StringField(1, required=True)
@@ -297,11 +1089,45 @@ class NewGameForm(messages.Message):
     attempts = messages.IntegerField(2, default=9)
     min_letters = messages.IntegerField(3, default=6)
     max_letters = messages.IntegerField(4, default=12)
+    dictionary = messages.StringField(5, default=DEFAULT_DICTIONARY)
+    word_difficulty = messages.StringField(6)
+
+
+class NewGamesForm(messages.Message):
+    """Used to create the same kind of game for several users at once"""
+    users = messages.StringField(1, repeated=True)
+    attempts = messages.IntegerField(2, default=9)
+    min_letters = messages.IntegerField(3, default=6)
+    max_letters = messages.IntegerField(4, default=12)
+    dictionary = messages.StringField(5, default=DEFAULT_DICTIONARY)
+    word_difficulty = messages.StringField(6)
+    # give every game the same word
+    shared_word = messages.BooleanField(7, default=False)
 
 
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     guess = messages.StringField(1, required=True)
+    request_id = messages.StringField(2)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in a row in an existing game"""
+    guesses = messages.StringField(1, repeated=True)
+    request_id = messages.StringField(2)
+
+
+class MoveResultForm(messages.Message):
+    """MoveResultForm for the outbound result of one guess"""
+    guess = messages.StringField(1, required=True)
+    message = messages.StringField(2, required=True)
+    attempts_remaining = messages.IntegerField(3, required=True)
+
+
+class MoveResultsForm(messages.Message):
+    """Return the result of each guess and the final game state"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
 
 
 class ScoreForm(messages.Message):
@@ -315,6 +1141,15 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class HintForm(messages.Message):
+    """The letter to guess next, the share of the words that could be the
+    word that it is in, and the number of those words"""
+    letter = messages.StringField(1)
+    probability = messages.FloatField(2, required=True)
+    candidates = messages.IntegerField(3, required=True)
 
 
 class StringMessage(messages.Message):
@@ -330,6 +1165,22 @@ class UserRankForm(messages.Message):
 
 class UserRankForms(messages.Message):
     rankings = messages.MessageField(UserRankForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class UserPositionForm(messages.Message):
+    """A user's place in the rankings for one difficulty level"""
+    difficulty = messages.StringField(1, required=True)
+    performance = messages.IntegerField(2, required=True)
+    rank = messages.IntegerField(3, required=True)
+    players = messages.IntegerField(4, required=True)
+    percentile = messages.FloatField(5, required=True)
+
+
+class UserPositionForms(messages.Message):
+    """Return a user's place for each difficulty level they have played"""
+    user = messages.StringField(1, required=True)
+    positions = messages.MessageField(UserPositionForm, 2, repeated=True)
 
 
 class GameHistoryForm(messages.Message):
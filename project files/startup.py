@@ -0,0 +1,127 @@
+"""startup.py - Import and initialization times of a new instance.
+
+install() is called from appengine_config.py, before the application is
+loaded, and times the first import of every module until uninstall() is
+called at the end of the warmup request. Warmup requests are not
+guaranteed, so timing also stops at the first other request (see
+StartupMiddleware), after MAX_SECONDS or after MAX_IMPORTS modules,
+whichever comes first. The warmup handler adds the time of each
+initialization step, and the report is logged and shown on /admin/stats."""
+
+import __builtin__
+import logging
+import sys
+import threading
+import time
+
+
+# imports that took less than this many milliseconds are left out of the
+# report
+REPORT_THRESHOLD_MS = 1.0
+# imports are timed for at most this many seconds after install(), and for
+# at most this many modules
+MAX_SECONDS = 60
+MAX_IMPORTS = 1000
+WARMUP_PATH = '/_ah/warmup'
+
+# the import function replaced by install(), kept after uninstall() for
+# imports that were already in _timed_import on other threads
+_builtin_import = None
+_original_import = None
+# [name, nesting depth, milliseconds] of each module imported, in the order
+# the imports started
+_imports = []
+# (name, milliseconds) of each initialization step
+_steps = []
+_depth = threading.local()
+_installed_at = None
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if name in sys.modules:
+        return _builtin_import(name, globals, locals, fromlist, level)
+    if len(_imports) >= MAX_IMPORTS or \
+            time.time() - _installed_at > MAX_SECONDS:
+        uninstall()
+        return _builtin_import(name, globals, locals, fromlist, level)
+    depth = getattr(_depth, 'value', 0)
+    entry = [name, depth, None]
+    _imports.append(entry)
+    _depth.value = depth + 1
+    start = time.time()
+    try:
+        return _builtin_import(name, globals, locals, fromlist, level)
+    finally:
+        entry[2] = (time.time() - start) * 1000
+        _depth.value = depth
+
+
+def install():
+    """Starts timing imports."""
+    global _builtin_import, _original_import, _installed_at
+    if _original_import is None:
+        _installed_at = time.time()
+        _builtin_import = _original_import = __builtin__.__import__
+        __builtin__.__import__ = _timed_import
+
+
+def uninstall():
+    """Stops timing imports, so later imports cost nothing extra."""
+    global _original_import
+    if _original_import is not None:
+        __builtin__.__import__ = _original_import
+        _original_import = None
+
+
+class StartupMiddleware(object):
+    """WSGI middleware that stops timing imports at the first request that
+    is not a warmup request, in case the instance was not warmed up."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if _original_import is not None and \
+                environ.get('PATH_INFO') != WARMUP_PATH:
+            uninstall()
+        return self.app(environ, start_response)
+
+
+def step(name, func, *args, **kwargs):
+    """Runs one initialization step, recording how long it took, and returns
+    its result."""
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _steps.append((name, (time.time() - start) * 1000))
+
+
+def get_report():
+    """Returns the import times of the modules that took at least
+    REPORT_THRESHOLD_MS, indented by how deeply they were nested, and the
+    time of each initialization step, in milliseconds."""
+    imports = [
+        ('  ' * depth + name, round(ms, 1)) for name, depth, ms in _imports
+        if ms is not None and ms >= REPORT_THRESHOLD_MS
+    ]
+    return {
+        'imports': imports,
+        'import_ms': round(sum(
+            ms for name, depth, ms in _imports if depth == 0 and ms
+        ), 1),
+        'steps': [(name, round(ms, 1)) for name, ms in _steps],
+        'since_install_ms': round(
+            (time.time() - _installed_at) * 1000, 1
+        ) if _installed_at else None,
+    }
+
+
+def log_report():
+    """Logs the report, one line per module or step."""
+    report = get_report()
+    lines = ['Startup: imports took %.1f ms' % report['import_ms']]
+    lines.extend('  %-50s %8.1f ms' % entry for entry in report['imports'])
+    lines.append('Initialization:')
+    lines.extend('  %-50s %8.1f ms' % entry for entry in report['steps'])
+    logging.info('\n'.join(lines))
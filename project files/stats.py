@@ -0,0 +1,163 @@
+"""stats.py - Latency and RPC statistics for endpoints and handlers.
+
+A sample of the calls to each endpoint method and handler is recorded: the
+wall time, the number of datastore, memcache and taskqueue RPCs and the bytes
+they sent and received, and the number of tasks queued. Each sampled call is
+logged as one JSON line, and the last WINDOW_SIZE wall times of each endpoint
+or handler are kept on the instance to report percentiles.
+
+The share of calls sampled can be set in appengine_config.py, for example
+    hangman_stats_SAMPLE_RATE = 1.0
+A call that is not sampled costs one random number."""
+
+import collections
+import functools
+import json
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import lib_config
+
+
+_config = lib_config.register('hangman_stats', {
+    # share of calls that are recorded, from 0 to 1
+    'SAMPLE_RATE': 0.1,
+    # number of recent wall times kept for each endpoint or handler
+    'WINDOW_SIZE': 1000,
+})
+
+# services whose RPCs are counted
+SERVICES = ('datastore_v3', 'memcache', 'taskqueue')
+PERCENTILES = (50, 95, 99)
+
+# the call being recorded on each request thread
+_current = threading.local()
+
+# recent wall times and running totals, by endpoint or handler name
+_wall_times = {}
+_totals = {}
+_lock = threading.Lock()
+
+
+def _post_call_hook(service, call, request, response, rpc=None):
+    """Counts an RPC made while a call is being recorded."""
+    record = getattr(_current, 'record', None)
+    if record is None:
+        return
+    record[service + '_rpcs'] += 1
+    try:
+        record[service + '_bytes'] += request.ByteSize() + response.ByteSize()
+    except Exception:
+        pass
+    if service == 'taskqueue' and call == 'BulkAdd':
+        record['tasks_queued'] += request.add_request_size()
+
+
+for _service in SERVICES:
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'hangman_stats_%s' % _service, _post_call_hook, _service
+    )
+
+
+def _start(name):
+    """Starts recording a call, if it is sampled and no other call is being
+    recorded on this thread. Returns the record, or None."""
+    if random.random() >= _config.SAMPLE_RATE:
+        return None
+    if getattr(_current, 'record', None) is not None:
+        return None
+    record = collections.defaultdict(int)
+    record['name'] = name
+    record['start'] = time.time()
+    _current.record = record
+    return record
+
+
+def _finish(record, error=None):
+    """Stops recording a call, logs it and adds it to the statistics."""
+    _current.record = None
+    record['wall_ms'] = round((time.time() - record.pop('start')) * 1000, 3)
+    if error is not None:
+        record['error'] = error.__class__.__name__
+    logging.info('stats %s', json.dumps(record, sort_keys=True))
+
+    name = record['name']
+    with _lock:
+        if name not in _wall_times:
+            _wall_times[name] = collections.deque(maxlen=_config.WINDOW_SIZE)
+            _totals[name] = collections.defaultdict(int)
+        _wall_times[name].append(record['wall_ms'])
+        totals = _totals[name]
+        totals['calls'] += 1
+        totals['errors'] += int(error is not None)
+        for key, value in record.items():
+            if key.endswith(('_rpcs', '_bytes')) or key == 'tasks_queued':
+                totals[key] += value
+
+
+def timed(func):
+    """Decorator recording a sample of the calls to an endpoint method. Put
+    it below @endpoints.method, so the method keeps its name and
+    docstring."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        record = _start(func.__name__)
+        if record is None:
+            return func(*args, **kwargs)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            _finish(record, e)
+            raise
+        _finish(record)
+        return result
+    return wrapper
+
+
+class StatsMiddleware(object):
+    """WSGI middleware recording a sample of the requests to an application,
+    by path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        record = _start(environ.get('PATH_INFO', ''))
+        if record is None:
+            return self.app(environ, start_response)
+        try:
+            # webapp2 returns the whole response body at once
+            result = self.app(environ, start_response)
+        except Exception as e:
+            _finish(record, e)
+            raise
+        _finish(record)
+        return result
+
+
+def _percentile(ordered, percent):
+    return ordered[int(round((len(ordered) - 1) * percent / 100.0))]
+
+
+def get_stats():
+    """Returns this instance's statistics for each endpoint or handler: the
+    percentiles of the recent wall times in milliseconds, the number of
+    calls recorded and the average RPCs, bytes and tasks queued per call."""
+    with _lock:
+        snapshot = dict(
+            (name, (sorted(times), dict(_totals[name])))
+            for name, times in _wall_times.items()
+        )
+    stats = {}
+    for name, (ordered, totals) in snapshot.items():
+        calls = totals.pop('calls')
+        entry = {'calls': calls, 'errors': totals.pop('errors')}
+        for percent in PERCENTILES:
+            entry['p%d_ms' % percent] = _percentile(ordered, percent)
+        for key, value in totals.items():
+            entry[key + '_per_call'] = round(float(value) / calls, 2)
+        stats[name] = entry
+    return stats
@@ -0,0 +1,145 @@
+"""base.py - Common set up for the tests, on local App Engine stubs.
+
+The tests need the App Engine SDK. Set APPENGINE_SDK to its path, or put
+dev_appserver.py on the PATH, and run them from the application directory:
+
+    python -m unittest discover tests
+"""
+
+import logging
+import os
+import sys
+import unittest
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fix_sys_path():
+    """Adds the App Engine SDK, its libraries and the application to
+    sys.path."""
+    sdk_path = os.environ.get('APPENGINE_SDK')
+    if not sdk_path:
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            if os.path.exists(os.path.join(path, 'dev_appserver.py')):
+                sdk_path = os.path.realpath(path)
+                break
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+
+
+fix_sys_path()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+import webapp2
+
+import game_cache
+
+# retried transactions and other expected failures are logged as warnings
+logging.getLogger().setLevel(logging.ERROR)
+
+# datastore calls that manage indexes, which are not counted
+INDEX_CALLS = ('CreateIndex', 'UpdateIndex', 'GetIndices', 'DeleteIndex')
+
+
+class TestCase(unittest.TestCase):
+    """Runs each test on fresh datastore, memcache, taskqueue and mail stubs,
+    counting the RPCs it makes."""
+
+    def setUp(self):
+        # the word lists are read from the application directory
+        self._cwd = os.getcwd()
+        os.chdir(APP_DIR)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # endpoints reads the app version from the environment
+        self.testbed.setup_env(current_version_id='test.1', overwrite=True)
+        # queries fail, as in production, if index.yaml has no index for
+        # them
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1),
+            require_indexes=True, root_path=APP_DIR
+        )
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        # a new ndb context, so nothing is cached from an earlier test. Gets
+        # and puts of more than 10 entity groups are otherwise split into
+        # several RPCs, sent at the same time, so RPC counts would grow with
+        # the entities instead of the batches
+        ndb.set_context(ndb.make_context(
+            config=ndb.ContextOptions(max_entity_groups_per_rpc=1000)
+        ))
+        game_cache.clear()
+
+        # (service, call, request) of each RPC, in order
+        self.rpcs = []
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'tests', self._record_rpc
+        )
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        os.chdir(self._cwd)
+
+    def _record_rpc(self, service, call, request, response):
+        # the stub creates the indexes of index.yaml on the first query
+        if call not in INDEX_CALLS:
+            self.rpcs.append((service, call, request))
+
+    def count_rpcs(self, func, *args, **kwargs):
+        """Calls func and returns its result and the number of datastore
+        RPCs it made."""
+        result, rpcs = self.record_rpcs(func, *args, **kwargs)
+        return result, len(rpcs)
+
+    def record_rpcs(self, func, *args, **kwargs):
+        """Calls func and returns its result and the (call, request) of each
+        datastore RPC it made."""
+        start = len(self.rpcs)
+        result = func(*args, **kwargs)
+        return result, [
+            (call, request) for service, call, request in self.rpcs[start:]
+            if service == 'datastore_v3'
+        ]
+
+    def call(self, api, name, request_container, **fields):
+        """Calls an endpoint method with a request built from fields."""
+        request_type = getattr(
+            request_container, 'combined_message_class', request_container
+        )
+        return getattr(api, name)(request_type(**fields))
+
+    def get_tasks(self, url=None):
+        """Returns the queued tasks, for url or for every url."""
+        return self.taskqueue.get_filtered_tasks(url=url)
+
+    def run_tasks(self):
+        """Runs queued tasks through the main.py handlers until none are
+        left, including any tasks they queue. Returns the number run."""
+        import main
+        count = 0
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks()
+            if not tasks:
+                return count
+            for queue in self.taskqueue.GetQueues():
+                self.taskqueue.FlushQueue(queue['name'])
+            for task in tasks:
+                request = webapp2.Request.blank(
+                    task.url, method=task.method, body=task.payload,
+                    headers=dict(task.headers)
+                )
+                response = request.get_response(main.app)
+                self.assertLess(response.status_int, 300, task.url)
+                count += 1
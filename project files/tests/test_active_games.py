@@ -0,0 +1,67 @@
+"""test_active_games.py - A user's cached active games are never older than
+the last change to them."""
+
+from base import TestCase
+
+from google.appengine.api import memcache
+
+from models import User, Game, MEMCACHE_ACTIVE_GAMES_GENERATION
+
+
+class ActiveGamesTest(TestCase):
+
+    def setUp(self):
+        super(ActiveGamesTest, self).setUp()
+        self.user = User(name='player')
+        self.user.put()
+
+    def new_game(self):
+        return Game.new_game(self.user.key, 6, 5, 8)
+
+    def test_cached_until_a_change(self):
+        game = self.new_game()
+        keys = Game.get_active_game_keys(self.user.key)
+        self.assertEqual(keys, [game.key.urlsafe()])
+        keys, rpcs = self.count_rpcs(Game.get_active_game_keys, self.user.key)
+        self.assertEqual(rpcs, 0)
+        game.cancel()
+        self.assertEqual(Game.get_active_game_keys(self.user.key), [])
+
+    def test_change_during_a_read(self):
+        first = self.new_game()
+        query = Game.query
+        user = self.user
+        games = []
+
+        class RacingQuery(object):
+            """A query whose results are read just before another game is
+            saved, as when a new_game runs while the list is read."""
+            def __init__(self, *args, **kwargs):
+                self.query = query(*args, **kwargs)
+
+            def fetch(self, **kwargs):
+                results = self.query.fetch(**kwargs)
+                games.append(Game.new_game(user.key, 6, 5, 8))
+                return results
+
+        Game.query = RacingQuery
+        try:
+            keys = Game.get_active_game_keys(self.user.key)
+        finally:
+            # back to the query classmethod of ndb.Model
+            del Game.query
+        self.assertEqual(keys, [first.key.urlsafe()])
+        # the list read before the new game was saved is not used
+        keys = Game.get_active_game_keys(self.user.key)
+        self.assertEqual(
+            sorted(keys), sorted([first.key.urlsafe(), games[0].key.urlsafe()])
+        )
+
+    def test_evicted_generation(self):
+        game = self.new_game()
+        Game.get_active_game_keys(self.user.key)
+        memcache.delete(
+            MEMCACHE_ACTIVE_GAMES_GENERATION % self.user.key.urlsafe()
+        )
+        game.cancel()
+        self.assertEqual(Game.get_active_game_keys(self.user.key), [])
@@ -0,0 +1,83 @@
+"""test_bulk_games.py - create_games_bulk saves and caches its games in
+batches."""
+
+from base import TestCase
+
+from google.appengine.api import memcache
+
+import api
+import game_cache
+from models import User, Game
+
+
+class BulkGamesTest(TestCase):
+
+    def setUp(self):
+        super(BulkGamesTest, self).setUp()
+        self.api = api.HangmanApi()
+
+    def create_games(self, count, prefix='user'):
+        """Creates count users and a game for each with create_games_bulk.
+        Returns the forms and the RPCs made."""
+        names = ['%s%d' % (prefix, number) for number in range(count)]
+        for name in names:
+            User(name=name).put()
+        start = len(self.rpcs)
+        forms = self.call(
+            self.api, 'create_games_bulk', api.NEW_GAMES_REQUEST,
+            users=names, attempts=9, min_letters=5, max_letters=10
+        )
+        return forms, self.rpcs[start:]
+
+    def test_one_put_and_one_task(self):
+        forms, rpcs = self.create_games(25)
+        self.assertEqual(len(forms.items), 25)
+        game_puts = [
+            request for service, call, request in rpcs
+            if call == 'Put' and any(
+                entity.key().path().element_list()[-1].type() == 'Game'
+                for entity in request.entity_list()
+            )
+        ]
+        self.assertEqual(len(game_puts), 1)
+        self.assertEqual(len(game_puts[0].entity_list()), 25)
+        self.assertEqual(
+            len(self.get_tasks('/tasks/cache_average_attempts')), 1
+        )
+
+    def test_games_are_cached_in_one_batch(self):
+        # the second task in the window is suppressed, which is counted with
+        # an Increment
+        forms, rpcs = self.create_games(5)
+        few = len([rpc for rpc in rpcs if rpc[0] == 'memcache' and
+                   rpc[1] != 'Increment'])
+        memcache.flush_all()
+        forms, rpcs = self.create_games(25, 'other')
+        many = len([rpc for rpc in rpcs if rpc[0] == 'memcache' and
+                    rpc[1] != 'Increment'])
+        self.assertEqual(many, few)
+        for game in Game.query():
+            cached, count = self.count_rpcs(game_cache.get, game.key)
+            self.assertEqual(count, 0)
+            self.assertEqual(cached.version, game.version)
+
+    def test_failed_write_removes_both_keys(self):
+        forms, rpcs = self.create_games(2)
+        games = list(Game.query())
+        urlsafe = games[0].key.urlsafe()
+        write_newer = game_cache._write_newer
+        # only the version of the first game cannot be written
+        game_cache._write_newer = \
+            lambda mapping, versions: [
+                game_cache.MEMCACHE_GAME_VERSION % urlsafe
+            ]
+        try:
+            game_cache.store_multi(games)
+        finally:
+            game_cache._write_newer = write_newer
+        self.assertIsNone(memcache.get(game_cache.MEMCACHE_GAME % urlsafe))
+        self.assertIsNone(
+            memcache.get(game_cache.MEMCACHE_GAME_VERSION % urlsafe)
+        )
+        other = games[1].key.urlsafe()
+        self.assertIsNotNone(memcache.get(game_cache.MEMCACHE_GAME % other))
@@ -0,0 +1,76 @@
+"""test_end_game.py - Datastore RPCs of the move that ends a game."""
+
+from base import TestCase
+
+import api
+from models import Game, Score, UserRank
+from test_game_forms import read_kinds
+
+
+def put_kinds(rpcs):
+    """Returns the kinds of the entities saved by each Put RPC."""
+    return [
+        sorted(
+            entity.key().path().element_list()[-1].type()
+            for entity in request.entity_list()
+        )
+        for call, request in rpcs if call == 'Put'
+    ]
+
+
+class EndGameTest(TestCase):
+
+    def setUp(self):
+        super(EndGameTest, self).setUp()
+        self.api = api.HangmanApi()
+        self.call(
+            self.api, 'create_user', api.USER_REQUEST, user='player',
+            email='player@example.com'
+        )
+        self.call(
+            self.api, 'new_game', api.NEW_GAME_REQUEST, user='player',
+            attempts=6, min_letters=5, max_letters=8
+        )
+        self.game_key = Game.query().get(keys_only=True)
+        self.word = self.game_key.get().target_word.lower()
+
+    def move(self, guess):
+        return self.call(
+            self.api, 'make_move', api.MAKE_MOVE_REQUEST,
+            urlsafe_game_key=self.game_key.urlsafe(), guess=guess
+        )
+
+    def test_winning_move(self):
+        letters = sorted(set(self.word))
+        for letter in letters[:-1]:
+            self.move(letter)
+        form, rpcs = self.record_rpcs(self.move, letters[-1])
+        self.assertTrue(form.game_over)
+        self.assertTrue(form.won)
+
+        # the move's transaction: one get of the game, then the game and
+        # its score in one Put, with the task added in the same transaction
+        calls = [call for call, request in rpcs]
+        self.assertEqual(
+            calls[:calls.index('Commit') + 1],
+            ['BeginTransaction', 'Get', 'Put', 'AddActions', 'Commit']
+        )
+        saved = put_kinds(rpcs)
+        self.assertIn(['Game', 'Score'], saved)
+        self.assertEqual(
+            len([kinds for kinds in saved if 'Game' in kinds]), 1
+        )
+        # the rank is read and saved by the task, not by the move
+        self.assertNotIn(UserRank._get_kind(), read_kinds(rpcs))
+        self.assertNotIn(
+            UserRank._get_kind(), [kind for kinds in saved for kind in kinds]
+        )
+        self.assertEqual(
+            len(self.get_tasks('/tasks/record_game_result')), 1
+        )
+
+        self.run_tasks()
+        score = Score.query(ancestor=self.game_key).get()
+        self.assertTrue(score.recorded)
+        rank = UserRank.query().get()
+        self.assertEqual((rank.games_finished, rank.games_won), (1, 1))
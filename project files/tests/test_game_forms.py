@@ -0,0 +1,81 @@
+"""test_game_forms.py - Datastore RPCs made to show a game."""
+
+from base import TestCase
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import api
+from models import User, Game
+
+
+def read_kinds(rpcs):
+    """Returns the kinds of the entities got or queried by datastore
+    RPCs."""
+    kinds = []
+    for call, request in rpcs:
+        if call == 'Get':
+            kinds.extend(
+                key.path().element_list()[-1].type()
+                for key in request.key_list()
+            )
+        elif call == 'RunQuery':
+            kinds.append(request.kind())
+    return kinds
+
+
+class GameFormTest(TestCase):
+
+    def setUp(self):
+        super(GameFormTest, self).setUp()
+        self.api = api.HangmanApi()
+        self.call(
+            self.api, 'create_user', api.USER_REQUEST, user='player',
+            email='player@example.com'
+        )
+        self.form = self.call(
+            self.api, 'new_game', api.NEW_GAME_REQUEST, user='player',
+            attempts=6, min_letters=5, max_letters=8
+        )
+        self.game_key = Game.query().get(keys_only=True)
+
+    def test_to_form_makes_no_rpcs(self):
+        game = self.game_key.get(use_cache=False)
+        form, rpcs = self.count_rpcs(game.to_form, 'Good luck!')
+        self.assertEqual(rpcs, 0)
+        self.assertEqual(form.user, 'player')
+
+    def test_game_without_user_name(self):
+        # games saved before the user name was stored get the user once
+        game = self.game_key.get(use_cache=False)
+        game.user_name = None
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        form, rpcs = self.count_rpcs(game.to_form, 'Good luck!')
+        self.assertEqual(rpcs, 1)
+        self.assertEqual(form.user, 'player')
+        form, rpcs = self.count_rpcs(game.to_form, 'Good luck!')
+        self.assertEqual(rpcs, 0)
+
+    def test_moves_do_not_read_the_user(self):
+        urlsafe = self.game_key.urlsafe()
+        form, rpcs = self.record_rpcs(
+            self.call, self.api, 'make_move', api.MAKE_MOVE_REQUEST,
+            urlsafe_game_key=urlsafe, guess='e'
+        )
+        self.assertEqual(form.user, 'player')
+        self.assertNotIn(User._get_kind(), read_kinds(rpcs))
+        form, rpcs = self.count_rpcs(
+            self.call, self.api, 'get_game', api.GET_GAME_REQUEST,
+            urlsafe_game_key=urlsafe
+        )
+        self.assertEqual(form.user, 'player')
+        # the game comes from the game cache
+        self.assertEqual(rpcs, 0)
+
+    def test_body_parts(self):
+        game = self.game_key.get()
+        game.attempts_remaining = 4
+        self.assertEqual(
+            game.to_form('').body_parts, "['head', 'body']"
+        )
@@ -0,0 +1,51 @@
+"""test_game_history.py - Parts of a game's history."""
+
+from base import TestCase
+
+import endpoints
+
+import api
+from models import Game
+
+
+class GameHistoryTest(TestCase):
+
+    def setUp(self):
+        super(GameHistoryTest, self).setUp()
+        self.api = api.HangmanApi()
+        self.call(
+            self.api, 'create_user', api.USER_REQUEST, user='player',
+            email='player@example.com'
+        )
+        self.call(
+            self.api, 'new_game', api.NEW_GAME_REQUEST, user='player',
+            attempts=6, min_letters=5, max_letters=8
+        )
+        self.urlsafe = Game.query().get(keys_only=True).urlsafe()
+        for guess in '12':
+            # not letters, so the game goes on whatever the word is
+            self.call(
+                self.api, 'make_move', api.MAKE_MOVE_REQUEST,
+                urlsafe_game_key=self.urlsafe, guess=guess
+            )
+
+    def history(self, **fields):
+        return self.call(
+            self.api, 'get_game_history', api.GAME_HISTORY_REQUEST,
+            urlsafe_game_key=self.urlsafe, **fields
+        ).history
+
+    def test_offset_and_limit(self):
+        moves = self.history()
+        first, second = moves.split(', (')
+        self.assertEqual(self.history(limit=1), first)
+        self.assertEqual(self.history(offset=1), '(' + second)
+        self.assertEqual(self.history(offset=5), '')
+        self.assertEqual(self.history(limit=0), '')
+
+    def test_negative_offset_or_limit(self):
+        for fields in [{'offset': -1}, {'limit': -1},
+                       {'offset': 2, 'limit': -5}]:
+            self.assertRaises(
+                endpoints.BadRequestException, self.history, **fields
+            )
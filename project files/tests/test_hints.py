@@ -0,0 +1,135 @@
+"""test_hints.py - The words matching a revealed pattern and the letter
+suggested for them, on a small word list. Skipped if NumPy is not
+installed."""
+
+import unittest
+
+from base import TestCase
+
+import endpoints
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import api
+import words
+
+# a dictionary of a few words, so the matches can be counted by hand
+DICTIONARY = 'tiny'
+WORDS = ['apple', 'angle', 'ample', 'eagle', 'maple', 'abase', 'bobby',
+         'banana']
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class HintTest(TestCase):
+
+    def setUp(self):
+        super(HintTest, self).setUp()
+        import hints
+        self.hints = hints
+        self.api = api.HangmanApi()
+        # get_word_index returns a loaded index whatever its name
+        words._indexes[DICTIONARY] = words.WordIndex.from_words(WORDS)
+
+    def tearDown(self):
+        del words._indexes[DICTIONARY]
+        for key in self.hints._tables.keys():
+            if key[0] == DICTIONARY:
+                del self.hints._tables[key]
+        self.hints._candidates_cache.clear()
+        super(HintTest, self).tearDown()
+
+    def matches(self, pattern, incorrect=''):
+        numbers = self.hints.candidates(
+            DICTIONARY, self.hints.normalize_pattern(pattern), incorrect
+        )
+        index = words.get_word_index(DICTIONARY)
+        first = index.starts[len(self.hints.normalize_pattern(pattern))]
+        return sorted(index.word(first + number) for number in numbers)
+
+    def test_nothing_revealed(self):
+        self.assertEqual(len(self.matches('_ _ _ _ _')), 7)
+        # a and e are each in six of the seven words; a comes first
+        self.assertEqual(
+            self.hints.best_letter(DICTIONARY, '_ _ _ _ _'), ('a', 6 / 7.0, 7)
+        )
+
+    def test_every_copy_of_a_shown_letter_is_revealed(self):
+        # abase has a hidden a, so it is not a match
+        self.assertEqual(
+            self.matches('a _ _ _ e'), ['ample', 'angle', 'apple']
+        )
+        # l is in all three, and a and e have been guessed
+        self.assertEqual(
+            self.hints.best_letter(DICTIONARY, 'A _ _ _ E'), ('l', 1.0, 3)
+        )
+
+    def test_incorrect_letters_are_excluded(self):
+        self.assertEqual(self.matches('a _ _ _ e', 'P'), ['angle'])
+        self.assertEqual(
+            self.hints.best_letter(DICTIONARY, 'a _ _ _ e', 'p'),
+            ('g', 1.0, 1)
+        )
+
+    def test_lengths_without_words(self):
+        # shorter than every word, and longer than the longest
+        for pattern in ('_ _ _ _', '_ _ _ _ _ _ _ _ _'):
+            self.assertEqual(
+                self.hints.best_letter(DICTIONARY, pattern), (None, 0.0, 0)
+            )
+
+    def test_every_letter_guessed(self):
+        self.assertEqual(
+            self.hints.best_letter(DICTIONARY, 'b a n a n a'),
+            (None, 0.0, 1)
+        )
+
+    def test_numbers_are_16_bit(self):
+        numbers = self.hints.candidates(DICTIONARY, '_____', '')
+        self.assertEqual(numbers.dtype, numpy.uint16)
+
+    def test_matches_are_cached(self):
+        first = self.hints.candidates(DICTIONARY, 'a___e', '')
+        self.assertIs(self.hints.candidates(DICTIONARY, 'a___e', ''), first)
+        self.assertIsNot(
+            self.hints.candidates(DICTIONARY, 'a___e', 'p'), first
+        )
+
+    def hint(self, pattern, **fields):
+        return self.call(
+            self.api, 'get_hint', api.HINT_REQUEST, pattern=pattern,
+            **fields
+        )
+
+    def test_get_hint(self):
+        form = self.hint('a _ _ _ e', dictionary=DICTIONARY,
+                         incorrect_letters='p')
+        self.assertEqual(
+            (form.letter, form.probability, form.candidates), ('g', 1.0, 1)
+        )
+
+    def test_get_hint_errors(self):
+        self.assertRaises(
+            endpoints.NotFoundException, self.hint, 'x _ _ _ _',
+            dictionary=DICTIONARY
+        )
+        self.assertRaises(
+            endpoints.BadRequestException, self.hint, '_ _ _ _ _',
+            dictionary='klingon'
+        )
+        self.assertRaises(endpoints.BadRequestException, self.hint, '  ')
+
+    def test_real_dictionaries(self):
+        # the word lists have fewer than 65536 words of any length
+        for dictionary in sorted(words.DICTIONARIES):
+            letter, share, count = self.hints.best_letter(
+                dictionary, '_ _ _ _ _ _ _'
+            )
+            self.assertTrue(letter)
+            self.assertGreater(count, 1000)
+            self.assertEqual(
+                self.hints.candidates(dictionary, '_______', '').dtype,
+                numpy.uint16
+            )
@@ -0,0 +1,114 @@
+"""test_leaderboards.py - Leaderboards kept as games end, and a read-heavy
+load on get_high_scores."""
+
+import time
+
+from base import TestCase
+
+import endpoints
+
+import api
+from models import User, Game, Score, Leaderboard, LEADERBOARD_SIZE
+
+# reads of get_high_scores in the read-heavy test
+READS = 200
+
+
+class LeaderboardTest(TestCase):
+
+    def setUp(self):
+        super(LeaderboardTest, self).setUp()
+        self.api = api.HangmanApi()
+
+    def end_game(self, name, attempts=6, correct='ab', incorrect='c'):
+        """Plays a game for a new user to the end, and records its result
+        with the task end_game queues."""
+        user = User(name=name)
+        user.put()
+        game = Game.build_game(
+            user.key, attempts, 5, 12, user_name=name, word='pneumonia'
+        )
+        game.put()
+        game.correct_letters = correct
+        game.incorrect_letters = incorrect
+        game.finish(True)
+        game.end_game()
+        self.run_tasks()
+        return game
+
+    def scores(self, difficulty):
+        return [entry.score for entry in Leaderboard.get_entries(difficulty)]
+
+    def test_first_score_is_added_once(self):
+        self.end_game('first')
+        self.assertEqual(self.scores('hard'), [666])
+        self.assertEqual(self.scores('all'), [666])
+
+    def test_recording_twice_adds_the_score_once(self):
+        game = self.end_game('first')
+        self.end_game('second', correct='abc', incorrect='')
+        score = Score.query(ancestor=game.key).get()
+        Leaderboard.add_score(score, 'first')
+        self.assertEqual(self.scores('all'), [1000, 666])
+
+    def test_rebuild_keeps_score_keys(self):
+        self.end_game('first', attempts=12)
+        self.end_game('second', attempts=9, correct='abc', incorrect='')
+        Leaderboard.rebuild_all()
+        self.assertEqual(self.scores('all'), [1000, 666])
+        self.assertEqual(self.scores('easy'), [666])
+        self.assertEqual(self.scores('medium'), [1000])
+        self.assertEqual(self.scores('hard'), [])
+        for entry in Leaderboard.get_entries('all'):
+            self.assertEqual(entry.score_key.kind(), 'Score')
+
+    def test_number_of_results(self):
+        self.end_game('first')
+        self.end_game('second', correct='abc', incorrect='')
+        forms = self.call(
+            self.api, 'get_high_scores', api.HIGH_SCORE_REQUEST,
+            number_of_results=1
+        )
+        self.assertEqual([form.score for form in forms.items], [1000])
+        for number_of_results in (0, -5):
+            self.assertRaises(
+                endpoints.BadRequestException, self.call, self.api,
+                'get_high_scores', api.HIGH_SCORE_REQUEST,
+                number_of_results=number_of_results
+            )
+
+    def read_high_scores(self, number_of_results):
+        """Returns the datastore RPCs and seconds per get_high_scores call
+        over READS calls, after one call to fill the caches."""
+        difficulties = ['easy', 'medium', 'hard', None]
+        for difficulty in difficulties:
+            self.call(
+                self.api, 'get_high_scores', api.HIGH_SCORE_REQUEST,
+                number_of_results=number_of_results, difficulty=difficulty
+            )
+        rpcs = 0
+        start = time.time()
+        for number in range(READS):
+            forms, count = self.count_rpcs(
+                self.call, self.api, 'get_high_scores',
+                api.HIGH_SCORE_REQUEST, number_of_results=number_of_results,
+                difficulty=difficulties[number % len(difficulties)]
+            )
+            rpcs += count
+        return float(rpcs) / READS, (time.time() - start) / READS
+
+    def test_read_heavy_load(self):
+        for number in range(30):
+            self.end_game(
+                'user%d' % number, attempts=[6, 9, 12][number % 3],
+                correct='abcdef'[:number % 6 + 1], incorrect='xyz'
+            )
+        cached_rpcs, cached_seconds = self.read_high_scores(20)
+        # more scores than a leaderboard keeps are read with a query, as
+        # every read was before the leaderboards
+        query_rpcs, query_seconds = self.read_high_scores(
+            LEADERBOARD_SIZE + 1
+        )
+        self.assertEqual(cached_rpcs, 0)
+        self.assertGreaterEqual(query_rpcs, 1)
+        self.assertLess(cached_seconds, query_seconds)
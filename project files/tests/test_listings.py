@@ -0,0 +1,88 @@
+"""test_listings.py - The score and ranking listings make the same number
+of datastore RPCs however many rows they return."""
+
+from datetime import date
+
+from base import TestCase
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import api
+from models import User, Game, Score, UserRank, LEADERBOARD_SIZE
+
+
+class ListingRpcTest(TestCase):
+
+    def setUp(self):
+        super(ListingRpcTest, self).setUp()
+        self.api = api.HangmanApi()
+        self.users = []
+
+    def add_rows(self, count):
+        """Adds count users, each with a score and a rank, and count more
+        scores for the first user."""
+        for number in range(count):
+            user = User(name='user%d' % (len(self.users)))
+            user.put()
+            self.users.append(user)
+            self.add_score(user, number)
+            UserRank(
+                key=UserRank.get_key(user.key, 'easy'), user=user.key,
+                difficulty='easy', performance=number
+            ).put()
+        for number in range(count):
+            self.add_score(self.users[0], number)
+
+    def add_score(self, user, number):
+        # the game itself is not needed
+        game_id = Game.allocate_ids(1, parent=user.key)[0]
+        Score(
+            parent=ndb.Key(Game, game_id, parent=user.key), user=user.key,
+            date=date.today(), difficulty='easy', score=number
+        ).put()
+
+    def listing_rpcs(self, name, request_container, **fields):
+        """Returns the number of rows and datastore RPCs of one call, with
+        nothing cached. The Next RPCs that fetch more batches of a query's
+        results are not counted; they grow with the rows returned however
+        the users are got."""
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        forms, rpcs = self.record_rpcs(
+            self.call, self.api, name, request_container, **fields
+        )
+        rows = getattr(forms, 'items', None) or forms.rankings
+        return len(rows), len([
+            call for call, request in rpcs if call != 'Next'
+        ])
+
+    def assert_constant_rpcs(self, name, request_container, **fields):
+        self.add_rows(2)
+        few_rows, few_rpcs = self.listing_rpcs(
+            name, request_container, **fields
+        )
+        self.add_rows(20)
+        many_rows, many_rpcs = self.listing_rpcs(
+            name, request_container, **fields
+        )
+        self.assertGreater(many_rows, few_rows)
+        self.assertEqual(many_rpcs, few_rpcs)
+
+    def test_get_scores(self):
+        self.assert_constant_rpcs('get_scores', api.SCORES_REQUEST)
+
+    def test_get_user_scores(self):
+        self.assert_constant_rpcs(
+            'get_user_scores', api.USER_SCORES_REQUEST, user_name='user0'
+        )
+
+    def test_get_high_scores(self):
+        # more scores than the leaderboards keep are read with a query
+        self.assert_constant_rpcs(
+            'get_high_scores', api.HIGH_SCORE_REQUEST,
+            number_of_results=LEADERBOARD_SIZE + 1
+        )
+
+    def test_get_user_rankings(self):
+        self.assert_constant_rpcs('get_user_rankings', api.RANKINGS_REQUEST)
@@ -0,0 +1,40 @@
+"""test_lru.py - The least-recently-used cache, by entries and by
+weight."""
+
+import unittest
+
+from lru import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_drops_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_bounded_by_weight(self):
+        cache = LRUCache(10, weigh=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.set('c', 'x' * 4)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 2)
+        # replacing a value counts only its new weight
+        cache.set('b', 'x' * 7)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('b'), 'x' * 7)
+        cache.delete('b')
+        cache.set('d', 'x' * 10)
+        self.assertEqual(cache.get('d'), 'x' * 10)
+
+    def test_value_larger_than_cache_is_not_kept(self):
+        cache = LRUCache(10, weigh=len)
+        cache.set('a', 'x' * 11)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
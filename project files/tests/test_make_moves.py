@@ -0,0 +1,46 @@
+"""test_make_moves.py - Several guesses sent in one request."""
+
+from base import TestCase
+
+import endpoints
+
+import api
+from models import User, Game, MoveReceipt
+
+
+class MakeMovesTest(TestCase):
+
+    def setUp(self):
+        super(MakeMovesTest, self).setUp()
+        self.api = api.HangmanApi()
+        user = User(name='player')
+        user.put()
+        self.game = Game.build_game(
+            user.key, 6, 5, 12, user_name='player', word='pneumonia'
+        )
+        self.game.put()
+
+    def moves(self, guesses, request_id=None):
+        return self.call(
+            self.api, 'make_moves', api.MAKE_MOVES_REQUEST,
+            urlsafe_game_key=self.game.key.urlsafe(), guesses=guesses,
+            request_id=request_id
+        )
+
+    def test_guesses_are_applied_in_order(self):
+        form = self.moves(['p', 'x', 'n'], request_id='first')
+        self.assertEqual(
+            [(result.guess, result.attempts_remaining)
+             for result in form.results],
+            [('p', 6), ('x', 5), ('n', 5)]
+        )
+        self.assertEqual(form.game.correct_letters, 'pn')
+        # sent again, the response is the same and nothing is applied
+        self.assertEqual(self.moves(['p', 'x', 'n'], request_id='first'), form)
+        self.assertEqual(self.game.key.get().attempts_remaining, 5)
+
+    def test_no_guesses(self):
+        with self.assertRaises(endpoints.BadRequestException):
+            self.moves([], request_id='empty')
+        self.assertIsNone(MoveReceipt.query(ancestor=self.game.key).get())
+        self.assertEqual(self.game.key.get().move_log, '')
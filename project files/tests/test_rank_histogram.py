@@ -0,0 +1,48 @@
+"""test_rank_histogram.py - A failed change to the rank histogram is
+corrected by a rebuild."""
+
+from base import TestCase
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+from models import User, UserRank, RankHistogram
+
+URL = '/tasks/rebuild_rank_histogram'
+
+
+class RankHistogramTest(TestCase):
+
+    def add_rank(self, name, performance):
+        user = User(name=name)
+        user.put()
+        UserRank(
+            key=UserRank.get_key(user.key, 'easy'), user=user.key,
+            difficulty='easy', performance=performance
+        ).put()
+        return performance
+
+    def test_move(self):
+        RankHistogram.move('easy', None, self.add_rank('first', 40))
+        RankHistogram.move('easy', None, self.add_rank('second', 60))
+        self.assertEqual(RankHistogram.get_position('easy', 40)[:2], (2, 2))
+        self.assertEqual(self.get_tasks(URL), [])
+
+    def test_failed_move_queues_a_rebuild(self):
+        RankHistogram.move('easy', None, self.add_rank('first', 40))
+
+        def always_fail(*args, **kwargs):
+            raise datastore_errors.TransactionFailedError()
+
+        performance = self.add_rank('second', 60)
+        transaction = ndb.transaction
+        ndb.transaction = always_fail
+        try:
+            RankHistogram.move('easy', None, performance)
+        finally:
+            ndb.transaction = transaction
+        # the second user is missing until the rebuild
+        self.assertEqual(RankHistogram.get_position('easy', 40)[:2], (1, 1))
+        self.assertEqual(len(self.get_tasks(URL)), 1)
+        self.run_tasks()
+        self.assertEqual(RankHistogram.get_position('easy', 40)[:2], (2, 2))
@@ -0,0 +1,54 @@
+"""test_reminders.py - The reminder cron sends each email once and records
+the progress of its run."""
+
+from base import TestCase
+
+from google.appengine.ext import testbed
+import webapp2
+
+import main
+from models import User, Game, ReminderRun
+
+
+class ReminderTest(TestCase):
+
+    def setUp(self):
+        super(ReminderTest, self).setUp()
+        self.mail = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        # two and a half batches of users, every other one with an
+        # unfinished game
+        for number in range(main.REMINDER_BATCH_SIZE * 5 / 2):
+            user = User(
+                name='user%d' % number, email='user%d@example.com' % number
+            )
+            user.put()
+            if number % 2:
+                Game(
+                    parent=user.key, user=user.key, target_word='hangman',
+                    attempts_allowed=6, attempts_remaining=6
+                ).put()
+
+    def send(self):
+        webapp2.Request.blank('/crons/send_reminder').get_response(main.app)
+        self.run_tasks()
+
+    def test_progress(self):
+        self.send()
+        users = main.REMINDER_BATCH_SIZE * 5 / 2
+        self.assertEqual(len(self.mail.get_sent_messages()), users / 2)
+        run = ReminderRun.query().get()
+        self.assertEqual(run.total_batches, 3)
+        batches, checked, emails, finished = run.get_progress()
+        self.assertEqual((batches, checked, emails), (3, users, users / 2))
+        self.assertIsNotNone(finished)
+
+    def test_retried_batch_is_not_sent_again(self):
+        self.send()
+        sent = len(self.mail.get_sent_messages())
+        run = ReminderRun.query().get()
+        request = webapp2.Request.blank(
+            '/tasks/send_reminder_batch', method='POST',
+            POST={'run': run.key.id(), 'batch': 0}
+        )
+        self.assertEqual(request.get_response(main.app).status_int, 200)
+        self.assertEqual(len(self.mail.get_sent_messages()), sent)
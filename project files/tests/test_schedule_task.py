@@ -0,0 +1,82 @@
+"""test_schedule_task.py - Coalescing of background tasks, on the local
+taskqueue stub."""
+
+from base import TestCase
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+import api
+import utils
+
+URL = '/tasks/cache_average_attempts'
+
+
+class FakeTime(object):
+    """Stands in for the time module in utils, with a clock the test
+    sets."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class ScheduleTaskTest(TestCase):
+
+    def setUp(self):
+        super(ScheduleTaskTest, self).setUp()
+        self.clock = FakeTime(1000000.0)
+        self._time = utils.time
+        utils.time = self.clock
+
+    def tearDown(self):
+        utils.time = self._time
+        super(ScheduleTaskTest, self).tearDown()
+
+    def test_burst_queues_one_task(self):
+        results = [utils.schedule_task(URL) for number in range(50)]
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(len(self.get_tasks(URL)), 1)
+        self.assertEqual(utils.get_suppressed_count(URL), 49)
+
+    def test_each_window_queues_a_task(self):
+        utils.schedule_task(URL)
+        self.clock.now += utils.DEFAULT_SCHEDULE_WINDOW
+        utils.schedule_task(URL)
+        utils.schedule_task(URL)
+        self.assertEqual(len(self.get_tasks(URL)), 2)
+
+    def test_task_name_guards_without_memcache(self):
+        utils.schedule_task(URL)
+        memcache.flush_all()
+        self.assertFalse(utils.schedule_task(URL))
+        self.assertEqual(len(self.get_tasks(URL)), 1)
+
+    def test_failed_add_does_not_suppress_the_next_request(self):
+        add = taskqueue.add
+
+        def fail(*args, **kwargs):
+            raise taskqueue.TransientError()
+
+        taskqueue.add = fail
+        try:
+            with self.assertRaises(taskqueue.TransientError):
+                utils.schedule_task(URL)
+        finally:
+            taskqueue.add = add
+        self.assertTrue(utils.schedule_task(URL))
+        self.assertEqual(len(self.get_tasks(URL)), 1)
+
+    def test_new_games_share_one_task(self):
+        hangman = api.HangmanApi()
+        self.call(hangman, 'create_user', api.USER_REQUEST, user='player')
+        for number in range(20):
+            self.call(
+                hangman, 'new_game', api.NEW_GAME_REQUEST, user='player',
+                attempts=9, min_letters=5, max_letters=10
+            )
+        self.assertEqual(len(self.get_tasks(URL)), 1)
+        self.assertEqual(utils.get_suppressed_count(URL), 19)
+        self.assertEqual(self.run_tasks(), 1)
@@ -0,0 +1,66 @@
+"""test_startup.py - The import timer stops without a warmup request."""
+
+import __builtin__
+import subprocess
+import sys
+
+from base import TestCase, APP_DIR
+
+import startup
+
+
+class StartupTest(TestCase):
+
+    def setUp(self):
+        super(StartupTest, self).setUp()
+        self.original_import = __builtin__.__import__
+        self.imports = startup._imports[:]
+        self.max_imports = startup.MAX_IMPORTS
+        startup.install()
+
+    def tearDown(self):
+        startup.uninstall()
+        __builtin__.__import__ = self.original_import
+        startup._imports[:] = self.imports
+        startup.MAX_IMPORTS = self.max_imports
+        super(StartupTest, self).tearDown()
+
+    def import_new_module(self):
+        sys.modules.pop('colorsys', None)
+        __import__('colorsys')
+
+    def request(self, path):
+        app = startup.StartupMiddleware(
+            lambda environ, start_response: ['ok']
+        )
+        return app({'PATH_INFO': path}, None)
+
+    def test_warmup_keeps_timing(self):
+        self.request(startup.WARMUP_PATH)
+        self.assertIs(__builtin__.__import__, startup._timed_import)
+
+    def test_first_request_stops_timing(self):
+        self.assertEqual(self.request('/_ah/spi/HangmanApi.get_game'), ['ok'])
+        self.assertIs(__builtin__.__import__, self.original_import)
+
+    def test_imports_are_capped(self):
+        startup.MAX_IMPORTS = len(startup._imports) + 1
+        self.import_new_module()
+        self.assertIs(__builtin__.__import__, startup._timed_import)
+        self.import_new_module()
+        self.assertIs(__builtin__.__import__, self.original_import)
+        self.assertEqual(len(startup._imports), startup.MAX_IMPORTS)
+
+    def test_timing_stops_after_max_seconds(self):
+        startup._installed_at -= startup.MAX_SECONDS + 1
+        self.import_new_module()
+        self.assertIs(__builtin__.__import__, self.original_import)
+
+    def test_handlers_do_not_import_endpoints(self):
+        # in a new interpreter, as the tests have imported endpoints already
+        imported = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys; sys.path[:] = %r; import main; '
+            'print "endpoints" in sys.modules' % sys.path
+        ], cwd=APP_DIR)
+        self.assertEqual(imported.strip(), 'False')
@@ -0,0 +1,167 @@
+"""test_transactions.py - Contention tests for make_move and cancel_game.
+
+Several requests for the same game are run on threads against the local
+datastore stub. Each request reads the game in its transaction and then
+waits until every other request has read it too, so all of them but one
+fail to commit and have to retry."""
+
+import threading
+import time
+
+from base import TestCase
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+import endpoints
+
+import api
+import utils
+from models import User, Game
+
+
+class Gate(object):
+    """Holds each thread on its first pass until `parties` threads have
+    reached it."""
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.waiting = 0
+        self.condition = threading.Condition()
+        self.passed = threading.local()
+
+    def wait(self):
+        if getattr(self.passed, 'value', False):
+            return
+        self.passed.value = True
+        deadline = time.time() + 5
+        with self.condition:
+            self.waiting += 1
+            self.condition.notify_all()
+            while self.waiting < self.parties:
+                if time.time() > deadline:
+                    raise AssertionError('Threads did not meet at the gate')
+                self.condition.wait(0.1)
+
+
+class ContentionTest(TestCase):
+
+    def setUp(self):
+        super(ContentionTest, self).setUp()
+        self.api = api.HangmanApi()
+        self.user = User(name='player')
+        self.user.put()
+        # known word, so which guesses are correct is known
+        self.game = Game.build_game(
+            self.user.key, 12, 5, 12, user_name='player', word='pneumonia'
+        )
+        self.game.put()
+        self.urlsafe = self.game.key.urlsafe()
+
+        self._get_game = api.HangmanApi.__dict__['_get_game']
+        self._retry_delay = utils.TRANSACTION_RETRY_DELAY
+        utils.TRANSACTION_RETRY_DELAY = 0.01
+
+    def tearDown(self):
+        api.HangmanApi._get_game = self._get_game
+        utils.TRANSACTION_RETRY_DELAY = self._retry_delay
+        super(ContentionTest, self).tearDown()
+
+    def hold_after_read(self, parties):
+        """Makes each request wait, after its first read of the game, until
+        `parties` requests have read it."""
+        gate = Gate(parties)
+        get_game = self._get_game.__func__
+
+        def held_get_game(game_key):
+            game = get_game(game_key)
+            gate.wait()
+            return game
+        api.HangmanApi._get_game = staticmethod(held_get_game)
+
+    def run_parallel(self, calls):
+        """Runs each of calls, a list of (endpoint name, request container,
+        fields), on its own thread. Returns the results, with any exception
+        in place of a result."""
+        results = [None] * len(calls)
+        def run(number, name, container, fields):
+            try:
+                results[number] = self.call(
+                    self.api, name, container, **fields
+                )
+            except Exception as e:
+                results[number] = e
+            finally:
+                # the next test must not find this thread's context
+                ndb.get_context().clear_cache()
+
+        threads = [
+            threading.Thread(target=run, args=(number,) + call)
+            for number, call in enumerate(calls)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        return results
+
+    def move(self, guess, request_id=None):
+        return ('make_move', api.MAKE_MOVE_REQUEST, dict(
+            urlsafe_game_key=self.urlsafe, guess=guess, request_id=request_id
+        ))
+
+    def test_parallel_moves_are_all_applied(self):
+        self.hold_after_read(3)
+        results = self.run_parallel(
+            [self.move('p'), self.move('x'), self.move('e')]
+        )
+        for result in results:
+            self.assertIsInstance(result, api.GameForm)
+        game = self.game.key.get(use_cache=False)
+        self.assertEqual(sorted(game.correct_letters), ['e', 'p'])
+        self.assertEqual(game.incorrect_letters, 'x')
+        self.assertEqual(game.attempts_remaining, 11)
+        self.assertEqual(len(list(game.iter_moves())), 3)
+
+    def test_retried_move_is_applied_once(self):
+        self.hold_after_read(2)
+        results = self.run_parallel(
+            [self.move('x', 'request-1'), self.move('x', 'request-1')]
+        )
+        self.assertEqual(results[0], results[1])
+        game = self.game.key.get(use_cache=False)
+        self.assertEqual(game.attempts_remaining, 11)
+        self.assertEqual(len(list(game.iter_moves())), 1)
+
+    def test_cancel_during_moves(self):
+        self.hold_after_read(3)
+        results = self.run_parallel([
+            self.move('x'),
+            ('cancel_game', api.GET_GAME_REQUEST,
+             dict(urlsafe_game_key=self.urlsafe)),
+            self.move('z'),
+        ])
+        for result in results:
+            self.assertNotIsInstance(result, Exception)
+        game = self.game.key.get(use_cache=False)
+        self.assertTrue(game.cancelled)
+        # only the moves that committed before the cancellation count
+        applied = [
+            form for form in (results[0], results[2])
+            if 'cancelled' not in form.message
+        ]
+        self.assertEqual(game.attempts_remaining, 12 - len(applied))
+
+    def test_conflict_after_every_retry(self):
+        def always_fail(*args, **kwargs):
+            raise datastore_errors.TransactionFailedError()
+
+        transaction = ndb.transaction
+        ndb.transaction = always_fail
+        try:
+            with self.assertRaises(utils.TransactionConflictError):
+                utils.run_in_transaction(lambda: None)
+            name, container, fields = self.move('x')
+            with self.assertRaises(endpoints.ConflictException):
+                self.call(self.api, name, container, **fields)
+        finally:
+            ndb.transaction = transaction
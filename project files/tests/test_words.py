@@ -0,0 +1,61 @@
+"""test_words.py - The committed binary word lists match their text files,
+and a binary file that does not is ignored."""
+
+import os
+import shutil
+import tempfile
+
+from base import TestCase
+
+import words
+
+
+class WordIndexTest(TestCase):
+
+    def setUp(self):
+        super(WordIndexTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(WordIndexTest, self).tearDown()
+
+    def write_word_list(self, text):
+        filename = os.path.join(self.directory, 'words.txt')
+        with open(filename, 'wb') as words_file:
+            words_file.write(text)
+        return filename
+
+    def test_committed_binary_files_are_current(self):
+        # fails if a word list changed without running python words.py
+        for filename in words.DICTIONARIES.values():
+            with open(filename, 'rb') as words_file:
+                checksum = words.text_checksum(words_file.read())
+            index = words.WordIndex.from_binary_file(
+                words.binary_filename(filename)
+            )
+            self.assertEqual(index.checksum, checksum, filename)
+
+    def test_binary_file_of_another_text_is_ignored(self):
+        filename = self.write_word_list('apple\nbanana\nkiwis\n')
+        words.WordIndex.from_text_file(filename).write_binary_file(
+            words.binary_filename(filename)
+        )
+        self.assertEqual(
+            words.load_word_index(filename).random_word(6, 6), 'banana'
+        )
+        # the same size, so only the checksum tells them apart
+        self.write_word_list('apple\norange\nkiwis\n')
+        self.assertEqual(
+            words.load_word_index(filename).random_word(6, 6), 'orange'
+        )
+        # and the binary file was rebuilt
+        index = words.WordIndex.from_binary_file(
+            words.binary_filename(filename)
+        )
+        self.assertEqual(index.random_word(6, 6), 'orange')
+
+    def test_missing_binary_file_is_built(self):
+        filename = self.write_word_list('apple\nbanana\nkiwis\n')
+        self.assertEqual(len(words.load_word_index(filename)), 3)
+        self.assertTrue(os.path.exists(words.binary_filename(filename)))
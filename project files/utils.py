@@ -1,22 +1,47 @@
 """utils.py - File for collecting general utility functions."""
 
+import datetime
 import logging
+import random
+import re
+import time
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+# how many times a transaction that failed because of contention is retried,
+# and the longest wait in seconds before the first retry
+TRANSACTION_RETRIES = 3
+TRANSACTION_RETRY_DELAY = 0.1
+
+# background tasks queued with schedule_task run at most once per this many
+# seconds
+DEFAULT_SCHEDULE_WINDOW = 10
+MEMCACHE_SCHEDULED = 'SCHEDULED_%s_%d'
+MEMCACHE_SUPPRESSED = 'SUPPRESSED_%s'
+
+# number of results in one page of a listing, if the client does not ask for
+# a page size, and the largest page size allowed
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that the urlsafe key string points to, without
+    getting the entity. Checks that the key is of the correct kind.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The Key that the urlsafe Key string points to.
     Raises:
-        ValueError:"""
+        BadRequestException: if the key string is malformed
+        ValueError: if the key is of the incorrect kind"""
+    # only the api raises endpoints errors, so the handlers in main.py do
+    # not import endpoints
+    import endpoints
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -27,9 +52,152 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    return get_key_by_urlsafe(urlsafe, model).get()
+
+
+def get_user_names(entities):
+    """Returns a dictionary of User key to user name for the users of a list
+    of entities with a `user` KeyProperty, such as Scores. Every distinct
+    user is got in one batch, instead of one get per entity.
+    Args:
+        entities: A list of entities with a `user` property
+    Returns:
+        A dictionary of User key to name. Users that do not exist are left
+        out."""
+    keys = list(set(entity.user for entity in entities))
+    return dict(
+        (key, user.name) for key, user in zip(keys, ndb.get_multi(keys))
+        if user is not None
+    )
+
+
+def fetch_page(query, page_size=None, cursor=None):
+    """Fetches one page of results of a query, using a datastore cursor to
+    continue from the end of the previous page.
+    Args:
+        query: An ndb.Query
+        page_size: The number of results wanted, up to MAX_PAGE_SIZE.
+            Defaults to DEFAULT_PAGE_SIZE.
+        cursor: The next_cursor string returned with the previous page, or
+            None for the first page.
+    Returns:
+        A list of results and the urlsafe cursor string for the next page, or
+        None if this is the last page.
+    Raises:
+        BadRequestException: if the page size or cursor is invalid"""
+    import endpoints
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise endpoints.BadRequestException(
+            'Page size must be 1 to %d.' % MAX_PAGE_SIZE
+        )
+    try:
+        results, next_cursor, more = query.fetch_page(
+            page_size, start_cursor=Cursor(urlsafe=cursor or None)
+        )
+    except (datastore_errors.BadValueError,
+            datastore_errors.BadRequestError):
+        raise endpoints.BadRequestException('Invalid cursor')
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+class TransactionConflictError(Exception):
+    """Raised by run_in_transaction when every attempt at a transaction
+    failed because of contention."""
+
+
+def run_in_transaction(func, *args, **kwargs):
+    """Runs func(*args, **kwargs) in a datastore transaction and returns its
+    result. If the transaction fails because of contention it is retried up
+    to TRANSACTION_RETRIES times, waiting a random, doubling delay between
+    attempts.
+    Raises:
+        TransactionConflictError: if every attempt failed"""
+    delay = TRANSACTION_RETRY_DELAY
+    for attempt in range(TRANSACTION_RETRIES + 1):
+        try:
+            return ndb.transaction(lambda: func(*args, **kwargs), retries=0)
+        except datastore_errors.TransactionFailedError:
+            logging.warning(
+                'Transaction failed, attempt %d of %d',
+                attempt + 1, TRANSACTION_RETRIES + 1
+            )
+            if attempt == TRANSACTION_RETRIES:
+                break
+            time.sleep(random.uniform(0, delay))
+            delay *= 2
+    raise TransactionConflictError(
+        'Transaction failed %d times' % (TRANSACTION_RETRIES + 1)
+    )
+
+
+def schedule_task(url, window=DEFAULT_SCHEDULE_WINDOW, params=None):
+    """Queues a background task for url, unless one has already been queued
+    for the same window of time. Many requests for the same job in a burst
+    are collapsed into one task, which runs at the end of the window so it
+    sees every change made during it. A memcache flag saves the taskqueue
+    call for most repeats, and the task name makes sure there is only one
+    task per window if memcache is flushed. Named tasks cannot be queued in
+    a transaction, so call it outside one.
+    Args:
+        url: The url of the task handler
+        window: The length of the window in seconds
+        params: Optional dictionary of parameters for the task. Requests
+            with different parameters in the same window are still
+            collapsed into the first one.
+    Returns:
+        True if a task was queued, False if the request was suppressed."""
+    now = time.time()
+    window_number = int(now // window)
+    guard = MEMCACHE_SCHEDULED % (url, window_number)
+    if not memcache.add(guard, 1, time=window):
+        _count_suppressed(url)
+        return False
+
+    # task names may only contain letters, digits, - and _
+    name = '%s-%d-%d' % (
+        re.sub(r'[^a-zA-Z0-9_-]', '-', url).strip('-'), window, window_number
+    )
+    eta = datetime.datetime.utcfromtimestamp((window_number + 1) * window)
+    try:
+        taskqueue.add(url=url, params=params, name=name, eta=eta)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        _count_suppressed(url)
+        return False
+    except Exception:
+        # no task was queued, so the next request must not be suppressed
+        memcache.delete(guard)
+        raise
+    return True
+
+
+def _count_suppressed(url):
+    """Counts a request for a background task that was suppressed."""
+    memcache.incr(MEMCACHE_SUPPRESSED % url, initial_value=0)
+
+
+def get_suppressed_count(url):
+    """Returns the number of requests for a task for url that schedule_task
+    has suppressed, since memcache was last flushed."""
+    return memcache.get(MEMCACHE_SUPPRESSED % url) or 0
@@ -0,0 +1,415 @@
+"""words.py - In-memory word indexes used to pick target words for new games.
+
+Each dictionary (word list) is loaded once per instance. The words are sorted
+by length and difficulty tier and packed into a single byte string, with
+prefix-summed tables of counts per length and per (length, tier) pool. A
+random word for any length range and tier can be picked without building a
+new list or scanning the words.
+
+A word list is compiled ahead of time into a binary file holding the same
+tables, which is memory-mapped at runtime instead of parsed. The tiers are
+computed when a word list is compiled. The binary files are committed next
+to the word lists, and each one records the size and CRC-32 of the text it
+was compiled from, so one that no longer matches its word list is ignored:
+
+    python words.py                 compile every word list
+    python words.py benchmark       compare loading the text and binary files
+"""
+
+import bisect
+import logging
+import os
+import random
+import string
+import struct
+import sys
+import zlib
+
+try:
+    import mmap
+except ImportError:
+    # not every runtime allows mmap, the binary file is read instead
+    mmap = None
+
+
+# dictionaries that can be picked for a new game, and their word lists.
+# https://github.com/first20hours/google-10000-english
+DICTIONARIES = {
+    'common': 'google-10000-english-usa.txt',
+    'full': 'wordsEn.txt',
+}
+DEFAULT_DICTIONARY = 'common'
+
+# guesses 1 to 4 characters long are treated as errant guesses, not attempts
+# to solve, so shorter words are left out of every dictionary
+MIN_WORD_LENGTH = 5
+
+# word difficulty tiers, easiest first
+TIERS = ('easy', 'medium', 'hard')
+
+# binary file layout, all integers are little-endian unsigned 32 bit:
+#   magic, size and CRC-32 of the word list, max_length,
+#   starts[0 .. max_length + 1], offsets[0 .. max_length + 1],
+#   tier_starts[tier][0 .. max_length + 1] for each tier,
+#   tier_bases[tier][0 .. max_length + 1] for each tier,
+#   the words, sorted by length and tier, with no separators
+BINARY_MAGIC = 'HMW3'
+BINARY_HEADER = struct.Struct('<4sIII')
+
+# loaded word indexes, keyed by dictionary name
+_indexes = {}
+
+
+def text_checksum(text):
+    """Return the (size, CRC-32) of a word list's text, which a binary file
+    records to show what it was compiled from."""
+    return len(text), zlib.crc32(text) & 0xffffffff
+
+
+def word_tiers(words):
+    """Return the difficulty tier (an index into TIERS) of each word.
+    A word is easier the more likely a guessed letter is to be in it: its
+    score is the sum, over its distinct letters, of the share of words in the
+    list that contain that letter. Words with few distinct letters, or with
+    rare letters, score low. Each length is split into thirds by score, so
+    every (length, tier) pool has words if the length has at least three."""
+    letter_counts = dict.fromkeys(string.ascii_lowercase, 0)
+    distinct_letters = []
+    for word in words:
+        letters = set(word.lower()) & set(string.ascii_lowercase)
+        distinct_letters.append(letters)
+        for letter in letters:
+            letter_counts[letter] += 1
+
+    scores = [
+        sum(letter_counts[letter] for letter in letters)
+        for letters in distinct_letters
+    ]
+
+    by_length = {}
+    for number, word in enumerate(words):
+        by_length.setdefault(len(word), []).append(number)
+
+    tiers = [0] * len(words)
+    for numbers in by_length.values():
+        numbers.sort(key=lambda number: -scores[number])
+        for rank, number in enumerate(numbers):
+            tiers[number] = rank * len(TIERS) // len(numbers)
+    return tiers
+
+
+class WordIndex(object):
+    """Words bucketed by length, and by tier within each length.
+    starts[length] is the number of words shorter than `length` letters, so
+    the words of length min to max are numbers starts[min] to
+    starts[max + 1] - 1. offsets[length] is the position in data of the first
+    word that is `length` letters long. Words of the same length are stored
+    one after the other, so word n is sliced straight out of data.
+
+    tier_starts[tier][length] is the number of words in that tier shorter
+    than `length` letters, and tier_bases[tier][length] is the number of the
+    first word of that tier and length.
+
+    checksum is the text_checksum of the word list the index was built
+    from, or None if it was not built from a file."""
+
+    def __init__(self, data, starts, offsets, tier_starts, tier_bases,
+                 checksum=None):
+        self.data = data
+        self.starts = starts
+        self.offsets = offsets
+        self.tier_starts = tier_starts
+        self.tier_bases = tier_bases
+        self.max_length = len(starts) - 2
+        self.checksum = checksum
+
+    @classmethod
+    def from_words(cls, words):
+        """Build a WordIndex from a list of words, computing their tiers."""
+        tiers = word_tiers(words)
+        order = sorted(
+            range(len(words)),
+            key=lambda number: (len(words[number]), tiers[number])
+        )
+        words = [words[number] for number in order]
+        tiers = [tiers[number] for number in order]
+        max_length = len(words[-1]) if words else 0
+
+        # count the words of each length and pool, then prefix-sum the counts
+        counts = [[0] * (max_length + 2) for tier in TIERS]
+        for word, tier in zip(words, tiers):
+            counts[tier][len(word)] += 1
+        starts = [0] * (max_length + 2)
+        offsets = [0] * (max_length + 2)
+        tier_starts = [[0] * (max_length + 2) for tier in TIERS]
+        tier_bases = [[0] * (max_length + 2) for tier in TIERS]
+        for length in range(max_length + 2):
+            if length > 0:
+                length_count = sum(count[length - 1] for count in counts)
+                starts[length] = starts[length - 1] + length_count
+                offsets[length] = \
+                    offsets[length - 1] + length_count * (length - 1)
+            base = starts[length]
+            for tier in range(len(TIERS)):
+                if length > 0:
+                    tier_starts[tier][length] = \
+                        tier_starts[tier][length - 1] + \
+                        counts[tier][length - 1]
+                tier_bases[tier][length] = base
+                base += counts[tier][length]
+        return cls(''.join(words), starts, offsets, tier_starts, tier_bases)
+
+    @classmethod
+    def from_text_file(cls, filename):
+        """Build a WordIndex from a text file with one word per line."""
+        with open(filename, 'rb') as words_file:
+            text = words_file.read()
+        index = cls.from_words(
+            [word for word in (line.strip() for line in text.splitlines())
+             if len(word) >= MIN_WORD_LENGTH]
+        )
+        index.checksum = text_checksum(text)
+        return index
+
+    @classmethod
+    def from_binary_file(cls, filename):
+        """Load a WordIndex compiled by write_binary_file. The file is
+        memory-mapped if possible, so no words are read until they are
+        picked."""
+        with open(filename, 'rb') as binary_file:
+            data = None
+            if mmap is not None:
+                try:
+                    data = mmap.mmap(
+                        binary_file.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+                except (EnvironmentError, ValueError):
+                    data = None
+            if data is None:
+                data = binary_file.read()
+
+        magic, size, crc, max_length = BINARY_HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC:
+            raise ValueError('%s is not a compiled word list.' % filename)
+        table = struct.Struct('<%dI' % (max_length + 2))
+        position = [BINARY_HEADER.size]
+
+        def read_table():
+            values = list(table.unpack_from(data, position[0]))
+            position[0] += table.size
+            return values
+
+        starts = read_table()
+        offsets = read_table()
+        tier_starts = [read_table() for tier in TIERS]
+        tier_bases = [read_table() for tier in TIERS]
+        # offsets in the file are relative to the start of the words
+        offsets = [offset + position[0] for offset in offsets]
+        return cls(
+            data, starts, offsets, tier_starts, tier_bases, (size, crc)
+        )
+
+    def write_binary_file(self, filename):
+        """Write this index, which must have been built from a word list, to
+        filename in the compiled binary format."""
+        table = struct.Struct('<%dI' % (self.max_length + 2))
+        first = self.offsets[0]
+        size, crc = self.checksum
+        with open(filename, 'wb') as binary_file:
+            binary_file.write(
+                BINARY_HEADER.pack(BINARY_MAGIC, size, crc, self.max_length)
+            )
+            binary_file.write(table.pack(*self.starts))
+            binary_file.write(
+                table.pack(*[offset - first for offset in self.offsets])
+            )
+            for values in self.tier_starts + self.tier_bases:
+                binary_file.write(table.pack(*values))
+            binary_file.write(
+                self.data[first:self.offsets[self.max_length + 1]]
+            )
+
+    def __len__(self):
+        return self.starts[self.max_length + 1]
+
+    def _start(self, starts, length):
+        """Return the number of words shorter than `length` letters, using
+        the prefix-summed starts table of all words or of one tier."""
+        if length < 0:
+            return 0
+        if length > self.max_length:
+            return starts[self.max_length + 1]
+        return starts[length]
+
+    def word(self, number):
+        """Return word `number`, counting from the shortest word."""
+        # the length of the word is the last length starting at or before it
+        length = bisect.bisect_right(self.starts, number) - 1
+        offset = self.offsets[length] + (number - self.starts[length]) * length
+        return self.data[offset:offset + length]
+
+    def tier_word(self, tier, number):
+        """Return word `number` of a tier, counting from the shortest word
+        in the tier."""
+        starts = self.tier_starts[tier]
+        length = bisect.bisect_right(starts, number) - 1
+        return self.word(
+            self.tier_bases[tier][length] + number - starts[length]
+        )
+
+    def count(self, min_letters, max_letters, tier=None):
+        """Return the number of words min_letters to max_letters long, in
+        one tier or in all tiers if tier is None."""
+        starts = self.starts if tier is None else self.tier_starts[tier]
+        return max(0, self._start(starts, max_letters + 1) -
+                   self._start(starts, min_letters))
+
+    def random_word(self, min_letters, max_letters, tier=None):
+        """Return a random word min_letters to max_letters long, from one tier
+        or from all tiers if tier is None. Raises a ValueError if there are no
+        such words."""
+        starts = self.starts if tier is None else self.tier_starts[tier]
+        first = self._start(starts, min_letters)
+        last = self._start(starts, max_letters + 1)
+        if last <= first:
+            raise ValueError(
+                'There are no %swords between %d and %d letters long.'
+                % ('' if tier is None else TIERS[tier] + ' ',
+                   min_letters, max_letters)
+            )
+        number = random.randrange(first, last)
+        if tier is None:
+            return self.word(number)
+        return self.tier_word(tier, number)
+
+
+def binary_filename(filename):
+    """Return the name of the compiled binary file for a word list."""
+    return os.path.splitext(filename)[0] + '.bin'
+
+
+def load_word_index(filename):
+    """Load the WordIndex for filename, from its compiled binary file if that
+    was compiled from the text file as it is now, otherwise from the text
+    file. A missing or out of date binary file is logged, and rebuilt where
+    the file system can be written, as on the development server. Checking
+    the binary file reads the text file, but does not parse it."""
+    binary = binary_filename(filename)
+    if os.path.exists(binary):
+        with open(filename, 'rb') as words_file:
+            checksum = text_checksum(words_file.read())
+        try:
+            index = WordIndex.from_binary_file(binary)
+        except (ValueError, struct.error):
+            index = None
+        if index is not None and index.checksum == checksum:
+            return index
+        logging.warning(
+            '%s was not compiled from the current %s, loading the text file;'
+            ' run python words.py and commit it', binary, filename
+        )
+    else:
+        logging.warning(
+            '%s is missing, loading the text file; run python words.py and '
+            'commit it', binary
+        )
+    index = WordIndex.from_text_file(filename)
+    try:
+        index.write_binary_file(binary)
+    except EnvironmentError:
+        # App Engine's file system is read-only
+        pass
+    return index
+
+
+def get_word_index(dictionary=DEFAULT_DICTIONARY):
+    """Return the WordIndex for a dictionary, loading it on first use.
+    Raises a ValueError if there is no such dictionary."""
+    index = _indexes.get(dictionary)
+    if index is None:
+        if dictionary not in DICTIONARIES:
+            raise ValueError(
+                'Dictionary must be one of: %s'
+                % ', '.join(sorted(DICTIONARIES))
+            )
+        index = load_word_index(DICTIONARIES[dictionary])
+        _indexes[dictionary] = index
+    return index
+
+
+def get_tier(word_difficulty):
+    """Convert a word difficulty name to a tier. Returns None (all tiers) if
+    word_difficulty is empty, raises a ValueError if it is not a tier."""
+    if not word_difficulty:
+        return None
+    if word_difficulty not in TIERS:
+        raise ValueError(
+            'Word difficulty must be one of: %s' % ', '.join(TIERS)
+        )
+    return TIERS.index(word_difficulty)
+
+
+def compile_word_lists():
+    """Compile every dictionary's word list into its binary file."""
+    for filename in sorted(DICTIONARIES.values()):
+        index = WordIndex.from_text_file(filename)
+        index.write_binary_file(binary_filename(filename))
+        print '%s: %d words -> %s' % (
+            filename, len(index), binary_filename(filename))
+
+
+def _readlines_pick(filename, min_letters, max_letters):
+    """Pick a word the way Game.new_game did before the word index: read the
+    whole file and filter it by length."""
+    words_file = open(filename, 'r')
+    all_words = words_file.readlines()
+    words_file.close()
+    correct_length_words = []
+    for word in all_words:
+        if len(word) <= max_letters + 1 and len(word) >= min_letters + 1:
+            correct_length_words.append(word)
+    pick_line = random.randrange(0, len(correct_length_words))
+    return correct_length_words[pick_line].rstrip('\n')
+
+
+def benchmark(number=20):
+    """Print the cost of loading each word list and picking one word, for the
+    old readlines() path, the text index and the compiled binary index."""
+    import timeit
+    for dictionary, filename in sorted(DICTIONARIES.items()):
+        print filename
+        timings = [
+            ('readlines() and filter',
+             lambda: _readlines_pick(filename, 6, 12)),
+            ('text index, load and pick',
+             lambda: WordIndex.from_text_file(filename).random_word(6, 12)),
+        ]
+        if os.path.exists(binary_filename(filename)):
+            timings.append((
+                'binary index, load and pick',
+                lambda: WordIndex.from_binary_file(
+                    binary_filename(filename)).random_word(6, 12)
+            ))
+            # as an instance starts: checked against the text file first
+            timings.append((
+                'checked binary, load and pick',
+                lambda: load_word_index(filename).random_word(6, 12)
+            ))
+        index = get_word_index(dictionary)
+        timings.append((
+            'loaded index, pick only', lambda: index.random_word(6, 12)
+        ))
+        timings.append((
+            'loaded index, pick hard only',
+            lambda: index.random_word(6, 12, TIERS.index('hard'))
+        ))
+        for name, func in timings:
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            print '  %-30s %10.3f ms' % (name, seconds * 1000 / number)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+    else:
+        compile_word_lists()